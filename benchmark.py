@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Замеры горячего цикла рассылки на FakeTelegramClient без аккаунта.
+
+Для каждого размера (по умолчанию 1k/10k/100k чатов) в отдельном
+временном каталоге выполняется полная синхронизация диалогов и
+рассылка по всем чатам, затем печатается:
+  - скорость отправки (сообщ/сек, по реальному и по времени цикла),
+  - накладные расходы на одну отправку сверх задержки сети,
+  - время записи в базу, журнал курсора и журнал доставки,
+  - память (пик tracemalloc при --tracemalloc и ru_maxrss процесса).
+
+Примеры:
+  python benchmark.py
+  python benchmark.py --sizes 1000 10000 --latency 0.05 --fake-clock
+  python benchmark.py --sizes 1000 --flood-every 200 --fake-clock --json
+  python benchmark.py --sizes 2000 --media-bytes 5000000
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegramClient, VirtualTimeLoop
+
+# main.py работает с data/ и logs/ относительно текущего каталога,
+# поэтому импортируется внутри временного каталога (см. run_benchmarks)
+main = None
+
+class Timer:
+    """Суммарное время и число вызовов обернутых функций.
+
+    Время вложенных замеров (например, запись индекса в базу внутри
+    журнала доставки) вычитается из внешнего, чтобы не считать его дважды.
+    """
+
+    _active = []
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+
+    def wrap(self, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            Timer._active.append(0.0)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = Timer._active.pop()
+                self.seconds += elapsed - nested
+                self.calls += 1
+                if Timer._active:
+                    Timer._active[-1] += elapsed
+        return wrapper
+
+@contextmanager
+def instrument(bot):
+    """Считать время записи в базу, журнал курсора и журнал доставки"""
+    store_timer, journal_timer, delivery_timer = Timer(), Timer(), Timer()
+    bot.store._execute = store_timer.wrap(bot.store._execute)
+    bot.store._transaction = store_timer.wrap(bot.store._transaction)
+    bot.delivery.record = delivery_timer.wrap(bot.delivery.record)
+    original_append = main.CampaignJournal.append
+    main.CampaignJournal.append = journal_timer.wrap(original_append)
+    try:
+        yield store_timer, journal_timer, delivery_timer
+    finally:
+        main.CampaignJournal.append = original_append
+        del bot.store._execute, bot.store._transaction, bot.delivery.record
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+def run_size(size, args):
+    """Один прогон в чистом каталоге: синхронизация и рассылка по всем чатам"""
+    workdir = os.path.join(os.getcwd(), f"run-{size}")
+    os.makedirs(workdir)
+    os.chdir(workdir)
+    os.makedirs("logs", exist_ok=True)
+    with open(main.CONFIG_FILE, 'w', encoding='utf-8') as f:
+        json.dump({"default_delay": 1 / args.rate, "max_send_rate": args.rate}, f)
+
+    loop = VirtualTimeLoop() if args.fake_clock else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    bot = main.TelegramSender()
+    bot.limiter.clock = loop.time
+    bot.client = FakeTelegramClient(size, latency=args.latency, error_rate=args.error_rate,
+                                    flood_every=args.flood_every, flood_seconds=args.flood_seconds)
+    bot.me = loop.run_until_complete(bot.client.get_me())
+
+    with instrument(bot) as (store_timer, journal_timer, delivery_timer):
+        start = time.perf_counter()
+        loop.run_until_complete(bot.get_chats())
+        sync_seconds = time.perf_counter() - start
+        store_sync = store_timer.seconds
+
+        media = None
+        if args.media_bytes:
+            media = "media.bin"
+            with open(media, 'wb') as f:
+                f.write(os.urandom(args.media_bytes))
+        campaign = main.Campaign(bot.registry.ids(), args.text, delay=1 / args.rate,
+                                 cycles=args.cycles, cycle_delay=0, media=media)
+        start, loop_start = time.perf_counter(), loop.time()
+        loop.run_until_complete(bot.mass_send(campaign))
+        wall = time.perf_counter() - start
+        loop_elapsed = loop.time() - loop_start
+        store_send = store_timer.seconds - store_sync
+        journal_seconds = journal_timer.seconds
+        delivery_seconds = delivery_timer.seconds
+
+    traced_peak = None
+    if args.tracemalloc:
+        traced_peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    sent, errors, _ = campaign.progress()
+    attempts = sent + errors
+    # Накладные расходы: реальное время без ожиданий в сети (при виртуальном
+    # времени цикла ожидания не занимают реального времени вовсе)
+    network = 0.0 if args.fake_clock else bot.client.requests * _mean_latency(args.latency)
+    result = {
+        "chats": size,
+        "sent": sent,
+        "errors": errors,
+        "flood_waits": bot.stats.get("flood_waits", 0),
+        "sync_seconds": round(sync_seconds, 3),
+        "send_seconds": round(wall, 3),
+        "loop_seconds": round(loop_elapsed, 3),
+        "msgs_per_sec": round(sent / wall, 1) if wall > 0 else None,
+        "loop_msgs_per_sec": round(sent / loop_elapsed, 2) if loop_elapsed > 0 else None,
+        "overhead_us": round(max(wall - network, 0) / attempts * 1e6, 1) if attempts else None,
+        "db_ms": round(store_send * 1000, 1),
+        "db_sync_ms": round(store_sync * 1000, 1),
+        "journal_ms": round(journal_seconds * 1000, 1),
+        "delivery_ms": round(delivery_seconds * 1000, 1),
+        "persist_us_per_send": round((store_send + journal_seconds + delivery_seconds) / attempts * 1e6, 1)
+                               if attempts else None,
+        "uploaded_mb": round(bot.client.uploaded_bytes / 2 ** 20, 2),
+        "traced_peak_mb": round(traced_peak, 1) if traced_peak is not None else None,
+        "max_rss_mb": round(max_rss_mb(), 1)
+    }
+
+    bot.stats_writer.flush()
+    bot.store.close()
+    loop.close()
+    asyncio.set_event_loop(None)
+    return result
+
+def _mean_latency(latency):
+    if isinstance(latency, (tuple, list)):
+        return sum(latency) / 2
+    return latency
+
+COLUMNS = [
+    ("chats", "Чатов"),
+    ("sent", "Отпр."),
+    ("errors", "Ошиб."),
+    ("sync_seconds", "Синхр,с"),
+    ("msgs_per_sec", "Сообщ/с"),
+    ("loop_msgs_per_sec", "Сообщ/с цикла"),
+    ("overhead_us", "Накл,мкс"),
+    ("persist_us_per_send", "Запись,мкс"),
+    ("db_ms", "База,мс"),
+    ("journal_ms", "Журнал,мс"),
+    ("delivery_ms", "Доставка,мс"),
+    ("uploaded_mb", "Загружено,МБ"),
+    ("traced_peak_mb", "Пик,МБ"),
+    ("max_rss_mb", "RSS,МБ")
+]
+
+def print_table(results):
+    widths = [max(len(title), *(len(str(r[key])) for r in results)) for key, title in COLUMNS]
+    print("  ".join(title.rjust(w) for (_, title), w in zip(COLUMNS, widths)))
+    for r in results:
+        print("  ".join(str(r[key]).rjust(w) for (key, _), w in zip(COLUMNS, widths)))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк рассылки на фейковом клиенте Telegram")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="число синтетических чатов для прогонов")
+    parser.add_argument("--cycles", type=int, default=1, help="циклов рассылки")
+    parser.add_argument("--rate", type=float, default=1e6,
+                        help="скорость отправки, сообщ/сек (по умолчанию без ограничения)")
+    parser.add_argument("--latency", type=float, nargs="+", default=[0.0],
+                        help="задержка запроса, сек (одно число или min max)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ошибок RPC")
+    parser.add_argument("--flood-every", type=int, default=0, help="FloodWait каждые N отправок")
+    parser.add_argument("--flood-seconds", type=int, default=5, help="длительность FloodWait")
+    parser.add_argument("--text", default="Benchmark message", help="текст сообщения")
+    parser.add_argument("--media-bytes", type=int, default=0,
+                        help="рассылка с файлом такого размера (0 - только текст)")
+    parser.add_argument("--fake-clock", action="store_true",
+                        help="виртуальное время: паузы и задержки не ждут по-настоящему")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="замерять пик памяти через tracemalloc (медленнее)")
+    parser.add_argument("--with-logging", action="store_true",
+                        help="не отключать логи (их стоимость войдет в замер)")
+    parser.add_argument("--workdir", default=None, help="каталог для временных данных")
+    parser.add_argument("--keep", action="store_true", help="не удалять временные данные")
+    parser.add_argument("--json", action="store_true", help="вывести результаты в JSON")
+    args = parser.parse_args(argv)
+    args.latency = args.latency[0] if len(args.latency) == 1 else tuple(args.latency[:2])
+    return args
+
+def run_benchmarks(args):
+    global main
+    cwd = os.getcwd()
+    bootstrap = tempfile.mkdtemp(prefix="bench-", dir=args.workdir)
+    os.chdir(bootstrap)
+    os.makedirs("logs", exist_ok=True)
+    try:
+        import main as main_module
+        main = main_module
+        if args.with_logging:
+            main.setup_logging()
+        else:
+            logging.disable(logging.WARNING)
+        return [run_size(size, args) for size in args.sizes]
+    finally:
+        if main is not None:
+            main.stop_logging()
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(bootstrap, ignore_errors=True)
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmarks(args)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_table(results)
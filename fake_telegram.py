@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальная замена TelegramClient для замеров и отладки без аккаунта.
+
+Реализует то подмножество API Telethon, которым пользуется main.py:
+send_message (в том числе с file=), upload_file, get_dialogs/iter_dialogs,
+get_me, get_input_entity, get_entity, add_event_handler, connect/disconnect. Задержка сети,
+случайные ошибки и FloodWait настраиваются в конструкторе.
+
+VirtualTimeLoop - цикл asyncio с виртуальным временем: когда делать
+нечего, время перескакивает к ближайшему таймеру, поэтому asyncio.sleep
+не ждет по-настоящему.
+"""
+
+import asyncio
+import os
+import random
+import selectors
+from types import SimpleNamespace
+
+from telethon import utils
+from telethon.errors import FloodWaitError, RPCError
+from telethon.tl import types
+
+# Доли типов синтетических чатов
+USER_SHARE = 0.6
+GROUP_SHARE = 0.1
+
+def make_entities(count, seed=0):
+    """Синтетические сущности: пользователи, группы и мегагруппы"""
+    rnd = random.Random(seed)
+    entities = []
+    for i in range(1, count + 1):
+        roll = rnd.random()
+        if roll < USER_SHARE:
+            entity = types.User(id=i, access_hash=rnd.getrandbits(63), username=f"user{i}",
+                                first_name=f"User {i}")
+        elif roll < USER_SHARE + GROUP_SHARE:
+            entity = types.Chat(id=i, title=f"Group {i}", photo=types.ChatPhotoEmpty(),
+                                participants_count=10, date=None, version=1)
+        else:
+            entity = types.Channel(id=1_000_000 + i, title=f"Supergroup {i}",
+                                   photo=types.ChatPhotoEmpty(), date=None,
+                                   access_hash=rnd.getrandbits(63), megagroup=True,
+                                   username=f"group{i}")
+        entities.append(entity)
+    return entities
+
+def make_dialog(entity, top_message, pinned=False):
+    """Объект с полями telethon.tl.custom.Dialog, которые читает main.py"""
+    is_user = isinstance(entity, types.User)
+    is_channel = isinstance(entity, types.Channel)
+    return SimpleNamespace(
+        id=utils.get_peer_id(entity),
+        entity=entity,
+        name=getattr(entity, 'title', None) or getattr(entity, 'first_name', ''),
+        is_user=is_user,
+        is_channel=is_channel,
+        is_group=isinstance(entity, types.Chat) or (is_channel and entity.megagroup),
+        pinned=pinned,
+        dialog=SimpleNamespace(top_message=top_message)
+    )
+
+class FakeTelegramClient:
+    """Подмена TelegramClient.
+
+    latency - задержка одного запроса в секундах (число или пара min/max),
+    error_rate - доля отправок, завершающихся ошибкой RPC,
+    flood_every / flood_seconds - каждая N-я отправка получает FloodWait,
+    chat_errors - {chat_id: исключение} для постоянных ошибок отдельных чатов.
+    """
+
+    def __init__(self, chats=1000, latency=0.0, error_rate=0.0, flood_every=0,
+                 flood_seconds=5, chat_errors=None, seed=0):
+        self.entities = make_entities(chats, seed) if isinstance(chats, int) else list(chats)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.chat_errors = chat_errors or {}
+        self.sent = []
+        self.requests = 0
+        self.uploaded_bytes = 0
+        self.handlers = []
+        self.me = types.User(id=10 ** 9, access_hash=1, first_name="Benchmark",
+                             username="benchmark", is_self=True)
+        self._random = random.Random(seed)
+        self._by_id = {utils.get_peer_id(e): e for e in self.entities}
+        self._by_username = {e.username.lower(): e for e in self.entities if getattr(e, 'username', None)}
+        self._message_id = 0
+        self._send_count = 0
+        self._connected = False
+
+    # --- служебное ---
+    async def _network(self):
+        self.requests += 1
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            latency = self._random.uniform(*latency)
+        if latency:
+            await asyncio.sleep(latency)
+
+    async def connect(self):
+        self._connected = True
+
+    async def start(self, *args, **kwargs):
+        self._connected = True
+        return self
+
+    async def disconnect(self):
+        self._connected = False
+
+    def is_connected(self):
+        return self._connected
+
+    async def is_user_authorized(self):
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    # --- аккаунт и диалоги ---
+    async def get_me(self, input_peer=False):
+        await self._network()
+        return utils.get_input_peer(self.me) if input_peer else self.me
+
+    async def iter_dialogs(self, limit=None, **kwargs):
+        await self._network()
+        count = len(self.entities) if limit is None else min(limit, len(self.entities))
+        for i in range(count):
+            yield make_dialog(self.entities[i], top_message=count - i)
+
+    async def get_dialogs(self, limit=None, **kwargs):
+        return [dialog async for dialog in self.iter_dialogs(limit)]
+
+    def _find(self, target):
+        if isinstance(target, types.TLObject):
+            try:
+                return self._by_id.get(utils.get_peer_id(target))
+            except Exception:
+                return None
+        if isinstance(target, int):
+            return self._by_id.get(target)
+        key = str(target).strip().lower()
+        for prefix in ("https://", "http://", "t.me/", "@"):
+            if key.startswith(prefix):
+                key = key[len(prefix):]
+        return self._by_username.get(key)
+
+    async def get_entity(self, target):
+        await self._network()
+        entity = self._find(target)
+        if entity is None:
+            raise ValueError(f"Cannot find any entity corresponding to \"{target}\"")
+        return entity
+
+    async def get_input_entity(self, target):
+        return utils.get_input_peer(await self.get_entity(target))
+
+    # --- отправка ---
+    async def upload_file(self, file, **kwargs):
+        await self._network()
+        size = os.path.getsize(file)
+        self.uploaded_bytes += size
+        return types.InputFile(id=self._random.getrandbits(63), parts=max(1, size // (512 * 1024)),
+                               name=os.path.basename(file), md5_checksum="")
+
+    async def send_message(self, entity, message="", file=None, **kwargs):
+        await self._network()
+        peer_id = utils.get_peer_id(entity) if isinstance(entity, types.TLObject) else entity
+        self._send_count += 1
+        if self.flood_every and self._send_count % self.flood_every == 0:
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        if peer_id in self.chat_errors:
+            raise self.chat_errors[peer_id]
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise RPCError(request=None, message="INTERNAL_SERVER_ERROR", code=500)
+        if isinstance(file, str):
+            # Путь к файлу: как и Telethon, загружаем его заново
+            file = await self.upload_file(file)
+        self._message_id += 1
+        self.sent.append((peer_id, message))
+        media = None
+        if file is not None:
+            media = file if isinstance(file, SimpleNamespace) else SimpleNamespace(source=file)
+        return SimpleNamespace(id=self._message_id, peer_id=peer_id, message=message, media=media)
+
+class _VirtualTimeSelector(selectors.DefaultSelector):
+    """Селектор, который вместо ожидания таймера сдвигает виртуальное время"""
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            return super().select(None)
+        self.loop.advance(timeout)
+        return []
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Цикл asyncio, в котором sleep и таймауты не занимают реального времени"""
+
+    def __init__(self):
+        selector = _VirtualTimeSelector()
+        super().__init__(selector)
+        selector.loop = self
+        self._virtual_time = 0.0
+
+    def time(self):
+        return self._virtual_time
+
+    def advance(self, seconds):
+        self._virtual_time += seconds
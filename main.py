@@ -6,29 +6,195 @@ TELEGRAM МАССОВЫЙ ОТПРАВИТЕЛЬ v4.0
 Автор: west_hub
 """
 
+import time
+# Точка отсчета для --profile-startup: время импорта модулей входит в замер
+IMPORT_STARTED = time.perf_counter()
+
+import argparse
 import asyncio
+import atexit
+import concurrent.futures
+import copy
+import gzip
+import heapq
 import json
+import math
 import os
+import shutil
+import signal
 import sys
-import time
+import threading
 import random
-from datetime import datetime
-from telethon import TelegramClient, events
-from telethon.errors import SessionPasswordNeededError
-from telethon.tl.types import InputPeerUser, InputPeerChannel, InputPeerChat
+import re
+import sqlite3
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from itertools import count as _sequence, islice
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 import logging
+import logging.handlers
+import queue
+
+# ========== ЛЕНИВЫЙ ИМПОРТ TELETHON ==========
+# Импорт Telethon - самая дорогая часть запуска, а меню он не нужен.
+# Модули подгружаются при первом обращении к сети или к разметке
+# (load_telethon), обычно - в фоновом подключении, пока меню уже на экране.
+TelegramClient = events = helpers = utils = errors = markdown = types = None
+SessionPasswordNeededError = FloodWaitError = None
+InputPeerUser = InputPeerChannel = InputPeerChat = PeerChat = PeerUser = None
+_telethon_lock = threading.Lock()
+
+def load_telethon():
+    """Импортировать Telethon (один раз, потокобезопасно)"""
+    global TelegramClient, events, helpers, utils, errors, markdown, types
+    global SessionPasswordNeededError, FloodWaitError
+    global InputPeerUser, InputPeerChannel, InputPeerChat, PeerChat, PeerUser
+    if TelegramClient is not None:
+        return
+    with _telethon_lock:
+        if TelegramClient is not None:
+            return
+        import telethon
+        from telethon import errors as telethon_errors
+        from telethon.extensions import markdown as telethon_markdown
+        from telethon.tl import types as telethon_types
+        
+        events, helpers, utils = telethon.events, telethon.helpers, telethon.utils
+        errors, markdown, types = telethon_errors, telethon_markdown, telethon_types
+        SessionPasswordNeededError = errors.SessionPasswordNeededError
+        FloodWaitError = errors.FloodWaitError
+        InputPeerUser, InputPeerChannel = types.InputPeerUser, types.InputPeerChannel
+        InputPeerChat, PeerChat, PeerUser = types.InputPeerChat, types.PeerChat, types.PeerUser
+        _load_error_classes()
+        # Последним: по нему остальные потоки понимают, что все готово
+        TelegramClient = telethon.TelegramClient
 
 # ========== НАСТРОЙКА ЛОГИРОВАНИЯ ==========
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+LOGS_DIR = "logs"
+LOG_FILE = os.path.join(LOGS_DIR, "bot.log")
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Ротация лога: по размеру или раз в LOG_ROTATE_HOURS, старые части сжимаются gzip
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_ROTATE_HOURS = 24
+
 logger = logging.getLogger(__name__)
 
+class JsonLinesFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация по размеру и по времени; закрытые части сжимаются в .gz"""
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS,
+                 rotate_hours=LOG_ROTATE_HOURS):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        self.interval = rotate_hours * 3600
+        # Отсчет идет от начала текущего файла, а не от запуска процесса:
+        # иначе при частых перезапусках лог не ротируется никогда
+        self.rollover_at = self._file_started() + self.interval if self.interval else None
+
+    def _file_started(self):
+        """Когда начат текущий файл лога (для нового или пустого - сейчас)"""
+        try:
+            stat = os.stat(self.baseFilename)
+        except OSError:
+            return time.time()
+        if not stat.st_size:
+            return time.time()
+        started = getattr(stat, "st_birthtime", None)
+        if started is None:
+            # Предыдущая часть пишется в момент ротации - ее mtime и есть начало
+            # текущего файла; без нее остается mtime самого лога
+            try:
+                started = os.stat(self.rotation_filename(f"{self.baseFilename}.1")).st_mtime
+            except OSError:
+                started = stat.st_mtime
+        return started
+
+    def namer(self, name):
+        return name + ".gz"
+
+    def rotator(self, source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+_log_listener = None
+
+def stop_logging():
+    """Дописать оставшиеся в очереди записи и остановить поток логов"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+def setup_logging(config=None):
+    """Логи через очередь: код только кладет запись в очередь, а файл и
+    консоль пишет отдельный поток QueueListener.
+
+    В файл идет INFO и выше (текст или JSON lines при log_format = "json"),
+    в консоль - только log_console_level (по умолчанию WARNING), чтобы
+    отчеты об отправке не перебивали меню.
+    """
+    global _log_listener
+    config = config or {}
+    if _log_listener is not None:
+        stop_logging()
+    else:
+        atexit.register(stop_logging)
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    
+    file_handler = CompressingRotatingFileHandler(
+        LOG_FILE,
+        config.get("log_max_bytes", LOG_MAX_BYTES),
+        config.get("log_backups", LOG_BACKUPS),
+        config.get("log_rotate_hours", LOG_ROTATE_HOURS)
+    )
+    file_handler.setLevel(logging.INFO)
+    if config.get("log_format") == "json":
+        file_handler.setFormatter(JsonLinesFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(config.get("log_console_level", "WARNING"))
+    console_handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler,
+                                                   respect_handler_level=True)
+    _log_listener.start()
+    return _log_listener
+
 # ========== КОНСТАНТЫ ==========
 VERSION = "4.0"
 CONFIG_FILE = "config.json"
@@ -39,20 +205,92 @@ FOLDERS_FILE = os.path.join(DATA_DIR, "folders.json")
 TEMPLATES_FILE = os.path.join(DATA_DIR, "templates.json")
 STATS_FILE = os.path.join(DATA_DIR, "stats.json")
 BLACKLIST_FILE = os.path.join(DATA_DIR, "blacklist.json")
+DB_FILE = os.path.join(DATA_DIR, "sender.db")
+SESSION_NAME = "telegram_sender"
+CAMPAIGNS_DIR = os.path.join(DATA_DIR, "campaigns")
+DELIVERY_DIR = os.path.join(DATA_DIR, "delivery")
 
-# Глобальные переменные для рассылки
-sending_active = False
-sent_count = 0
-error_count = 0
-start_time = None
-current_task = None
+# Отложенная запись статистики: не чаще раза в STATS_FLUSH_INTERVAL секунд
+# или после STATS_FLUSH_EVERY изменений
+STATS_FLUSH_INTERVAL = 5.0
+STATS_FLUSH_EVERY = 50
+
+# Адаптивная скорость отправки: повторный FloodWait в пределах FLOOD_WINDOW
+# секунд снижает скорость в FLOOD_BACKOFF раз, каждые RECOVERY_AFTER успешных
+# отправок скорость растет на RECOVERY_STEP от максимальной
+FLOOD_WINDOW = 600
+FLOOD_BACKOFF = 0.5
+RECOVERY_AFTER = 20
+RECOVERY_STEP = 0.1
+MIN_SEND_RATE = 1 / 60
+MAX_FLOOD_WAITS = 5
+
+# Повтор временных ошибок: пауза RETRY_BACKOFF_BASE * 2^(n-1) секунд, не
+# больше RETRY_BACKOFF_MAX, со случайным разбросом от половины до полной
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 30.0
+
+# Карантин чатов: после QUARANTINE_AFTER неудачных отправок подряд чат
+# исключается из рассылок на QUARANTINE_COOLDOWN секунд, после постоянной
+# ошибки (нет прав, блокировка, чат удален) - до ручного снятия
+QUARANTINE_AFTER = 3
+QUARANTINE_COOLDOWN = 6 * 3600
+
+# Ограничения Telegram на длину (в UTF-16 символах): текст сообщения и подпись к файлу
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+# Скомпилированных шаблонов в кэше
+TEMPLATE_CACHE_SIZE = 256
+
+# Инкрементальная синхронизация не видит покинутые и удаленные диалоги:
+# раз в столько секунд вместо нее идет полная, которая их убирает
+CHATS_FULL_SYNC_INTERVAL = 24 * 3600
+
+# Размер LRU кэша разрешенных username/ссылок
+PEER_CACHE_SIZE = 1000
+
+# Поиск адресатов на сервере: параллельных запросов, запросов в секунду
+# и самый долгий FloodWait, который стоит переждать
+RESOLVE_CONCURRENCY = 4
+RESOLVE_RATE = 2.0
+RESOLVE_MAX_FLOOD = 300
+
+# Журнал курсора рассылки сжимается до одной строки после стольких записей
+JOURNAL_COMPACT_EVERY = 10000
+
+# Расписание: запуск, пропущенный за время простоя, выполняется один раз,
+# если опоздание не больше SCHEDULE_MISFIRE_GRACE секунд. Если прошлый
+# запуск того же расписания еще идет, новый откладывается на SCHEDULE_BUSY_RETRY секунд
+SCHEDULE_MISFIRE_GRACE = 6 * 3600
+SCHEDULE_BUSY_RETRY = 60
+# Монотонные часы цикла стоят, пока устройство спит, поэтому долгий сон
+# планировщика делится на отрезки не длиннее SCHEDULE_MAX_SLEEP секунд
+SCHEDULE_MAX_SLEEP = 300
+
+# Журнал доставки: новый сегмент после DELIVERY_SEGMENT_BYTES байт,
+# индекс в базе обновляется пачками по DELIVERY_INDEX_EVERY записей,
+# хранятся последние DELIVERY_KEEP_SEGMENTS сегментов (старые удаляются с индексом)
+DELIVERY_SEGMENT_BYTES = 16 * 1024 * 1024
+DELIVERY_INDEX_EVERY = 200
+DELIVERY_KEEP_SEGMENTS = 8
+
+# Метрики отправки: локальный HTTP порт (0 - выключено) и границы
+# гистограмм задержек в секундах
+METRICS_PORT = 9464
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
 # ========== УТИЛИТЫ ==========
 def clear_screen():
-    """Очистка экрана"""
-    os.system('clear' if os.name == 'posix' else 'cls')
+    """Очистка экрана (на posix - escape-последовательностью, без запуска clear)"""
+    if os.name == 'posix':
+        sys.stdout.write("\033[H\033[2J")
+        sys.stdout.flush()
+    else:
+        os.system('cls')
 
-def print_header(title="ТЕЛЕГРАМ БОТ v4.0"):
+def print_header(title="ТЕЛЕГРАМ БОТ v4.0", bot=None):
     """Красивый заголовок"""
     clear_screen()
     border = "═" * 40
@@ -60,14 +298,22 @@ def print_header(title="ТЕЛЕГРАМ БОТ v4.0"):
     print(f"║{title.center(40)}║")
     print(f"╚{border}╝")
     
-    # Статус рассылки
-    if sending_active:
-        elapsed = time.time() - start_time
+    # Статус рассылок
+    active = bot.campaigns.active() if bot else []
+    if len(active) == 1:
+        sent, errors, elapsed = active[0].progress()
         hours, remainder = divmod(elapsed, 3600)
         minutes, seconds = divmod(remainder, 60)
         time_str = f"{int(hours):02d}:{int(minutes):02d}:{int(seconds):02d}"
-        print(f"\n🔥 Рассылка активна: {sent_count} отправлено, {error_count} ошибок")
+        paused = " (пауза)" if active[0].paused else ""
+        print(f"\n🔥 Рассылка активна{paused}: {sent} отправлено, {errors} ошибок")
+        print(f"🚦 Скорость: {bot.limiter.achieved_rate():.2f} из {bot.limiter.rate:.2f} сообщ/сек")
         print(f"⏰ Время работы: {time_str}\n")
+    elif active:
+        sent = sum(campaign.progress()[0] for campaign in active)
+        errors = sum(campaign.progress()[1] for campaign in active)
+        print(f"\n🔥 Активных рассылок: {len(active)}, всего {sent} отправлено, {errors} ошибок")
+        print(f"🚦 Скорость: {bot.limiter.achieved_rate():.2f} из {bot.limiter.rate:.2f} сообщ/сек\n")
     else:
         print("\n📱 Готов к работе\n")
 
@@ -94,10 +340,74 @@ def save_json(filepath, data):
         logger.error(f"Ошибка сохранения {filepath}: {e}")
         return False
 
-def create_default_files():
-    """Создание всех необходимых файлов"""
+def normalize_chat_id(value):
+    """Привести ID чата к единому виду (int). None - если это не ID"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+class StatsWriter:
+    """Отложенная запись статистики.
+
+    Изменения применяются к словарю в памяти и сбрасываются на диск пачкой:
+    по таймеру (flush_interval) или после flush_every изменений.
+    """
+
+    def __init__(self, data, save_func, flush_interval=STATS_FLUSH_INTERVAL, flush_every=STATS_FLUSH_EVERY):
+        self.data = data
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self._save = save_func
+        self._pending = 0
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def incr(self, key, amount=1):
+        """Увеличить счетчик"""
+        with self._lock:
+            self.data[key] = self.data.get(key, 0) + amount
+            self._mark_dirty()
+
+    def set(self, key, value):
+        """Установить значение"""
+        with self._lock:
+            self.data[key] = value
+            self._mark_dirty()
+
+    def _mark_dirty(self):
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Сбросить накопленные изменения на диск"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return True
+            if self._save(dict(self.data)):
+                self._pending = 0
+                return True
+            return False
+
+def create_default_files(store):
+    """Создание всех необходимых файлов и перенос data/*.json в базу"""
     os.makedirs(DATA_DIR, exist_ok=True)
-    os.makedirs("logs", exist_ok=True)
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    
+    if store.get_meta("json_migrated"):
+        return
     
     defaults = {
         CHATS_FILE: [],
@@ -112,45 +422,2646 @@ def create_default_files():
         BLACKLIST_FILE: []
     }
     
+    # Старые JSON файлы переносятся один раз, дальше работаем только с базой
+    data = {}
     for filepath, default_data in defaults.items():
-        if not os.path.exists(filepath):
-            save_json(filepath, default_data)
+        data[filepath] = load_json(filepath, default_data) if os.path.exists(filepath) else default_data
+    
+    store.import_legacy(
+        chats=data[CHATS_FILE],
+        favorites=data[FAVORITES_FILE],
+        folders=data[FOLDERS_FILE],
+        templates=data[TEMPLATES_FILE],
+        stats=data[STATS_FILE],
+        blacklist=data[BLACKLIST_FILE]
+    )
+    
+    for filepath in defaults:
+        if os.path.exists(filepath):
+            os.replace(filepath, f"{filepath}.bak")
+    
+    store.set_meta("json_migrated", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    logger.info("Данные перенесены в базу")
+
+# ========== ХРАНИЛИЩЕ ==========
+class DataStore:
+    """Единое хранилище данных бота (SQLite в режиме WAL).
+
+    Каждое изменение - отдельная небольшая транзакция, без перезаписи
+    всего набора данных. Чаты проиндексированы по id, типу и username,
+    членство в папках - по папке и по чату.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL DEFAULT '',
+            username TEXT NOT NULL DEFAULT '',
+            type TEXT NOT NULL DEFAULT 'user',
+            position INTEGER NOT NULL DEFAULT 0,
+            access_hash INTEGER,
+            top_message INTEGER NOT NULL DEFAULT 0,
+            writable INTEGER NOT NULL DEFAULT 1,
+            name TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS idx_chats_type ON chats(type);
+        CREATE INDEX IF NOT EXISTS idx_chats_username ON chats(username);
+        CREATE TABLE IF NOT EXISTS favorites (
+            chat_id INTEGER NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS folders (
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS folder_chats (
+            folder TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            UNIQUE (folder, chat_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_folder_chats_chat ON folder_chats(chat_id);
+        CREATE TABLE IF NOT EXISTS templates (
+            name TEXT PRIMARY KEY,
+            text TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS stats (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS blacklist (
+            chat_id INTEGER NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id TEXT PRIMARY KEY,
+            spec TEXT NOT NULL,
+            status TEXT NOT NULL,
+            updated TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_campaigns_status ON campaigns(status);
+        CREATE TABLE IF NOT EXISTS schedules (
+            id TEXT PRIMARY KEY,
+            spec TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            rule TEXT NOT NULL,
+            next_run REAL,
+            last_run REAL,
+            anchor REAL
+        );
+        CREATE TABLE IF NOT EXISTS quarantine (
+            chat_id INTEGER PRIMARY KEY,
+            failures INTEGER NOT NULL DEFAULT 0,
+            reason TEXT NOT NULL DEFAULT '',
+            opened INTEGER NOT NULL DEFAULT 0,
+            until REAL
+        );
+        CREATE TABLE IF NOT EXISTS deliveries (
+            campaign TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            outcome TEXT NOT NULL,
+            error TEXT NOT NULL DEFAULT '',
+            ts REAL NOT NULL,
+            segment INTEGER NOT NULL,
+            seg_offset INTEGER NOT NULL,
+            PRIMARY KEY (campaign, chat_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_deliveries_chat ON deliveries(chat_id);
+        CREATE TABLE IF NOT EXISTS last_delivered (
+            chat_id INTEGER PRIMARY KEY,
+            campaign TEXT NOT NULL,
+            message_id INTEGER,
+            ts REAL NOT NULL,
+            segment INTEGER NOT NULL,
+            seg_offset INTEGER NOT NULL
+        );
+    """
+
+    # Колонки, появившиеся после первой версии схемы (для старых баз)
+    ADDED_COLUMNS = {
+        "chats": {
+            "access_hash": "INTEGER",
+            "top_message": "INTEGER NOT NULL DEFAULT 0",
+            "writable": "INTEGER NOT NULL DEFAULT 1",
+            "name": "TEXT NOT NULL DEFAULT ''",
+        },
+        "schedules": {
+            "anchor": "REAL",
+        },
+    }
+
+    def __init__(self, path=DB_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._add_missing_columns()
+
+    def _add_missing_columns(self):
+        for table, columns in self.ADDED_COLUMNS.items():
+            existing = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            for name, decl in columns.items():
+                if name not in existing:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _transaction(self, statements):
+        """Выполнить несколько запросов одной транзакцией"""
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN")
+                for sql, params in statements:
+                    if isinstance(params, list):
+                        self._conn.executemany(sql, params)
+                    else:
+                        self._conn.execute(sql, params or ())
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- служебные значения ---
+    def get_meta(self, key, default=None):
+        rows = self._execute("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else default
+
+    def set_meta(self, key, value):
+        self._execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+
+    # --- чаты ---
+    @staticmethod
+    def _chat_row(chat, position):
+        return (chat["id"], chat.get("title") or "", chat.get("username") or "",
+                chat.get("type") or "user", position, chat.get("access_hash"),
+                chat.get("top_message") or 0, int(chat.get("writable", True)), chat.get("name") or "")
+
+    @staticmethod
+    def _chat_dict(row):
+        return {"id": row[0], "title": row[1], "username": row[2], "type": row[3],
+                "access_hash": row[4], "top_message": row[5], "writable": bool(row[6]), "name": row[7]}
+
+    _CHAT_COLUMNS = "id, title, username, type, access_hash, top_message, writable, name"
+
+    def load_chats(self):
+        rows = self._execute(f"SELECT {self._CHAT_COLUMNS} FROM chats ORDER BY position")
+        return [self._chat_dict(r) for r in rows]
+
+    def get_chat(self, chat_id):
+        rows = self._execute(f"SELECT {self._CHAT_COLUMNS} FROM chats WHERE id = ?", (chat_id,))
+        return self._chat_dict(rows[0]) if rows else None
+
+    def chat_ids_by_type(self, chat_type):
+        return [r[0] for r in self._execute("SELECT id FROM chats WHERE type = ? ORDER BY position", (chat_type,))]
+
+    def replace_chats(self, chats):
+        """Заменить список чатов: обновить изменившиеся, удалить пропавшие"""
+        new_ids = {chat["id"] for chat in chats}
+        old_ids = {r[0] for r in self._execute("SELECT id FROM chats")}
+        self._transaction([
+            ("DELETE FROM chats WHERE id = ?", [(cid,) for cid in old_ids - new_ids]),
+            (self._UPSERT_CHAT, [self._chat_row(chat, i) for i, chat in enumerate(chats)]),
+        ])
+
+    def prepend_chats(self, chats):
+        """Добавить или обновить чаты, поставив их в начало списка.
+
+        Меняются только строки этих чатов: позиции уходят ниже текущего минимума.
+        """
+        start = self._execute("SELECT COALESCE(MIN(position), 0) FROM chats")[0][0] - len(chats)
+        self._transaction([
+            (self._UPSERT_CHAT, [self._chat_row(chat, start + i) for i, chat in enumerate(chats)]),
+        ])
+
+    def upsert_chats(self, chats):
+        """Добавить или обновить чаты (в конец списка)"""
+        start = self._execute("SELECT COALESCE(MAX(position) + 1, 0) FROM chats")[0][0]
+        self._transaction([
+            (self._UPSERT_CHAT, [self._chat_row(chat, start + i) for i, chat in enumerate(chats)]),
+        ])
+
+    _UPSERT_CHAT = (
+        "INSERT INTO chats (id, title, username, type, position, access_hash, top_message, writable, name) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET title = excluded.title, username = excluded.username, "
+        "type = excluded.type, position = excluded.position, "
+        "access_hash = COALESCE(excluded.access_hash, chats.access_hash), "
+        "top_message = excluded.top_message, writable = excluded.writable, name = excluded.name"
+    )
+
+    # Поля чата, которые можно менять точечно через update_chat
+    _UPDATABLE_CHAT_FIELDS = ("title", "name", "username", "access_hash", "writable")
+
+    def update_chat(self, chat_id, fields):
+        """Изменить отдельные поля одного чата"""
+        columns = [name for name in fields if name in self._UPDATABLE_CHAT_FIELDS]
+        if not columns:
+            return
+        assignments = ", ".join(f"{name} = ?" for name in columns)
+        values = [int(fields[name]) if name == "writable" else fields[name] for name in columns]
+        self._execute(f"UPDATE chats SET {assignments} WHERE id = ?", (*values, chat_id))
+
+    # --- избранное и черный список ---
+    def load_favorites(self):
+        return [r[0] for r in self._execute("SELECT chat_id FROM favorites ORDER BY rowid")]
+
+    def add_favorite(self, chat_id):
+        self._execute("INSERT OR IGNORE INTO favorites (chat_id) VALUES (?)", (chat_id,))
+
+    def remove_favorite(self, chat_id):
+        self._execute("DELETE FROM favorites WHERE chat_id = ?", (chat_id,))
+
+    def load_blacklist(self):
+        return [r[0] for r in self._execute("SELECT chat_id FROM blacklist ORDER BY rowid")]
+
+    def add_to_blacklist(self, chat_id):
+        self._execute("INSERT OR IGNORE INTO blacklist (chat_id) VALUES (?)", (chat_id,))
+
+    def remove_from_blacklist(self, chat_id):
+        self._execute("DELETE FROM blacklist WHERE chat_id = ?", (chat_id,))
+
+    # --- папки ---
+    def load_folders(self):
+        folders = {r[0]: [] for r in self._execute("SELECT name FROM folders ORDER BY rowid")}
+        for folder, chat_id in self._execute("SELECT folder, chat_id FROM folder_chats ORDER BY rowid"):
+            folders.setdefault(folder, []).append(chat_id)
+        return folders
+
+    def create_folder(self, name):
+        self._execute("INSERT OR IGNORE INTO folders (name) VALUES (?)", (name,))
+
+    def delete_folder(self, name):
+        self._transaction([
+            ("DELETE FROM folder_chats WHERE folder = ?", (name,)),
+            ("DELETE FROM folders WHERE name = ?", (name,)),
+        ])
+
+    def add_to_folder(self, name, chat_id):
+        self._execute("INSERT OR IGNORE INTO folder_chats (folder, chat_id) VALUES (?, ?)", (name, chat_id))
+
+    def folders_of_chat(self, chat_id):
+        return [r[0] for r in self._execute("SELECT folder FROM folder_chats WHERE chat_id = ?", (chat_id,))]
+
+    # --- шаблоны ---
+    def load_templates(self):
+        return dict(self._execute("SELECT name, text FROM templates ORDER BY rowid"))
+
+    def save_template(self, name, text):
+        self._execute(
+            "INSERT INTO templates (name, text) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET text = excluded.text",
+            (name, text)
+        )
+
+    def delete_template(self, name):
+        self._execute("DELETE FROM templates WHERE name = ?", (name,))
+
+    # --- статистика ---
+    def load_stats(self):
+        return {key: json.loads(value) for key, value in self._execute("SELECT key, value FROM stats")}
+
+    def save_stats(self, stats):
+        """Сохранить статистику одной транзакцией"""
+        try:
+            self._transaction([(
+                "INSERT INTO stats (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                [(key, json.dumps(value, ensure_ascii=False)) for key, value in stats.items()]
+            )])
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения статистики: {e}")
+            return False
+
+    # --- рассылки ---
+    def save_campaign(self, campaign_id, spec, status):
+        self._execute(
+            "INSERT INTO campaigns (id, spec, status, updated) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET spec = excluded.spec, status = excluded.status, "
+            "updated = excluded.updated",
+            (campaign_id, json.dumps(spec, ensure_ascii=False), status,
+             datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+
+    def set_campaign_status(self, campaign_id, status):
+        self._execute(
+            "UPDATE campaigns SET status = ?, updated = ? WHERE id = ?",
+            (status, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), campaign_id)
+        )
+
+    def load_campaign(self, campaign_id):
+        rows = self._execute("SELECT spec FROM campaigns WHERE id = ?", (campaign_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def campaign_status(self, campaign_id):
+        rows = self._execute("SELECT status FROM campaigns WHERE id = ?", (campaign_id,))
+        return rows[0][0] if rows else None
+
+    def recent_campaigns(self, limit=10):
+        """[(id, status, updated)] последних рассылок"""
+        return self._execute(
+            "SELECT id, status, updated FROM campaigns ORDER BY updated DESC LIMIT ?", (limit,)
+        )
+
+    def unfinished_campaigns(self):
+        """[(id, spec, status, updated)] рассылок, которые можно продолжить"""
+        rows = self._execute(
+            "SELECT id, spec, status, updated FROM campaigns WHERE status NOT IN ('done', 'cancelled') "
+            "ORDER BY updated DESC"
+        )
+        return [(r[0], json.loads(r[1]), r[2], r[3]) for r in rows]
+
+    # --- расписание ---
+    def load_schedules(self):
+        """[(id, spec, kind, rule, next_run, last_run, anchor)]"""
+        rows = self._execute("SELECT id, spec, kind, rule, next_run, last_run, anchor FROM schedules")
+        return [(r[0], json.loads(r[1]), r[2], r[3], r[4], r[5], r[6]) for r in rows]
+
+    def save_schedule(self, schedule_id, spec, kind, rule, next_run, last_run, anchor=None):
+        self._execute(
+            "INSERT INTO schedules (id, spec, kind, rule, next_run, last_run, anchor) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET spec = excluded.spec, kind = excluded.kind, "
+            "rule = excluded.rule, next_run = excluded.next_run, last_run = excluded.last_run, "
+            "anchor = excluded.anchor",
+            (schedule_id, json.dumps(spec, ensure_ascii=False), kind, rule, next_run, last_run, anchor)
+        )
+
+    def delete_schedule(self, schedule_id):
+        self._execute("DELETE FROM schedules WHERE id = ?", (schedule_id,))
+
+    # --- карантин ---
+    def load_quarantine(self):
+        rows = self._execute("SELECT chat_id, failures, reason, opened, until FROM quarantine")
+        return {r[0]: {"failures": r[1], "reason": r[2], "opened": bool(r[3]), "until": r[4]} for r in rows}
+
+    def save_quarantine(self, chat_id, entry):
+        self._execute(
+            "INSERT INTO quarantine (chat_id, failures, reason, opened, until) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET failures = excluded.failures, reason = excluded.reason, "
+            "opened = excluded.opened, until = excluded.until",
+            (chat_id, entry["failures"], entry["reason"], int(entry["opened"]), entry["until"])
+        )
+
+    def remove_from_quarantine(self, chat_id):
+        self._execute("DELETE FROM quarantine WHERE chat_id = ?", (chat_id,))
+
+    # --- журнал доставки ---
+    def index_deliveries(self, records, position):
+        """Обновить индекс журнала доставки пачкой [(запись, сегмент, смещение)]"""
+        self._transaction([
+            ("INSERT INTO deliveries (campaign, chat_id, outcome, error, ts, segment, seg_offset) "
+             "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(campaign, chat_id) DO UPDATE SET "
+             "outcome = excluded.outcome, error = excluded.error, ts = excluded.ts, "
+             "segment = excluded.segment, seg_offset = excluded.seg_offset",
+             [(r["campaign"], r["chat"], r["outcome"], r["error"], r["ts"], seg, off)
+              for r, seg, off in records]),
+            ("INSERT OR REPLACE INTO last_delivered (chat_id, campaign, message_id, ts, segment, seg_offset) "
+             "VALUES (?, ?, ?, ?, ?, ?)",
+             [(r["chat"], r["campaign"], r["msg"], r["ts"], seg, off)
+              for r, seg, off in records if r["outcome"] == "ok"]),
+            ("INSERT OR REPLACE INTO meta (key, value) VALUES ('delivery_indexed', ?)",
+             (f"{position[0]} {position[1]}",)),
+        ])
+
+    def prune_deliveries(self, before_segment):
+        """Удалить из индекса записи сегментов с номером меньше before_segment"""
+        self._transaction([
+            ("DELETE FROM deliveries WHERE segment < ?", (before_segment,)),
+            ("DELETE FROM last_delivered WHERE segment < ?", (before_segment,)),
+        ])
+
+    def failed_deliveries(self, campaign_id):
+        """[(chat_id, outcome, error, ts)] чатов, последняя попытка в которые не удалась"""
+        return self._execute(
+            "SELECT chat_id, outcome, error, ts FROM deliveries "
+            "WHERE campaign = ? AND outcome != 'ok' ORDER BY ts", (campaign_id,)
+        )
+
+    def last_deliveries(self, chat_ids=None):
+        """{chat_id: (campaign, message_id, ts)} последней успешной отправки"""
+        if chat_ids is None:
+            rows = self._execute("SELECT chat_id, campaign, message_id, ts FROM last_delivered")
+        else:
+            chat_ids = list(chat_ids)
+            rows = self._execute(
+                f"SELECT chat_id, campaign, message_id, ts FROM last_delivered "
+                f"WHERE chat_id IN ({','.join('?' * len(chat_ids))})", chat_ids
+            ) if chat_ids else []
+        return {r[0]: (r[1], r[2], r[3]) for r in rows}
+
+    # --- миграция ---
+    def import_legacy(self, chats, favorites, folders, templates, stats, blacklist):
+        """Перенос данных из старых JSON файлов одной транзакцией"""
+        folder_rows = [(name, chat_id) for name, ids in folders.items() for chat_id in ids]
+        self._transaction([
+            (self._UPSERT_CHAT, [self._chat_row(chat, i) for i, chat in enumerate(chats) if "id" in chat]),
+            ("INSERT OR IGNORE INTO favorites (chat_id) VALUES (?)", [(cid,) for cid in favorites]),
+            ("INSERT OR IGNORE INTO folders (name) VALUES (?)", [(name,) for name in folders]),
+            ("INSERT OR IGNORE INTO folder_chats (folder, chat_id) VALUES (?, ?)", folder_rows),
+            ("INSERT OR REPLACE INTO templates (name, text) VALUES (?, ?)", list(templates.items())),
+            ("INSERT OR REPLACE INTO stats (key, value) VALUES (?, ?)",
+             [(key, json.dumps(value, ensure_ascii=False)) for key, value in stats.items()]),
+            ("INSERT OR IGNORE INTO blacklist (chat_id) VALUES (?)", [(cid,) for cid in blacklist]),
+        ])
+
+# ========== КЭШ АДРЕСАТОВ ==========
+def make_input_peer(chat):
+    """Собрать InputPeer из сохраненного чата (None, если нет access_hash)"""
+    load_telethon()
+    try:
+        real_id, peer_type = utils.resolve_id(chat["id"])
+    except Exception:
+        return None
+    if peer_type is PeerChat:
+        return InputPeerChat(real_id)
+    access_hash = chat.get("access_hash")
+    if access_hash is None:
+        return None
+    if peer_type is PeerUser:
+        return InputPeerUser(real_id, access_hash)
+    return InputPeerChannel(real_id, access_hash)
+
+def can_write(entity):
+    """Можно ли отправлять сообщения в чат по данным сущности"""
+    load_telethon()
+    if isinstance(entity, (types.ChatForbidden, types.ChannelForbidden)):
+        return False
+    if isinstance(entity, types.User):
+        return not entity.deleted
+    if getattr(entity, 'left', False) or getattr(entity, 'deactivated', False):
+        return False
+    if getattr(entity, 'creator', False) or getattr(entity, 'admin_rights', None):
+        return True
+    if getattr(entity, 'broadcast', False):
+        # В канал пишут только администраторы
+        return False
+    for rights in (getattr(entity, 'banned_rights', None), getattr(entity, 'default_banned_rights', None)):
+        if rights is not None and rights.send_messages:
+            return False
+    return True
+
+def peer_cache_key(target):
+    """Ключ кэша для username/ссылки: @Name, t.me/name и name - одно и то же"""
+    key = str(target).strip().lower()
+    for prefix in ("https://", "http://", "www."):
+        if key.startswith(prefix):
+            key = key[len(prefix):]
+    for prefix in ("t.me/", "telegram.me/", "@"):
+        if key.startswith(prefix):
+            key = key[len(prefix):]
+    return key.rstrip("/")
+
+class PeerCache:
+    """LRU кэш InputPeer для username и ссылок, которых нет в реестре.
+
+    Читают его и меню, и фоновый цикл, поэтому доступ - под блокировкой.
+    """
+
+    def __init__(self, maxsize=PEER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            peer = self._items.get(key)
+            if peer is not None:
+                self._items.move_to_end(key)
+            return peer
+
+    def put(self, key, peer):
+        with self._lock:
+            self._items[key] = peer
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+USERNAME_RULE = re.compile(r"^[a-z][a-z0-9_]{3,31}$")
+CHAT_ID_RULE = re.compile(r"-?\d+")
+TARGET_SEPARATORS = re.compile(r"[\s,;]+")
+
+def parse_target(value):
+    """Адресат из ввода: ID чата (int) или username (str, без @, в нижнем регистре).
+
+    Понимает отрицательные ID групп и каналов (-100...), @name, name,
+    t.me/name, t.me/name/123 (ссылка на пост) и t.me/c/123/45 (пост
+    закрытого канала). ValueError - если адресат не распознан.
+    """
+    text = str(value).strip()
+    if CHAT_ID_RULE.fullmatch(text):
+        chat_id = int(text)
+        # Telegram не выдает нулевой ID: '0' и '-0' - такая же опечатка
+        if chat_id == 0:
+            raise ValueError("неверный ID чата")
+        return chat_id
+    if text.startswith("-"):
+        raise ValueError("неверный ID чата")
+    key = peer_cache_key(text)
+    path = key.split("?", 1)[0].split("/")
+    if path[0] == "s" and len(path) > 1:
+        # t.me/s/name - веб-просмотр канала
+        path = path[1:]
+    if path[0] == "c" and len(path) > 1 and path[1].isdigit():
+        if int(path[1]) == 0:
+            raise ValueError("неверный ID чата")
+        return int(f"-100{path[1]}")
+    if path[0].startswith("+") or path[0] == "joinchat":
+        if path[0][1:].isdigit():
+            raise ValueError("номер телефона: укажите ID или username")
+        raise ValueError("ссылка-приглашение: сначала вступите в чат")
+    if USERNAME_RULE.match(path[0]):
+        return path[0]
+    raise ValueError("не ID, не username и не ссылка t.me")
+
+def parse_targets(values):
+    """Разобрать список адресатов (строку через запятую/пробел или список).
+
+    Возвращает (адресаты без повторов в порядке ввода, {ввод: причина})
+    для того, что разобрать не удалось.
+    """
+    if isinstance(values, str):
+        values = TARGET_SEPARATORS.split(values)
+    targets, invalid = {}, {}
+    for value in values:
+        if isinstance(value, str) and not value.strip():
+            continue
+        try:
+            targets[parse_target(value)] = None
+        except ValueError as e:
+            invalid[str(value).strip()] = str(e)
+    return list(targets), invalid
+
+class ResolveReport:
+    """Итог поиска адресатов перед рассылкой: что нашлось и что нет"""
+
+    def __init__(self, targets, invalid=None):
+        self.targets = targets
+        self.resolved = {}  # адресат -> chat_id
+        self.failed = dict(invalid or {})  # адресат/ввод -> причина
+        self.cached = 0  # найдено в реестре и кэше, без запросов к серверу
+
+    def chat_ids(self):
+        """ID найденных чатов в порядке ввода, без повторов"""
+        return list(dict.fromkeys(self.resolved[target] for target in self.targets
+                                  if target in self.resolved))
+
+    def summary(self):
+        fetched = len(self.resolved) - self.cached
+        text = f"найдено {len(self.resolved)} (из кэша {self.cached}, с сервера {fetched})"
+        unique = len(self.chat_ids())
+        if unique != len(self.resolved):
+            # Разные username/ссылки одного и того же чата
+            text += f", разных чатов {unique}"
+        return f"{text}, не найдено {len(self.failed)}"
+
+    @staticmethod
+    def label(target):
+        return f"@{target}" if isinstance(target, str) else str(target)
+
+# ========== ОШИБКИ ОТПРАВКИ ==========
+ERROR_TRANSIENT = "transient"
+ERROR_RATE_LIMIT = "rate_limit"
+ERROR_PERMANENT = "permanent"
+ERROR_ACCOUNT = "account"
+
+# Кортежи классов ошибок заполняет load_telethon (_load_error_classes)
+RATE_LIMIT_ERRORS = CHAT_PERMANENT_ERRORS = PERMANENT_ERRORS = ACCOUNT_ERRORS = ()
+
+class PeerNotFoundError(ValueError):
+    """get_input_entity не нашел адресата"""
+
+class AccountError(Exception):
+    """Сессия отозвана или аккаунт недоступен: отправлять дальше бессмысленно"""
+
+def _load_error_classes():
+    global RATE_LIMIT_ERRORS, CHAT_PERMANENT_ERRORS, PERMANENT_ERRORS, ACCOUNT_ERRORS
+    # Ограничения скорости: FloodWait, медленный режим, спам-ограничение аккаунта
+    RATE_LIMIT_ERRORS = (errors.FloodError, errors.PeerFloodError)
+    
+    # Постоянные ошибки конкретного чата: писать туда бесполезно
+    CHAT_PERMANENT_ERRORS = (
+        errors.ForbiddenError,
+        errors.UserIsBlockedError,
+        errors.ChannelPrivateError,
+        errors.ChannelInvalidError,
+        errors.ChatIdInvalidError,
+        errors.PeerIdInvalidError,
+        errors.UserBannedInChannelError,
+        errors.ChatAdminRequiredError,
+        errors.ChatRestrictedError,
+        errors.InputUserDeactivatedError,
+        errors.UsernameNotOccupiedError,
+        errors.UsernameInvalidError,
+        PeerNotFoundError,
+    )
     
-    logger.info("Файлы данных созданы")
+    # Остальные ошибки запроса (например, текст): повтор не поможет,
+    # но чат в этом не виноват
+    PERMANENT_ERRORS = (errors.BadRequestError, ValueError, TypeError)
+    
+    # Ошибки аккаунта (отозванный ключ, удаленный аккаунт) останавливают рассылку
+    ACCOUNT_ERRORS = (errors.UnauthorizedError, errors.AuthKeyError)
+
+def classify_error(error):
+    """Класс ошибки отправки: transient, rate_limit, permanent или account"""
+    load_telethon()
+    if isinstance(error, ACCOUNT_ERRORS):
+        return ERROR_ACCOUNT
+    if isinstance(error, RATE_LIMIT_ERRORS):
+        return ERROR_RATE_LIMIT
+    if isinstance(error, CHAT_PERMANENT_ERRORS + PERMANENT_ERRORS):
+        return ERROR_PERMANENT
+    return ERROR_TRANSIENT
+
+def is_chat_error(error):
+    """Ошибка говорит о самом чате (а не о тексте или аккаунте)"""
+    load_telethon()
+    return isinstance(error, CHAT_PERMANENT_ERRORS)
+
+# Ошибки запрета писать в чат: их карантин снимается, когда право вернулось
+WRITE_BAN_ERRORS = ("ChatWriteForbiddenError", "ChatAdminRequiredError", "ChatRestrictedError",
+                    "UserBannedInChannelError", "ChatSendPlainForbiddenError", "ChatSendMediaForbiddenError")
+
+def backoff_delay(attempt, base=RETRY_BACKOFF_BASE, cap=RETRY_BACKOFF_MAX):
+    """Экспоненциальная пауза перед повтором attempt (с 1) со случайным разбросом"""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+class ChatQuarantine:
+    """Предохранитель по чатам.
+
+    Считает неудачные отправки подряд; после QUARANTINE_AFTER чат закрыт
+    на cooldown, затем пропускается одна пробная отправка: успех снимает
+    карантин, неудача снова закрывает чат. Постоянная ошибка закрывает
+    сразу и без срока (until = None). Состояние хранится в DataStore.
+    """
+
+    def __init__(self, store, threshold=QUARANTINE_AFTER, cooldown=QUARANTINE_COOLDOWN, clock=time.time):
+        self.store = store
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.entries = store.load_quarantine()
+
+    def __len__(self):
+        return sum(1 for entry in self.entries.values() if entry["opened"])
+
+    def __contains__(self, chat_id):
+        return chat_id in self.blocked()
+
+    def blocked(self):
+        """ID чатов, закрытых прямо сейчас"""
+        now = self.clock()
+        return {chat_id for chat_id, entry in self.entries.items()
+                if entry["opened"] and (entry["until"] is None or entry["until"] > now)}
+
+    def record_success(self, chat_id):
+        if chat_id in self.entries:
+            self.release(chat_id)
+
+    def record_failure(self, chat_id, reason, permanent=False):
+        """Учесть неудачную отправку. Возвращает True, если чат закрыт"""
+        entry = self.entries.setdefault(chat_id, {"failures": 0, "reason": "", "opened": False, "until": None})
+        entry["failures"] += 1
+        entry["reason"] = reason
+        if permanent:
+            entry["opened"], entry["until"] = True, None
+        elif entry["failures"] >= self.threshold:
+            entry["opened"], entry["until"] = True, self.clock() + self.cooldown
+        self.store.save_quarantine(chat_id, entry)
+        if entry["opened"]:
+            logger.warning(f"Чат {chat_id} в карантине: {reason}")
+        return entry["opened"]
+
+    def release(self, chat_id):
+        if self.entries.pop(chat_id, None) is not None:
+            self.store.remove_from_quarantine(chat_id)
+
+    def release_write_ban(self, chat_id):
+        """Снять карантин, если чат закрыт только из-за запрета писать в него"""
+        entry = self.entries.get(chat_id)
+        if entry is not None and entry["reason"] in WRITE_BAN_ERRORS:
+            self.release(chat_id)
+
+# ========== РЕЕСТР ЧАТОВ ==========
+class ChatRegistry:
+    """Реестр чатов в памяти с индексами для быстрых проверок.
+
+    Все ID приводятся к int. Чаты хранятся в словаре id -> чат, а избранное,
+    черный список и папки - в упорядоченных множествах (dict без значений),
+    поэтому проверка членства стоит O(1). Каждое изменение сразу
+    записывается в DataStore.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.chats = {}
+        self._peers = {}
+        for chat in store.load_chats():
+            chat_id = normalize_chat_id(chat["id"])
+            if chat_id is not None:
+                chat["id"] = chat_id
+                self.chats[chat_id] = chat
+        self.unwritable = {chat_id for chat_id, chat in self.chats.items() if not chat.get("writable", True)}
+        self.favorites = self._id_set(store.load_favorites())
+        self.blacklist = self._id_set(store.load_blacklist())
+        self.folders = {name: self._id_set(ids) for name, ids in store.load_folders().items()}
+        self.quarantine = ChatQuarantine(store)
+        self._type_index = None
+        self._username_index = None
+
+    @staticmethod
+    def _id_set(ids):
+        normalized = (normalize_chat_id(cid) for cid in ids)
+        return dict.fromkeys(cid for cid in normalized if cid is not None)
+
+    def __len__(self):
+        return len(self.chats)
+
+    def __contains__(self, chat_id):
+        return normalize_chat_id(chat_id) in self.chats
+
+    def get(self, chat_id):
+        return self.chats.get(normalize_chat_id(chat_id))
+
+    def head(self, limit):
+        """Первые limit чатов в порядке диалогов"""
+        return list(islice(self.chats.values(), limit))
+
+    def ids(self):
+        return list(self.chats)
+
+    def input_peer(self, chat_id):
+        """InputPeer из сохраненных id + access_hash, без запросов к серверу"""
+        peer = self._peers.get(chat_id)
+        if peer is None:
+            chat = self.chats.get(chat_id)
+            peer = make_input_peer(chat) if chat else None
+            if peer is not None:
+                self._peers[chat_id] = peer
+        return peer
+
+    # --- чаты ---
+    def replace(self, chats):
+        for chat in chats:
+            chat["id"] = normalize_chat_id(chat["id"])
+        self.chats = {chat["id"]: chat for chat in chats if chat["id"] is not None}
+        self.unwritable = {chat_id for chat_id, chat in self.chats.items() if not chat.get("writable", True)}
+        self._peers.clear()
+        self._type_index = self._username_index = None
+        self.store.replace_chats(list(self.chats.values()))
+
+    def merge_recent(self, chats):
+        """Поставить изменившиеся чаты в начало, остальные оставить как есть"""
+        recent = {}
+        for chat in chats:
+            chat["id"] = normalize_chat_id(chat["id"])
+            if chat["id"] is not None:
+                recent[chat["id"]] = chat
+                self._peers.pop(chat["id"], None)
+                self._track_writable(chat["id"], chat.get("writable", True))
+        if not recent:
+            return
+        self._type_index = self._username_index = None
+        # Новый словарь подменяется целиком: меню может читать старый в это время
+        merged = dict(recent)
+        for chat_id, chat in self.chats.items():
+            if chat_id not in recent:
+                merged[chat_id] = chat
+        self.chats = merged
+        self.store.prepend_chats(list(recent.values()))
+
+    def upsert(self, chats):
+        """Добавить или обновить чаты (импорт из меню)"""
+        added = []
+        # Как и в merge_recent, словарь и множество недоступных собираются заново
+        # и подменяются целиком: цикл рассылки может перебирать старые в это время
+        merged = dict(self.chats)
+        unwritable = set(self.unwritable)
+        for chat in chats:
+            chat_id = normalize_chat_id(chat.get("id"))
+            if chat_id is None:
+                continue
+            chat["id"] = chat_id
+            merged[chat_id] = chat
+            self._peers.pop(chat_id, None)
+            self._track_writable(chat_id, chat.get("writable", True), unwritable)
+            added.append(chat)
+        if added:
+            self.chats = merged
+            self.unwritable = unwritable
+            # Индексы сбрасываются после подмены, чтобы не пересобраться по старому словарю
+            self._type_index = self._username_index = None
+        self.store.upsert_chats(added)
+        return added
+
+    def update_chat(self, chat_id, **fields):
+        """Точечное изменение полей чата (название, username, права на запись)"""
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return False
+        chat.update(fields)
+        if "access_hash" in fields:
+            self._peers.pop(chat_id, None)
+        if "writable" in fields:
+            self._track_writable(chat_id, fields["writable"])
+        if "type" in fields:
+            self._type_index = None
+        if "username" in fields:
+            self._username_index = None
+        self.store.update_chat(chat_id, fields)
+        return True
+
+    def _track_writable(self, chat_id, writable, unwritable=None):
+        if unwritable is None:
+            unwritable = self.unwritable
+        if writable:
+            # Только настоящий возврат права писать снимает карантин за запрет
+            # писать; обычное обновление диалога (новый top_message) его не трогает,
+            # а постоянные ошибки и серии неудач снимает только ChatQuarantine или меню
+            if chat_id in unwritable:
+                unwritable.discard(chat_id)
+                self.quarantine.release_write_ban(chat_id)
+        else:
+            unwritable.add(chat_id)
+
+    # --- избранное ---
+    def is_favorite(self, chat_id):
+        return chat_id in self.favorites
+
+    def add_favorite(self, chat_id):
+        if chat_id in self.favorites:
+            return False
+        self.favorites[chat_id] = None
+        self.store.add_favorite(chat_id)
+        return True
+
+    def remove_favorite(self, chat_id):
+        self.favorites.pop(chat_id, None)
+        self.store.remove_favorite(chat_id)
+
+    # --- черный список ---
+    def is_blacklisted(self, chat_id):
+        return chat_id in self.blacklist
+
+    def add_to_blacklist(self, chat_id):
+        if chat_id in self.blacklist:
+            return False
+        self.blacklist[chat_id] = None
+        self.store.add_to_blacklist(chat_id)
+        return True
+
+    def remove_from_blacklist(self, chat_id):
+        self.blacklist.pop(chat_id, None)
+        self.store.remove_from_blacklist(chat_id)
+
+    # --- папки ---
+    def create_folder(self, name):
+        if name in self.folders:
+            return False
+        self.folders[name] = {}
+        self.store.create_folder(name)
+        return True
+
+    def delete_folder(self, name):
+        del self.folders[name]
+        self.store.delete_folder(name)
+
+    def add_to_folder(self, name, chat_id):
+        members = self.folders[name]
+        if chat_id in members:
+            return False
+        members[chat_id] = None
+        self.store.add_to_folder(name, chat_id)
+        return True
+
+    # --- выборка целей ---
+    def ids_of_type(self, chat_type):
+        """ID чатов одного типа. Индекс строится при первом запросе и
+        сбрасывается при изменении списка чатов"""
+        index = self._type_index
+        if index is None:
+            index = {}
+            for chat_id, chat in self.chats.items():
+                index.setdefault(chat.get("type"), set()).add(chat_id)
+            self._type_index = index
+        return index.get(chat_type, set())
+
+    def find_username(self, username):
+        """ID чата по username (без @, регистр не важен) или None"""
+        index = self._username_index
+        if index is None:
+            index = {chat["username"].lower(): chat_id for chat_id, chat in self.chats.items()
+                     if chat.get("username")}
+            self._username_index = index
+        return index.get(username.lower())
+
+    def excluded(self):
+        """Чаты, куда сейчас не пишем: черный список, без права записи, карантин"""
+        return self.blacklist.keys() | self.unwritable | self.quarantine.blocked()
+
+    def filter_targets(self, chat_ids):
+        """Убрать из списка целей черный список, чаты без права записи и карантин"""
+        excluded = self.excluded() & set(chat_ids)
+        if not excluded:
+            return list(chat_ids)
+        return [cid for cid in chat_ids if cid not in excluded]
+
+# Правило выборки: термы и операции над множествами
+QUERY_TOKEN = re.compile(r'\s*(?:([()|&+-])|(\w+)(?::(?:"([^"]*)"|([^\s()|&"]+)))?)')
+QUERY_TERMS = {
+    "all": "all", "все": "all",
+    "favorites": "favorites", "fav": "favorites", "избранное": "favorites",
+    "folder": "folder", "папка": "folder",
+    "type": "type", "тип": "type",
+    "id": "id",
+}
+CHAT_TYPES = ("user", "group", "channel")
+
+class TargetQuery:
+    """Выборка чатов правилом с операциями над множествами.
+
+    Термы: all, favorites, folder:ИМЯ (имя с пробелами - в кавычках),
+    type:user|group|channel, id:ЧИСЛО. Операции: | или + - объединение,
+    & - пересечение, - - разность, скобки; & связывает сильнее | и -.
+    Из результата всегда вычитаются черный список, чаты без права записи
+    и карантин.
+
+        folder:Клиенты | favorites - type:user
+        (folder:A & folder:B) | id:-1001234567890
+
+    Правило разбирается один раз; каждый терм - готовое множество реестра
+    (ключи словаря или индекс по типу), так что выборка из 100k чатов
+    стоит нескольких операций над множествами на уровне C.
+    """
+
+    def __init__(self, text):
+        self.text = text.strip()
+        self._tokens = self._tokenize(self.text)
+        self._pos = 0
+        if not self._tokens:
+            raise ValueError("Пустое правило выборки")
+        self.tree = self._union()
+        if self._pos != len(self._tokens):
+            raise ValueError(f"Лишнее в правиле: {self._tokens[self._pos][1]!r}")
+        del self._tokens
+
+    @staticmethod
+    def _tokenize(text):
+        tokens = []
+        pos = 0
+        while pos < len(text):
+            match = QUERY_TOKEN.match(text, pos)
+            if not match or match.end() == pos:
+                if text[pos:].strip():
+                    raise ValueError(f"Не понимаю правило с позиции {pos + 1}: {text[pos:]!r}")
+                break
+            operator, name, quoted, value = match.groups()
+            if operator:
+                tokens.append(("op", "|" if operator == "+" else operator))
+            elif name:
+                tokens.append(("term", TargetQuery._term(name, quoted if quoted is not None else value)))
+            pos = match.end()
+        return tokens
+
+    @staticmethod
+    def _term(name, value):
+        kind = QUERY_TERMS.get(name.lower())
+        if kind is None:
+            raise ValueError(f"Неизвестный терм: {name}")
+        if kind in ("all", "favorites"):
+            if value is not None:
+                raise ValueError(f"У {name} не бывает значения")
+            return (kind, None)
+        if value is None:
+            raise ValueError(f"Нужно значение: {name}:...")
+        if kind == "type":
+            if value not in CHAT_TYPES:
+                raise ValueError(f"Тип чата - один из {', '.join(CHAT_TYPES)}")
+        elif kind == "id":
+            chat_id = normalize_chat_id(value)
+            if chat_id is None:
+                raise ValueError(f"Неверный ID чата: {name}:{value}")
+            value = chat_id
+        return (kind, value)
+
+    def _peek(self):
+        return self._tokens[self._pos] if self._pos < len(self._tokens) else (None, None)
+
+    def _union(self):
+        node = self._intersection()
+        while self._peek() in (("op", "|"), ("op", "-")):
+            operator = self._peek()[1]
+            self._pos += 1
+            node = (operator, node, self._intersection())
+        return node
+
+    def _intersection(self):
+        node = self._atom()
+        while self._peek() == ("op", "&"):
+            self._pos += 1
+            node = ("&", node, self._atom())
+        return node
+
+    def _atom(self):
+        kind, value = self._peek()
+        self._pos += 1
+        if kind == "term":
+            return value
+        if (kind, value) == ("op", "("):
+            node = self._union()
+            if self._peek() != ("op", ")"):
+                raise ValueError("Не закрыта скобка")
+            self._pos += 1
+            return node
+        raise ValueError("Правило оборвано" if kind is None else f"Неожиданное {value!r}")
+
+    def _evaluate(self, node, registry):
+        kind, left = node[0], node[1]
+        if kind == "all":
+            return registry.chats.keys()
+        if kind == "favorites":
+            return registry.favorites.keys()
+        if kind == "folder":
+            if left not in registry.folders:
+                raise ValueError(f"Папка не найдена: {left}")
+            return registry.folders[left].keys()
+        if kind == "type":
+            return registry.ids_of_type(left)
+        if kind == "id":
+            return {left}
+        left, right = self._evaluate(left, registry), self._evaluate(node[2], registry)
+        if kind == "|":
+            return left | right
+        if kind == "&":
+            return left & right
+        return left - right
+
+    def evaluate(self, registry):
+        """Множество ID по правилу без черного списка, закрытых и карантина"""
+        return self._evaluate(self.tree, registry) - registry.excluded()
+
+    def iter_ids(self, registry):
+        """ID по порядку диалогов (чаты вне реестра - в конце), лениво"""
+        selected = self.evaluate(registry)
+        for chat_id in registry.chats:
+            if chat_id in selected:
+                yield chat_id
+        yield from sorted(selected - registry.chats.keys())
+
+    def ids(self, registry):
+        return list(self.iter_ids(registry))
+
+    def count(self, registry):
+        return len(self.evaluate(registry))
+
+# ========== ШАБЛОНЫ ==========
+# Подстановки в тексте: {title} {username} {name} {id} {date} {time}
+# {n} {cycle} {total}; {{ и }} - сами фигурные скобки.
+# {n} и {total} считаются в пределах текущего цикла: номер получателя в
+# списке рассылки и длина этого списка, поэтому {n} никогда не больше {total}
+TEMPLATE_TOKEN = re.compile(r"\{\{|\}\}|\{(\w+)\}")
+TEMPLATE_FIELDS = ("title", "username", "name", "id", "date", "time", "n", "cycle", "total")
+
+def template_context(chat=None, campaign=None):
+    """Значения подстановок для одного получателя"""
+    chat = chat or {}
+    now = datetime.now()
+    username = chat.get("username") or ""
+    context = {
+        "id": str(chat.get("id", "")),
+        "title": chat.get("title") or "",
+        "username": f"@{username}" if username else "",
+        "name": chat.get("title") or chat.get("name")
+                or (f"@{username}" if username else str(chat.get("id", ""))),
+        "date": now.strftime("%d.%m.%Y"),
+        "time": now.strftime("%H:%M")
+    }
+    if campaign is not None:
+        # campaign.index указывает на текущего получателя цикла
+        context.update(n=str(campaign.index + 1), cycle=str(campaign.cycle),
+                       total=str(len(campaign.chat_ids)))
+    return context
+
+def _utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+class CompiledTemplate:
+    """Текст рассылки, разобранный один раз.
+
+    Markdown превращается в текст и formatting_entities, подстановки - в
+    слоты между неизменными кусками. Для каждой сущности заранее известно,
+    сколько слотов стоит перед ней и внутри нее, поэтому render() только
+    склеивает строки и сдвигает смещения. Без подстановок render() отдает
+    готовые части без какой-либо работы.
+
+    Текст длиннее MESSAGE_LIMIT делится на несколько сообщений; подпись к
+    файлу делить нельзя, поэтому длиннее CAPTION_LIMIT - ValueError.
+    """
+
+    def __init__(self, text, caption=False):
+        load_telethon()
+        self.source = text or ""
+        self.caption = caption
+        body, entities = markdown.parse(self.source)
+        # Сущности нулевой длины Telegram не принимает (Telethon убирает их так же)
+        entities = [e for e in entities if e.length]
+        if not body.strip() and not caption:
+            raise ValueError("Пустой текст сообщения")
+        
+        # Смещения сущностей - в UTF-16, поэтому разбор идет по тексту с суррогатами
+        body = helpers.add_surrogate(body)
+        self._chunks = []      # неизменные куски, на один больше, чем слотов
+        self.fields = []       # имена подстановок по слотам
+        spans = []             # (начало, конец) слотов в исходном тексте
+        removed = []           # (позиция, сколько символов убрано до нее включительно)
+        chunk, last, shrink = [], 0, 0
+        for match in TEMPLATE_TOKEN.finditer(body):
+            name = match.group(1)
+            if name is not None and name not in TEMPLATE_FIELDS:
+                continue
+            chunk.append(body[last:match.start()])
+            if name is None:
+                chunk.append(match.group()[0])
+                shrink += 1
+            else:
+                self._chunks.append("".join(chunk))
+                chunk = []
+                self.fields.append(name)
+                spans.append((match.start(), match.end()))
+                shrink += match.end() - match.start()
+            removed.append((match.end(), shrink))
+            last = match.end()
+        chunk.append(body[last:])
+        self._chunks.append("".join(chunk))
+        
+        def shifted(pos):
+            # Позиция в тексте без подстановок и экранирования
+            cut = 0
+            for end, total in removed:
+                if end > pos:
+                    break
+                cut = total
+            return pos - cut
+        
+        # (сущность, смещение и длина без подстановок, слоты до нее, слоты до ее конца)
+        self._entities = []
+        for entity in entities:
+            start, end = entity.offset, entity.offset + entity.length
+            before = sum(1 for s, e in spans if e <= start)
+            inside = sum(1 for s, e in spans if e <= end)
+            self._entities.append((entity, shifted(start), shifted(end) - shifted(start), before, inside))
+        
+        self.parts = None
+        if not self.fields:
+            self.parts = self._split(helpers.del_surrogate(self._chunks[0]), entities)
+        elif caption and _utf16_len(helpers.del_surrogate("".join(self._chunks))) > CAPTION_LIMIT:
+            raise ValueError(f"Подпись к файлу длиннее {CAPTION_LIMIT} символов")
+
+    def _split(self, text, entities):
+        if not text.strip():
+            return ((text, entities),)
+        limit = CAPTION_LIMIT if self.caption else MESSAGE_LIMIT
+        if _utf16_len(text) <= limit and len(entities) <= 100:
+            return ((text, entities),)
+        parts = tuple(utils.split_text(text, entities, limit=limit))
+        if self.caption and len(parts) > 1:
+            raise ValueError(f"Подпись к файлу длиннее {CAPTION_LIMIT} символов")
+        return parts
+
+    def render(self, context=None):
+        """Части (текст, formatting_entities) для одного получателя"""
+        if not self.fields:
+            return self.parts
+        context = context or {}
+        values = [helpers.add_surrogate(str(context.get(name, ""))) for name in self.fields]
+        offsets = [0]
+        for value in values:
+            offsets.append(offsets[-1] + len(value))
+        pieces = [self._chunks[0]]
+        for value, chunk in zip(values, self._chunks[1:]):
+            pieces.append(value)
+            pieces.append(chunk)
+        entities = []
+        for entity, offset, length, before, inside in self._entities:
+            rendered = copy.copy(entity)
+            rendered.offset = offset + offsets[before]
+            rendered.length = length + offsets[inside] - offsets[before]
+            if rendered.length:
+                entities.append(rendered)
+        return self._split(helpers.del_surrogate("".join(pieces)), entities)
+
+class TemplateCache:
+    """Скомпилированные тексты и шаблоны (LRU).
+
+    Ключ - сам текст и режим подписи, то есть версия шаблона: изменение
+    шаблона дает новый ключ, а invalidate() сразу выбрасывает старую версию.
+    """
+
+    def __init__(self, maxsize=TEMPLATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._compiled = OrderedDict()
+        # Кэшем пользуются и меню (подготовка рассылки), и фоновый цикл
+        self._lock = threading.Lock()
+
+    def get(self, text, caption=False):
+        key = (text, caption)
+        with self._lock:
+            template = self._compiled.get(key)
+            if template is not None:
+                self._compiled.move_to_end(key)
+                return template
+        # Разбор - вне блокировки, чтобы другой поток не ждал его
+        template = CompiledTemplate(text, caption)
+        with self._lock:
+            self._compiled[key] = template
+            if len(self._compiled) > self.maxsize:
+                self._compiled.popitem(last=False)
+        return template
+
+    def invalidate(self, text):
+        with self._lock:
+            for caption in (False, True):
+                self._compiled.pop((text, caption), None)
+
+# ========== ФОНОВЫЙ ЦИКЛ ==========
+class AsyncRunner:
+    """Долгоживущий цикл asyncio в отдельном потоке.
+
+    Цикл владеет TelegramClient; меню работает в основном потоке и передает
+    корутины через submit(), получая concurrent.futures.Future.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="sender-loop", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Запустить корутину в фоновом цикле, не дожидаясь результата"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """Выполнить корутину в фоновом цикле и дождаться результата"""
+        return self.submit(coro).result(timeout)
+
+    @staticmethod
+    async def _cancel_pending():
+        # Фоновые задачи (планировщик, подключение) завершаются до остановки цикла
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        if self.loop.is_running():
+            try:
+                self.run(self._cancel_pending(), timeout=5)
+            except Exception as e:
+                logger.error(f"Фоновые задачи не завершились: {e}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+class RateLimiter:
+    """Темп отправки по абсолютным срокам с учетом FloodWait.
+
+    Каждая отправка назначается на срок start + n / rate, а не через
+    delay после предыдущей, поэтому задержка сети съедает следующее
+    ожидание, а не добавляется к нему. Если отправка опоздала больше
+    чем на один интервал, расписание начинается заново (без залпа).
+
+    FloodWait от сервера ставит на паузу всех, кто ждет отправки, ровно
+    на указанное время. Повторные FloodWait снижают скорость, серия
+    успешных отправок возвращает ее к max_rate.
+
+    Лимитер общий для всех рассылок. Если слота ждут несколько, его
+    получает рассылка со старшим priority, а при равном приоритете - та,
+    что получила меньше слотов с учетом weight (взвешенная справедливая
+    очередь: у каждой рассылки виртуальное время vtime растет на 1/weight
+    за слот). Ожидающие лежат в куче, слоты раздает одна задача _dispatch.
+
+    clock - источник времени; в бенчмарке подменяется виртуальным временем цикла.
+    """
+
+    def __init__(self, rate, max_rate=None, clock=time.monotonic):
+        self.clock = clock
+        self.rate = max(rate, MIN_SEND_RATE)
+        self.max_rate = max(max_rate or self.rate, self.rate)
+        self.paused_until = 0.0
+        self.flood_events = deque(maxlen=100)
+        self._next_at = None
+        self._started = None
+        self._granted = 0
+        self._success_streak = 0
+        self._waiters = []  # куча (-priority, vtime, номер, рассылка, future)
+        self._order = _sequence()
+        self._vclock = 0.0
+        self._dispatcher = None
+
+    def configure(self, rate, max_rate=None):
+        """Задать скорость для новой рассылки и сбросить расписание"""
+        self.rate = max(rate, MIN_SEND_RATE)
+        self.max_rate = max(max_rate or self.rate, self.rate)
+        self._next_at = None
+        self._started = None
+        self._granted = 0
+        self._success_streak = 0
+
+    def allow(self, rate, max_rate=None):
+        """Поднять скорость для еще одной рассылки, не сбрасывая расписание и паузу"""
+        self.rate = max(self.rate, rate, MIN_SEND_RATE)
+        self.max_rate = max(self.max_rate, max_rate or self.rate, self.rate)
+
+    def _reserve(self):
+        """Занять слот, если его срок наступил. Иначе - сколько секунд ждать"""
+        now = self.clock()
+        if now < self.paused_until:
+            return self.paused_until - now
+        interval = 1 / self.rate
+        if self._next_at is None or now - self._next_at > interval:
+            self._next_at = now
+        if self._next_at > now:
+            return self._next_at - now
+        self._next_at += interval
+        if self._started is None:
+            self._started = now
+        self._granted += 1
+        return 0
+
+    def _charge(self, lane):
+        if lane is not None:
+            start = max(lane.vtime, self._vclock)
+            lane.vtime = start + 1 / lane.weight
+            self._vclock = start
+
+    async def acquire(self, lane=None):
+        """Дождаться срока следующей отправки (lane - рассылка с priority и weight)"""
+        # Без очереди и со свободным слотом - сразу, без future и задачи
+        if not self._waiters and self._reserve() == 0:
+            self._charge(lane)
+            return
+        future = asyncio.get_running_loop().create_future()
+        if lane is None:
+            key = (0, self._vclock)
+        else:
+            key = (-lane.priority, max(lane.vtime, self._vclock))
+        heapq.heappush(self._waiters, (*key, next(self._order), lane, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        """Раздавать слоты ожидающим по сроку, приоритету и весу"""
+        while True:
+            # Отмененные ожидания слот не занимают
+            while self._waiters and self._waiters[0][-1].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                return
+            wait = self._reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            *_, lane, future = heapq.heappop(self._waiters)
+            self._charge(lane)
+            future.set_result(None)
+
+    def achieved_rate(self):
+        """Фактическая скорость с начала расписания (сообщ/сек)"""
+        if self._started is None or self._granted < 2:
+            return 0.0
+        elapsed = self.clock() - self._started
+        return (self._granted - 1) / elapsed if elapsed > 0 else 0.0
+
+    def on_success(self):
+        self._success_streak += 1
+        if self._success_streak >= RECOVERY_AFTER and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_STEP)
+            self._success_streak = 0
+
+    def on_flood_wait(self, seconds, chat_id=None):
+        """Учесть FloodWait: пауза ровно на seconds, при повторе - снижение скорости"""
+        now = self.clock()
+        repeated = any(now - ts < FLOOD_WINDOW for ts, _, _ in self.flood_events)
+        self.flood_events.append((now, seconds, chat_id))
+        self.paused_until = max(self.paused_until, now + seconds)
+        self._success_streak = 0
+        if repeated:
+            self.rate = max(MIN_SEND_RATE, self.rate * FLOOD_BACKOFF)
+            logger.warning(f"Повторный FloodWait, скорость снижена до {self.rate:.3f} сообщ/сек")
+        # Расписание продолжается сразу после паузы
+        self._next_at = self.paused_until
+        self._started = None
+        self._granted = 0
+
+class CampaignInterrupt:
+    """Участок ожидания, который Campaign.stop() обрывает сразу.
+
+    Пока рассылка внутри такого участка (темп, FloodWait, пауза перед
+    повтором, поиск адресатов), stop() отменяет ее задачу. Сама отправка
+    в участок не входит и при остановке завершается как обычно. Вход в
+    участок уже остановленной рассылки сразу дает CancelledError.
+    """
+
+    __slots__ = ("campaign",)
+
+    def __init__(self, campaign):
+        self.campaign = campaign
+
+    def __enter__(self):
+        if not self.campaign.active:
+            raise asyncio.CancelledError()
+        self.campaign._interruptible = True
+
+    def __exit__(self, *exc_info):
+        self.campaign._interruptible = False
+        return False
+
+class Campaign:
+    """Рассылка: параметры, курсор и счетчики, общие для меню и фонового цикла.
+
+    Курсор (cycle, index) - номер цикла и индекс следующей цели в chat_ids.
+    priority и weight решают, кто из одновременных рассылок получает
+    следующий слот общего лимитера; свой темп (delay) держит pacer.
+    query - правило TargetQuery: тогда chat_ids пересчитываются в начале
+    каждого цикла, а сохраненный список нужен только курсору.
+    """
+
+    def __init__(self, chat_ids, text, delay=2, infinite=False, cycles=1, cycle_delay=5,
+                 campaign_id=None, cycle=1, index=0, media=None, priority=0, weight=1.0, query=None):
+        self.id = campaign_id or f"{datetime.now():%Y%m%d-%H%M%S}-{random.randrange(16 ** 4):04x}"
+        self.chat_ids = chat_ids
+        self.query = query
+        self.text = text
+        self.media = media
+        self.messages = None
+        self.delay = delay
+        self.infinite = infinite
+        self.cycles = cycles
+        self.cycle_delay = cycle_delay
+        self.cycle = cycle
+        self.index = index
+        self.priority = priority
+        self.weight = max(weight, 0.01)
+        self.vtime = 0.0
+        self.pacer = None
+        self.schedule_id = None
+        self.future = None
+        self.interruptible = CampaignInterrupt(self)
+        self._loop = None
+        self._task = None
+        self._interruptible = False
+        self._stop_event = None
+        self._resume_event = None
+        self._lock = threading.Lock()
+        self._active = True
+        self._paused = False
+        self._cancelled = False
+        self._sent = 0
+        self._errors = 0
+        self._start_time = time.time()
+
+    @property
+    def active(self):
+        with self._lock:
+            return self._active
+
+    @property
+    def paused(self):
+        with self._lock:
+            return self._paused
+
+    @property
+    def cancelled(self):
+        with self._lock:
+            return self._cancelled
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._active:
+                return "paused" if self._paused else "running"
+            return "cancelled" if self._cancelled else "stopped"
+
+    def bind(self, loop):
+        """Привязать рассылку к циклу событий и задаче, в которой она выполняется"""
+        self._loop = loop
+        self._task = asyncio.current_task()
+        self._stop_event = asyncio.Event()
+        self._resume_event = asyncio.Event()
+
+    def _wake(self, event):
+        if self._loop and not self._loop.is_closed() and event is not None:
+            self._loop.call_soon_threadsafe(event.set)
+
+    def _interrupt(self):
+        # В потоке цикла: рассылка сейчас стоит на await, флаг не изменится
+        if self._interruptible and self._task is not None:
+            self._task.cancel()
+
+    def stop(self):
+        """Остановить рассылку. Ожидания обрываются сразу, отправка в процессе
+        завершается; затем сохраняются курсор и статистика. Возвращает
+        future задачи рассылки, по которому можно дождаться остановки"""
+        with self._lock:
+            self._active = False
+        self._wake(self._stop_event)
+        self._wake(self._resume_event)
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._interrupt)
+        return self.future
+
+    def cancel(self):
+        """Остановить без возможности продолжить"""
+        with self._lock:
+            self._cancelled = True
+        return self.stop()
+
+    def pause(self):
+        with self._lock:
+            self._paused = True
+
+    def resume(self):
+        with self._lock:
+            self._paused = False
+        self._wake(self._resume_event)
+
+    async def checkpoint(self):
+        """Перед отправкой: переждать паузу. Возвращает active"""
+        while self.paused and self.active:
+            self._resume_event.clear()
+            if self.paused and self.active:
+                await self._resume_event.wait()
+        return self.active
+
+    async def wait(self, seconds):
+        """Пауза, которую stop() прерывает сразу. Возвращает active"""
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        return self.active
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self._sent += 1
+            else:
+                self._errors += 1
+
+    def progress(self):
+        """(отправлено, ошибок, секунд с начала)"""
+        with self._lock:
+            return self._sent, self._errors, time.time() - self._start_time
+
+    def prepare(self, cache=None):
+        """Скомпилировать текст или варианты один раз на всю рассылку"""
+        if self.messages is None:
+            compile_text = cache.get if cache is not None else CompiledTemplate
+            variants = self.text if isinstance(self.text, list) else [self.text]
+            self.messages = [compile_text(variant, bool(self.media)) for variant in variants]
+        return self.messages
+
+    def to_spec(self):
+        """Параметры для сохранения (без курсора - он в журнале)"""
+        return {
+            "chat_ids": self.chat_ids,
+            "text": self.text,
+            "delay": self.delay,
+            "infinite": self.infinite,
+            "cycles": self.cycles,
+            "cycle_delay": self.cycle_delay,
+            "media": self.media,
+            "priority": self.priority,
+            "weight": self.weight,
+            "query": self.query
+        }
+
+    @classmethod
+    def from_spec(cls, campaign_id, spec, cursor=None):
+        cycle, index = cursor or (1, 0)
+        return cls(spec["chat_ids"], spec["text"], spec["delay"], spec["infinite"],
+                   spec["cycles"], spec["cycle_delay"], campaign_id, cycle, index, spec.get("media"),
+                   spec.get("priority", 0), spec.get("weight", 1.0), spec.get("query"))
+
+class CampaignManager:
+    """Рассылки, идущие одновременно.
+
+    Каждая рассылка - своя задача mass_send в фоновом цикле; отправки
+    всех рассылок проходят через общий RateLimiter, который и решает
+    очередность. Завершенные рассылки остаются в списке, пока их не
+    уберет clear_finished(), чтобы меню могло показать итог.
+    """
+
+    def __init__(self, runner, run):
+        self.runner = runner
+        self.run = run  # корутина-функция mass_send(campaign)
+        self.campaigns = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self.campaigns.values()))
+
+    def get(self, campaign_id):
+        with self._lock:
+            return self.campaigns.get(campaign_id)
+
+    def active(self):
+        return [campaign for campaign in self if campaign.active]
+
+    def start(self, campaign):
+        with self._lock:
+            self.campaigns[campaign.id] = campaign
+        campaign.future = self.runner.submit(self.run(campaign))
+        return campaign
+
+    def stop_all(self):
+        """Остановить все активные рассылки (курсоры сохраняются)"""
+        stopped = self.active()
+        for campaign in stopped:
+            campaign.stop()
+        return stopped
+
+    def wait(self, timeout=None):
+        """Дождаться завершения задач всех рассылок"""
+        futures = [campaign.future for campaign in self if campaign.future is not None]
+        done, pending = concurrent.futures.wait(futures, timeout)
+        for future in done:
+            if future.exception() is not None:
+                logger.error(f"Рассылка не завершилась корректно: {future.exception()}")
+        return not pending
+
+    def clear_finished(self):
+        with self._lock:
+            for campaign_id in [cid for cid, c in self.campaigns.items() if not c.active]:
+                del self.campaigns[campaign_id]
+
+class MediaAttachment:
+    """Файл рассылки, который загружается на сервер один раз.
+
+    upload() отдает файл через client.upload_file; первое сообщение уходит
+    с загруженным InputFile, а все следующие ссылаются на медиа из этого
+    сообщения, так что файл не загружается и не обрабатывается повторно.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.uploaded = None
+        self.media = None
+
+    async def upload(self, client):
+        if self.uploaded is None:
+            self.uploaded = await client.upload_file(self.path)
+            logger.info(f"Файл {self.path} загружен ({os.path.getsize(self.path)} байт)")
+        return self.uploaded
+
+    def ref(self):
+        """Что передать в send_message(file=...)"""
+        return self.media or self.uploaded
+
+    def remember(self, message):
+        if self.media is None and getattr(message, 'media', None) is not None:
+            self.media = message.media
+
+    def expired(self, error):
+        """Ссылка на медиа устарела: дальше отправлять загруженный файл"""
+        if self.media is not None and isinstance(error, errors.FileReferenceExpiredError):
+            self.media = None
+            return True
+        return False
+
+class CampaignJournal:
+    """Журнал курсора рассылки: строка "цикл индекс" после каждой отправки.
+
+    Дописывание строки дешевле любой перезаписи, а после сбоя достаточно
+    последней целой строки. Журнал периодически сжимается до одной строки.
+    """
+
+    def __init__(self, campaign_id, directory=CAMPAIGNS_DIR):
+        self.path = os.path.join(directory, f"{campaign_id}.journal")
+        self._file = None
+        self._lines = 0
+
+    def load(self):
+        """Последний сохраненный курсор (cycle, index) или None"""
+        cursor = None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and line.endswith("\n"):
+                        cursor = (int(parts[0]), int(parts[1]))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка чтения журнала {self.path}: {e}")
+        return cursor
+
+    def append(self, cycle, index):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(f"{cycle} {index}\n")
+        self._file.flush()
+        self._lines += 1
+        if self._lines >= JOURNAL_COMPACT_EVERY:
+            self._compact(cycle, index)
+
+    def _compact(self, cycle, index):
+        self.close()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(f"{cycle} {index}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._lines = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class DeliveryLog:
+    """Журнал доставки: одна строка NDJSON на каждую попытку отправки.
+
+    Записи дописываются в сегменты data/delivery/NNNNNNNN.ndjson, новый
+    сегмент начинается после segment_bytes. Индекс в DataStore (исход
+    последней попытки по рассылке и чату, последняя успешная отправка в
+    чат) обновляется пачками; позиция проиндексированного хранится в meta,
+    поэтому после сбоя хвост сегментов доиндексируется при открытии.
+    Хранятся последние keep_segments сегментов: при открытии нового
+    старейшие удаляются вместе с их строками индекса.
+    """
+
+    def __init__(self, store, directory=DELIVERY_DIR, segment_bytes=DELIVERY_SEGMENT_BYTES,
+                 index_every=DELIVERY_INDEX_EVERY, keep_segments=DELIVERY_KEEP_SEGMENTS):
+        self.store = store
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_every = index_every
+        self.keep_segments = keep_segments
+        self._lock = threading.Lock()
+        self._pending = []
+        self._file = None
+        os.makedirs(directory, exist_ok=True)
+        self.segment = max(self._segments(), default=1)
+        self._position = (self.segment, 0)
+        self._catch_up()
+        self._prune()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.ndjson")
+
+    def _segments(self):
+        return sorted(int(name[:-7]) for name in os.listdir(self.directory)
+                      if name.endswith(".ndjson") and name[:-7].isdigit())
+
+    def _catch_up(self):
+        """Доиндексировать записи после последней сохраненной позиции"""
+        indexed = self.store.get_meta("delivery_indexed")
+        segment, offset = map(int, indexed.split()) if indexed else (0, 0)
+        for number in self._segments():
+            if number < segment:
+                continue
+            path = self._segment_path(number)
+            start = offset if number == segment else 0
+            with open(path, 'rb') as f:
+                f.seek(start)
+                position = start
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Недописанная при сбое строка
+                        self._truncate(path, position)
+                        break
+                    try:
+                        self._pending.append((json.loads(line), number, position))
+                    except ValueError:
+                        logger.error(f"Поврежденная запись журнала доставки {path}:{position}")
+                    position += len(line)
+            self._position = (number, position)
+        self._flush_index()
+
+    def _prune(self):
+        """Удалить сегменты старше последних keep_segments и их индекс"""
+        oldest_kept = self.segment - self.keep_segments + 1
+        expired = [number for number in self._segments() if number < oldest_kept]
+        if not expired:
+            return
+        # Сначала индекс: он не должен указывать на удаленный файл
+        self._flush_index()
+        self.store.prune_deliveries(oldest_kept)
+        for number in expired:
+            os.remove(self._segment_path(number))
+        logger.info(f"Журнал доставки: удалено старых сегментов {len(expired)}")
+
+    @staticmethod
+    def _truncate(path, size):
+        with open(path, 'r+b') as f:
+            f.truncate(size)
+
+    def record(self, campaign_id, chat_id, outcome, error="", message_id=None, latency=0.0):
+        """Дописать попытку отправки: outcome - "ok" или класс ошибки"""
+        entry = {
+            "ts": round(time.time(), 3),
+            "campaign": campaign_id or "",
+            "chat": chat_id,
+            "msg": message_id,
+            "latency": round(latency, 4),
+            "outcome": outcome,
+            "error": error
+        }
+        line = (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            if self._file is None:
+                self._file = open(self._segment_path(self.segment), 'ab')
+            offset = self._file.tell()
+            if offset and offset + len(line) > self.segment_bytes:
+                self._file.close()
+                self.segment += 1
+                self._file = open(self._segment_path(self.segment), 'ab')
+                offset = 0
+                self._prune()
+            self._file.write(line)
+            self._file.flush()
+            self._pending.append((entry, self.segment, offset))
+            self._position = (self.segment, offset + len(line))
+            if len(self._pending) >= self.index_every:
+                self._flush_index()
+
+    def _flush_index(self):
+        if self._pending:
+            self.store.index_deliveries(self._pending, self._position)
+            self._pending = []
+
+    def flush(self):
+        with self._lock:
+            self._flush_index()
+
+    def read(self, segment, offset):
+        """Полная запись по адресу из индекса"""
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def failed_chats(self, campaign_id):
+        """[(chat_id, outcome, error, ts)] чатов, куда рассылка не дошла"""
+        self.flush()
+        return self.store.failed_deliveries(campaign_id)
+
+    def last_success(self, chat_ids=None):
+        """{chat_id: (campaign, message_id, ts)} последней успешной отправки"""
+        self.flush()
+        return self.store.last_deliveries(chat_ids)
+
+    def close(self):
+        with self._lock:
+            self._flush_index()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+# ========== СОБЫТИЯ TELEGRAM ==========
+class ChatEventSubscriber:
+    """Подписка на события клиента и точечное обновление реестра чатов.
+
+    Вход/выход/исключение, смена названия и username, потеря права писать.
+    Чаты, куда писать больше нельзя, помечаются writable=False и выпадают
+    из следующих рассылок через ChatRegistry.filter_targets.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def attach(self, client):
+        load_telethon()
+        client.add_event_handler(self.on_chat_action, events.ChatAction())
+        client.add_event_handler(self.on_channel_update, events.Raw(types.UpdateChannel))
+        client.add_event_handler(self.on_banned_rights, events.Raw(types.UpdateChatDefaultBannedRights))
+        client.add_event_handler(self.on_user_name, events.Raw(types.UpdateUserName))
+
+    @property
+    def registry(self):
+        return self.bot.registry
+
+    def _is_me(self, event):
+        me = self.bot.me
+        return me is not None and me.id in (event.user_ids or [])
+
+    async def on_chat_action(self, event):
+        try:
+            chat_id = event.chat_id
+            if event.new_title:
+                self.registry.update_chat(chat_id, title=event.new_title)
+            if (event.user_left or event.user_kicked) and self._is_me(event):
+                logger.info(f"Нас больше нет в чате {chat_id}, исключаю из рассылок")
+                self.registry.update_chat(chat_id, writable=False)
+            elif (event.user_joined or event.user_added or event.created) and self._is_me(event):
+                await self._refresh(chat_id, await event.get_chat())
+        except Exception as e:
+            logger.error(f"Ошибка обработки события чата: {e}")
+
+    async def on_channel_update(self, update):
+        await self._refresh(utils.get_peer_id(types.PeerChannel(update.channel_id)))
+
+    async def on_banned_rights(self, update):
+        await self._refresh(utils.get_peer_id(update.peer))
+
+    async def on_user_name(self, update):
+        usernames = getattr(update, 'usernames', None) or []
+        active = [u.username for u in usernames if getattr(u, 'active', True)]
+        name = " ".join(part for part in (update.first_name, update.last_name) if part)
+        self.registry.update_chat(update.user_id, name=name, username=active[0] if active else "")
+
+    async def _refresh(self, chat_id, entity=None):
+        """Перечитать чат с сервера и обновить название, username и право записи"""
+        known = chat_id in self.registry
+        try:
+            if entity is None:
+                if not known:
+                    return
+                entity = await self.bot.client.get_entity(chat_id)
+        except Exception as e:
+            if is_chat_error(e):
+                # Закрытый или удаленный чат
+                logger.info(f"Чат {chat_id} недоступен ({e}), исключаю из рассылок")
+                self.registry.update_chat(chat_id, writable=False)
+            else:
+                # Сеть, таймаут, FloodWait: чат не трогаем, обновится при следующем событии
+                logger.warning(f"Не удалось обновить чат {chat_id}: {e}")
+            return
+        
+        writable = can_write(entity)
+        input_peer = utils.get_input_peer(entity, allow_self=True, check_hash=False)
+        if known:
+            self.registry.update_chat(
+                chat_id,
+                title=getattr(entity, 'title', '') or "",
+                name=utils.get_display_name(entity),
+                username=getattr(entity, 'username', '') or "",
+                access_hash=getattr(input_peer, 'access_hash', None),
+                writable=writable
+            )
+        else:
+            self.registry.merge_recent([{
+                "id": chat_id,
+                "title": getattr(entity, 'title', '') or "",
+                "name": utils.get_display_name(entity),
+                "username": getattr(entity, 'username', '') or "",
+                "type": "channel" if isinstance(entity, types.Channel) else "group",
+                "access_hash": getattr(input_peer, 'access_hash', None),
+                "writable": writable
+            }])
+        if not writable:
+            logger.info(f"Нет права писать в чат {chat_id}, исключаю из рассылок")
+
+# ========== РАСПИСАНИЕ ==========
+SCHEDULE_AT = "at"
+SCHEDULE_EVERY = "every"
+SCHEDULE_CRON = "cron"
+
+# Единица интервала - целым словом или известным сокращением: 'every 5 months'
+# не должно читаться как 5 минут по первой букве
+INTERVAL_UNITS = {
+    **dict.fromkeys(("с", "сек", "секунда", "секунды", "секунд", "секунду",
+                     "s", "sec", "secs", "second", "seconds"), 1),
+    **dict.fromkeys(("м", "мин", "минута", "минуты", "минут", "минуту",
+                     "m", "min", "mins", "minute", "minutes"), 60),
+    **dict.fromkeys(("ч", "час", "часа", "часов",
+                     "h", "hr", "hrs", "hour", "hours"), 3600),
+    **dict.fromkeys(("д", "дн", "день", "дня", "дней",
+                     "d", "day", "days"), 86400),
+}
+INTERVAL_RULE = re.compile(r"^(?:каждые|каждый|каждую|every)\s+(\d+)\s*(\w+)$", re.IGNORECASE)
+
+class CronExpression:
+    """Выражение cron из пяти полей: минута час день месяц день_недели.
+
+    Поля: *, число, список (1,15), диапазон (1-5) и шаг (*/10, 8-20/2).
+    Воскресенье - 0 или 7. Если заданы и день месяца, и день недели,
+    подходит любой из них (как в cron).
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"В выражении cron должно быть 5 полей: {expression!r}")
+        self.expression = " ".join(parts)
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(part, low, high) for part, (low, high) in zip(parts, self.FIELDS))
+        self.weekdays = {day % 7 for day in weekdays}
+        self._any_day = parts[2] == "*"
+        self._any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for item in field.split(","):
+            span, _, step = item.partition("/")
+            try:
+                step = int(step) if step else 1
+                if span == "*":
+                    start, end = low, high
+                elif "-" in span:
+                    start, end = (int(value) for value in span.split("-", 1))
+                else:
+                    start = int(span)
+                    end = high if item != span else start
+            except ValueError:
+                raise ValueError(f"Неверное поле cron: {field!r}") from None
+            if step < 1 or not low <= start <= end <= high:
+                raise ValueError(f"Неверное поле cron: {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = moment.isoweekday() % 7 in self.weekdays
+        if self._any_day:
+            return weekday
+        if self._any_weekday:
+            return day
+        return day or weekday
+
+    def next_after(self, timestamp):
+        """Ближайший подходящий момент строго после timestamp (по местному времени)"""
+        moment = datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        last_year = moment.year + 5
+        # Несовпавшее поле перескакивает сразу к следующему месяцу/дню/часу
+        while moment.year <= last_year:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        raise ValueError(f"Выражение cron не срабатывает никогда: {self.expression!r}")
+
+def parse_schedule(text, now=None):
+    """Правило запуска из строки меню -> (вид, значение).
+
+    'ЧЧ:ММ' (сегодня или завтра) и 'ГГГГ-ММ-ДД ЧЧ:ММ' - один раз,
+    'каждые 30м' / 'every 2h' - с интервалом, пять полей - cron.
+    """
+    text = text.strip()
+    now = time.time() if now is None else now
+    match = INTERVAL_RULE.match(text)
+    if match:
+        unit = match.group(2).lower()
+        if unit not in INTERVAL_UNITS:
+            raise ValueError(f"Неизвестная единица интервала: {match.group(2)!r}")
+        seconds = int(match.group(1)) * INTERVAL_UNITS[unit]
+        if seconds <= 0:
+            raise ValueError("Интервал должен быть больше нуля")
+        return SCHEDULE_EVERY, seconds
+    if len(text.split()) == 5:
+        expression = CronExpression(text)
+        # Правило вроде '0 0 30 2 *' разбирается, но не срабатывает никогда
+        expression.next_after(now)
+        return SCHEDULE_CRON, expression.expression
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%H:%M"):
+        try:
+            moment = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt == "%H:%M":
+            today = datetime.fromtimestamp(now)
+            moment = today.replace(hour=moment.hour, minute=moment.minute, second=0, microsecond=0)
+            if moment.timestamp() <= now:
+                moment += timedelta(days=1)
+        return SCHEDULE_AT, moment.timestamp()
+    raise ValueError(f"Не понимаю время запуска: {text!r}")
+
+class Schedule:
+    """Рассылка по расписанию: параметры Campaign.to_spec() и правило запуска.
+
+    Каждый запуск создает новую рассылку из spec. Разовое расписание
+    после запуска удаляется, интервальное сохраняет фазу от первого срока:
+    он хранится в anchor отдельно от next_run, который сдвигают догоняющий
+    запуск и повтор занятого расписания.
+    """
+
+    def __init__(self, spec, kind, value, schedule_id=None, next_run=None, last_run=None, now=None,
+                 anchor=None):
+        self.id = schedule_id or f"sch-{datetime.now():%Y%m%d-%H%M%S}-{random.randrange(16 ** 4):04x}"
+        self.spec = spec
+        self.kind = kind
+        self.last_run = last_run
+        if kind == SCHEDULE_AT:
+            self.value = float(value)
+        elif kind == SCHEDULE_EVERY:
+            self.value = float(value)
+        elif kind == SCHEDULE_CRON:
+            self.value = CronExpression(value)
+        else:
+            raise ValueError(f"Неизвестный вид расписания: {kind}")
+        if next_run is None and last_run is None:
+            next_run = self.first_run(time.time() if now is None else now)
+        self.next_run = next_run
+        if kind == SCHEDULE_EVERY and anchor is None:
+            anchor = next_run if next_run is not None else last_run
+        self.anchor = anchor
+
+    @classmethod
+    def from_row(cls, row):
+        schedule_id, spec, kind, rule, next_run, last_run, anchor = row
+        return cls(spec, kind, rule, schedule_id, next_run, last_run, anchor=anchor)
+
+    @property
+    def rule(self):
+        """Правило для базы"""
+        if self.kind == SCHEDULE_CRON:
+            return self.value.expression
+        return repr(self.value)
+
+    def first_run(self, now):
+        if self.kind == SCHEDULE_AT:
+            return self.value
+        if self.kind == SCHEDULE_EVERY:
+            return now + self.value
+        return self.value.next_after(now)
+
+    def next_after(self, now):
+        """Следующий срок после now (None - больше запусков нет)"""
+        if self.kind == SCHEDULE_AT:
+            return None
+        if self.kind == SCHEDULE_EVERY:
+            base = self.anchor if self.anchor is not None else now
+            if base > now:
+                return base
+            return base + (int((now - base) // self.value) + 1) * self.value
+        return self.value.next_after(now)
+
+    def describe(self):
+        if self.kind == SCHEDULE_AT:
+            return f"один раз {datetime.fromtimestamp(self.value):%Y-%m-%d %H:%M}"
+        if self.kind == SCHEDULE_EVERY:
+            return f"каждые {format_duration(self.value)}"
+        return f"cron {self.value.expression}"
+
+def format_duration(seconds):
+    """3600 -> '1 ч', 90 -> '90 сек'"""
+    for unit, name in ((86400, "дн"), (3600, "ч"), (60, "мин")):
+        if seconds >= unit and seconds % unit == 0:
+            return f"{int(seconds // unit)} {name}"
+    return f"{int(seconds)} сек"
+
+class Scheduler:
+    """Запуск рассылок по расписанию.
+
+    Сроки лежат в мин-куче (срок, id); одна задача спит до ближайшего
+    срока или до изменения расписания, так что каждое расписание стоит
+    одного пробуждения на запуск, а не постоянного опроса. Изменения из
+    меню попадают в цикл через call_soon_threadsafe; при удалении и
+    переносе куча не чистится - устаревшие записи отбрасываются, когда
+    доходят до вершины.
+
+    launch(schedule) запускает рассылку и возвращает False, если запустить
+    сейчас нельзя (прошлый запуск этого расписания еще идет).
+    """
+
+    def __init__(self, store, launch, clock=time.time, grace=SCHEDULE_MISFIRE_GRACE,
+                 busy_retry=SCHEDULE_BUSY_RETRY, max_sleep=SCHEDULE_MAX_SLEEP):
+        self.store = store
+        self.launch = launch
+        self.clock = clock
+        self.grace = grace
+        self.busy_retry = busy_retry
+        self.max_sleep = max_sleep
+        self.schedules = {}
+        # Словарь меняют и меню (add/remove), и цикл (_fire, reconcile)
+        self._lock = threading.Lock()
+        for row in store.load_schedules():
+            try:
+                schedule = Schedule.from_row(row)
+            except ValueError as e:
+                logger.error(f"Расписание {row[0]} пропущено: {e}")
+                continue
+            self.schedules[schedule.id] = schedule
+        self._heap = []
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    def __len__(self):
+        return len(self.schedules)
+
+    def _snapshot(self):
+        with self._lock:
+            return list(self.schedules.values())
+
+    def upcoming(self):
+        """Расписания по возрастанию срока"""
+        return sorted(self._snapshot(), key=lambda s: s.next_run or 0)
+
+    def _save(self, schedule):
+        self.store.save_schedule(schedule.id, schedule.spec, schedule.kind, schedule.rule,
+                                 schedule.next_run, schedule.last_run, schedule.anchor)
+
+    def add(self, schedule):
+        with self._lock:
+            self.schedules[schedule.id] = schedule
+        self._save(schedule)
+        self._notify(schedule)
+        logger.info(f"Расписание {schedule.id}: {schedule.describe()}")
+        return schedule
+
+    def remove(self, schedule_id):
+        with self._lock:
+            removed = self.schedules.pop(schedule_id, None)
+        if removed is not None:
+            self.store.delete_schedule(schedule_id)
+            self._notify()
+
+    def _notify(self, schedule=None):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._push, schedule)
+
+    def _push(self, schedule=None):
+        if schedule is not None and schedule.next_run is not None:
+            heapq.heappush(self._heap, (schedule.next_run, schedule.id))
+        self._wakeup.set()
+
+    def reconcile(self):
+        """Сверить сроки, пропущенные, пока бот не работал.
+
+        Опоздание в пределах grace - один догоняющий запуск сейчас (сколько
+        бы сроков ни было пропущено), больше - запуск пропускается.
+        """
+        now = self.clock()
+        for schedule in self._snapshot():
+            if schedule.next_run is None or schedule.next_run > now:
+                continue
+            missed = f"{datetime.fromtimestamp(schedule.next_run):%Y-%m-%d %H:%M}"
+            if now - schedule.next_run <= self.grace:
+                logger.info(f"Расписание {schedule.id}: пропущенный запуск {missed} выполняется сейчас")
+                schedule.next_run = now
+            else:
+                logger.warning(f"Расписание {schedule.id}: запуск {missed} пропущен")
+                schedule.next_run = self._next_run(schedule, now)
+                if schedule.next_run is None:
+                    self.remove(schedule.id)
+                    continue
+            self._save(schedule)
+
+    @staticmethod
+    def _next_run(schedule, now):
+        """Следующий срок; правило, которое больше не срабатывает, - None"""
+        try:
+            return schedule.next_after(now)
+        except ValueError as e:
+            logger.error(f"Расписание {schedule.id}: {e}, удаляю")
+            return None
+
+    def _fire(self, schedule, now):
+        if self.launch(schedule):
+            logger.info(f"Расписание {schedule.id}: рассылка запущена")
+            schedule.last_run = now
+            schedule.next_run = self._next_run(schedule, now)
+        else:
+            logger.info(f"Расписание {schedule.id}: прошлый запуск еще идет, повтор через {self.busy_retry} сек")
+            schedule.next_run = now + self.busy_retry
+        if schedule.next_run is None:
+            self.remove(schedule.id)
+        else:
+            self._save(schedule)
+            heapq.heappush(self._heap, (schedule.next_run, schedule.id))
+
+    async def run(self):
+        """Основной цикл: спать до ближайшего срока и запускать наступившие"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.current_task()
+        self.reconcile()
+        self._heap = [(s.next_run, s.id) for s in self._snapshot() if s.next_run is not None]
+        heapq.heapify(self._heap)
+        
+        while True:
+            self._wakeup.clear()
+            now = self.clock()
+            while self._heap and self._heap[0][0] <= now:
+                due, schedule_id = heapq.heappop(self._heap)
+                schedule = self.schedules.get(schedule_id)
+                # Запись устарела: расписание удалено или перенесено
+                if schedule is None or schedule.next_run != due:
+                    continue
+                try:
+                    self._fire(schedule, now)
+                except Exception as e:
+                    # Запись уже снята с кучи: без повтора расписание бы пропало
+                    logger.error(f"Расписание {schedule_id}: ошибка запуска: {e}", exc_info=True)
+                    schedule.next_run = now + self.busy_retry
+                    self._save(schedule)
+                    heapq.heappush(self._heap, (schedule.next_run, schedule.id))
+            
+            timeout = None
+            if self._heap:
+                timeout = min(max(self._heap[0][0] - self.clock(), 0), self.max_sleep)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def stop(self):
+        if self._task is not None and self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._task.cancel)
+
+# ========== МЕТРИКИ ==========
+class Histogram:
+    """Гистограмма задержек с фиксированными границами (как в Prometheus)"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+class SendMetrics:
+    """Метрики пути отправки: задержки по этапам, исходы, FloodWait, скорость.
+
+    Этапы: resolve - поиск адресата, network - запрос send_message,
+    persist - запись курсора и статистики, pacing - ожидание темпа.
+    Пишет фоновый цикл, читает HTTP поток и меню, поэтому все под lock.
+    """
+
+    STAGES = ("resolve", "network", "persist", "pacing")
+
+    def __init__(self, limiter=None):
+        self.limiter = limiter
+        self.histograms = {stage: Histogram() for stage in self.STAGES}
+        self.outcomes = {}
+        self.flood_wait_seconds = 0
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.histograms[stage].observe(seconds)
+
+    def timed(self, stage, func):
+        """Обертка func, замеряющая время каждого вызова"""
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(stage, time.perf_counter() - start)
+        return wrapper
+
+    def outcome(self, kind, error=""):
+        """Учесть исход отправки: "ok" или класс ошибки (classify_error) и ее имя"""
+        with self._lock:
+            self.outcomes[(kind, error)] = self.outcomes.get((kind, error), 0) + 1
+
+    def flood_wait(self, seconds):
+        self.outcome(ERROR_RATE_LIMIT, "FloodWaitError")
+        with self._lock:
+            self.flood_wait_seconds += seconds
+
+    def snapshot(self):
+        """Текущие значения в виде словаря (для JSON и меню)"""
+        with self._lock:
+            data = {
+                "latency": {
+                    stage: {
+                        "count": h.count,
+                        "sum": round(h.sum, 6),
+                        "p50": h.quantile(0.5),
+                        "p95": h.quantile(0.95),
+                        "buckets": {str(b): c for b, c in zip(h.buckets + ("+Inf",), h.counts)}
+                    } for stage, h in self.histograms.items()
+                },
+                "outcomes": {f"{kind}:{error}" if error else kind: count
+                             for (kind, error), count in self.outcomes.items()},
+                "flood_wait_seconds": self.flood_wait_seconds
+            }
+        if self.limiter:
+            data["rate"] = round(self.limiter.achieved_rate(), 3)
+            data["target_rate"] = round(self.limiter.rate, 3)
+            data["max_rate"] = round(self.limiter.max_rate, 3)
+        return data
+
+    def render_prometheus(self):
+        """Текстовый формат Prometheus"""
+        lines = ["# HELP sender_stage_seconds Time spent per send stage",
+                 "# TYPE sender_stage_seconds histogram"]
+        with self._lock:
+            for stage, h in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(h.buckets + ("+Inf",), h.counts):
+                    cumulative += count
+                    lines.append(f'sender_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'sender_stage_seconds_sum{{stage="{stage}"}} {h.sum}')
+                lines.append(f'sender_stage_seconds_count{{stage="{stage}"}} {h.count}')
+            lines += ["# HELP sender_sends_total Send attempts by outcome",
+                      "# TYPE sender_sends_total counter"]
+            for (kind, error), count in sorted(self.outcomes.items()):
+                lines.append(f'sender_sends_total{{outcome="{kind}",error="{error}"}} {count}')
+            lines += ["# HELP sender_flood_wait_seconds_total Seconds of FloodWait requested by the server",
+                      "# TYPE sender_flood_wait_seconds_total counter",
+                      f"sender_flood_wait_seconds_total {self.flood_wait_seconds}"]
+        if self.limiter:
+            for name, value, help_text in (
+                    ("sender_send_rate", self.limiter.achieved_rate(), "Achieved send rate, msgs/sec"),
+                    ("sender_target_rate", self.limiter.rate, "Current target send rate, msgs/sec"),
+                    ("sender_max_rate", self.limiter.max_rate, "Upper bound for the send rate, msgs/sec")):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    """HTTP на localhost: /metrics - Prometheus, /metrics.json - JSON снимок"""
+
+    def __init__(self, metrics, port=METRICS_PORT, host="127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics_ref = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path == "/metrics":
+                    body = metrics_ref.render_prometheus().encode()
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                elif path == "/metrics.json":
+                    body = json.dumps(metrics_ref.snapshot(), ensure_ascii=False).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True)
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
 
 # ========== КЛАСС БОТА ==========
 class TelegramSender:
-    def __init__(self):
+    def __init__(self, runner=None):
         self.client = None
         self.config = load_json(CONFIG_FILE, {})
         self.me = None
+        self.runner = runner
+        self.connecting = None
+        self.needs_login = False
+        self._scheduler_wanted = False
+        self.campaigns = CampaignManager(runner, self.mass_send)
+        # Нулевая задержка - без паузы: темп тогда задает max_send_rate
+        delay = self.config.get("default_delay", 2)
+        max_rate = self.config.get("max_send_rate")
+        self.limiter = RateLimiter(1 / delay if delay > 0 else max_rate or 1 / 2, max_rate)
+        self.peer_cache = PeerCache()
+        self.metrics = SendMetrics(self.limiter)
+        self.metrics_server = None
         
         # Загрузка данных
-        self.chats = load_json(CHATS_FILE, [])
-        self.favorites = load_json(FAVORITES_FILE, [])
-        self.folders = load_json(FOLDERS_FILE, {"default": []})
-        self.templates = load_json(TEMPLATES_FILE, {})
-        self.stats = load_json(STATS_FILE, {"total_sent": 0, "total_errors": 0, "last_active": ""})
-        self.blacklist = load_json(BLACKLIST_FILE, [])
+        self.store = DataStore(DB_FILE)
+        create_default_files(self.store)
+        
+        self.registry = ChatRegistry(self.store)
+        self.templates = self.store.load_templates()
+        self.template_cache = TemplateCache()
+        self.stats = {"total_sent": 0, "total_errors": 0, "last_active": ""}
+        self.stats.update(self.store.load_stats())
+        
+        self.stats_writer = StatsWriter(self.stats, self.metrics.timed("persist", self.store.save_stats))
+        self.delivery = DeliveryLog(self.store)
+        self.scheduler = Scheduler(self.store, self.launch_scheduled)
+        atexit.register(self.stats_writer.flush)
         
-        create_default_files()
+        # Аккаунт из прошлого входа: меню показывает его, не дожидаясь сети
+        cached_me = self.store.get_meta("me")
+        if cached_me:
+            self.me = SimpleNamespace(**json.loads(cached_me))
+
+    # --- изменение данных (каждое - одна запись в базу) ---
+    def save_template(self, name, text):
+        if name in self.templates:
+            self.template_cache.invalidate(self.templates[name])
+        self.templates[name] = text
+        self.store.save_template(name, text)
+
+    def delete_template(self, name):
+        self.template_cache.invalidate(self.templates.pop(name))
+        self.store.delete_template(name)
+
+    def start_metrics_server(self):
+        """Поднять HTTP с метриками, если порт не выключен в настройках"""
+        port = self.config.get("metrics_port", METRICS_PORT)
+        if not port:
+            return None
+        try:
+            self.metrics_server = MetricsServer(self.metrics, port).start()
+            logger.info(f"Метрики: {self.metrics_server.address}")
+        except OSError as e:
+            logger.warning(f"Не удалось открыть порт метрик {port}: {e}")
+        return self.metrics_server
 
-    async def connect(self):
-        """Подключение к Telegram"""
+    async def connect(self, interactive=True):
+        """Подключение к Telegram (interactive=False - без запроса кода и пароля)"""
         if not self.config.get("api_id") or not self.config.get("api_hash"):
             return False
         
         try:
-            session_name = "telegram_sender"
-            self.client = TelegramClient(session_name, self.config["api_id"], self.config["api_hash"])
+            load_telethon()
+            if self.client is not None:
+                # Повторное подключение: сессия не должна быть открыта дважды
+                await self.client.disconnect()
+            # flood_sleep_threshold=0: Telethon не ждет FloodWait сам, каждое
+            # ожидание проходит через общий лимитер (пауза всех рассылок, снижение темпа)
+            self.client = TelegramClient(SESSION_NAME, self.config["api_id"], self.config["api_hash"],
+                                         flood_sleep_threshold=0)
             
             # Проверяем существование сессии
-            if os.path.exists(f"{session_name}.session"):
+            if interactive and os.path.exists(f"{SESSION_NAME}.session"):
                 await self.client.start()
             else:
                 await self.client.connect()
                 
                 if not await self.client.is_user_authorized():
+                    if not interactive:
+                        # Сессия отозвана: следующий запуск и ensure_connected
+                        # уйдут на вход с запросом кода
+                        logger.error("Сессия не авторизована: войдите через интерактивный режим")
+                        self.needs_login = True
+                        self.store.set_meta("me", "")
+                        return False
                     print("\n📱 ВХОД В ТЕЛЕГРАМ")
                     print("=" * 40)
                     phone = input("📞 Введите номер телефона (с кодом страны): ").strip()
@@ -166,6 +3077,10 @@ class TelegramSender:
                         await self.client.sign_in(password=password)
             
             self.me = await self.client.get_me()
+            self.needs_login = False
+            self.store.set_meta("me", json.dumps({"id": self.me.id, "first_name": self.me.first_name,
+                                                  "username": self.me.username}, ensure_ascii=False))
+            ChatEventSubscriber(self).attach(self.client)
             logger.info(f"Успешный вход: {self.me.first_name} (@{self.me.username})")
             return True
             
@@ -173,25 +3088,93 @@ class TelegramSender:
             logger.error(f"Ошибка подключения: {e}")
             return False
 
+    def connect_in_background(self, profile=None, interactive=False):
+        """Подключиться и обновить чаты в фоне, пока меню работает с базой.
+
+        Без interactive - только для уже авторизованной сессии: вход с
+        кодом требует ввода. Результат подключения - в self.connecting
+        (см. wait_connected); он есть всегда, даже если подключение упало.
+        Вызывается повторно, если прошлое подключение не удалось.
+        """
+        profile = profile or StartupProfile()
+        connecting = self.connecting = concurrent.futures.Future()
+        
+        async def start():
+            connected = False
+            try:
+                with profile.span("импорт Telethon"):
+                    load_telethon()
+                with profile.span("подключение"):
+                    connected = await self.connect(interactive)
+            except Exception as e:
+                logger.error(f"Ошибка подключения: {e}")
+            finally:
+                connecting.set_result(connected)
+            if connected:
+                if self._scheduler_wanted and not self.scheduler.running:
+                    asyncio.ensure_future(self.scheduler.run())
+                with profile.span("синхронизация чатов"):
+                    await self.sync_chats()
+        
+        self.runner.submit(start())
+        return connecting
+
+    def wait_connected(self, timeout=None):
+        """Дождаться фонового подключения: True, если клиент готов"""
+        if self.connecting is not None:
+            return self.connecting.result(timeout)
+        return self.client is not None
+
+    @staticmethod
+    def _dialog_info(dialog):
+        """Данные диалога для реестра (None - если диалог не подходит)"""
+        if not (dialog.is_group or dialog.is_channel or dialog.is_user):
+            return None
+        load_telethon()
+        input_peer = utils.get_input_peer(dialog.entity)
+        return {
+            "id": dialog.id,
+            "title": getattr(dialog.entity, 'title', ''),
+            # Для личных чатов title пуст: имя собеседника нужно подстановке {name}
+            "name": dialog.name or "",
+            "username": getattr(dialog.entity, 'username', ''),
+            "type": "channel" if dialog.is_channel else "group" if dialog.is_group else "user",
+            "access_hash": getattr(input_peer, 'access_hash', None),
+            "top_message": dialog.dialog.top_message,
+            "writable": can_write(dialog.entity)
+        }
+
+    async def _with_flood_wait(self, call, what):
+        """Запрос вне отправки: FloodWait учесть в лимитере, переждать и повторить"""
+        load_telethon()
+        for attempt in range(1, MAX_FLOOD_WAITS + 1):
+            try:
+                return await call()
+            except FloodWaitError as e:
+                if attempt == MAX_FLOOD_WAITS:
+                    raise
+                logger.warning(f"FloodWait {e.seconds} сек: {what}")
+                self.limiter.on_flood_wait(e.seconds)
+                self.metrics.flood_wait(e.seconds)
+                await asyncio.sleep(e.seconds)
+
     async def get_chats(self):
-        """Получение списка диалогов"""
+        """Получение полного списка диалогов"""
+        async def read_dialogs():
+            chats = []
+            async for dialog in self.client.iter_dialogs():
+                chat_info = self._dialog_info(dialog)
+                if chat_info:
+                    chats.append(chat_info)
+            return chats
+        
         try:
-            dialogs = await self.client.get_dialogs()
-            chats_list = []
-            
-            for dialog in dialogs:
-                if dialog.is_group or dialog.is_channel or dialog.is_user:
-                    chat_info = {
-                        "id": dialog.id,
-                        "title": getattr(dialog.entity, 'title', ''),
-                        "username": getattr(dialog.entity, 'username', ''),
-                        "type": "channel" if dialog.is_channel else "group" if dialog.is_group else "user"
-                    }
-                    chats_list.append(chat_info)
+            chats_list = await self._with_flood_wait(read_dialogs, "список диалогов")
             
-            # Сохраняем в файл
-            self.chats = chats_list
-            save_json(CHATS_FILE, chats_list)
+            # Сохраняем в базу
+            self.registry.replace(chats_list)
+            self.store.set_meta("dialogs_synced", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            self.store.set_meta("dialogs_full_synced", str(time.time()))
             
             return chats_list
             
@@ -199,106 +3182,487 @@ class TelegramSender:
             logger.error(f"Ошибка получения чатов: {e}")
             return []
 
-    async def send_message(self, chat_id, text, retries=3):
-        """Отправка сообщения с повторными попытками"""
-        global sent_count, error_count
+    async def sync_chats(self):
+        """Инкрементальная синхронизация диалогов.
+
+        Диалоги приходят от новых к старым; как только встречается
+        незакрепленный диалог с тем же top_message, что и в реестре,
+        дальше все без изменений и чтение останавливается.
+
+        Покинутые и удаленные диалоги так не видны (их просто нет в
+        выдаче), поэтому раз в CHATS_FULL_SYNC_INTERVAL вместо
+        инкрементальной идет полная синхронизация get_chats, которая
+        убирает их из реестра.
+        """
+        full_synced = float(self.store.get_meta("dialogs_full_synced") or 0)
+        if (not self.registry or not self.store.get_meta("dialogs_synced")
+                or time.time() - full_synced > CHATS_FULL_SYNC_INTERVAL):
+            return await self.get_chats()
+        
+        async def read_changed():
+            changed = []
+            async for dialog in self.client.iter_dialogs():
+                chat_info = self._dialog_info(dialog)
+                if not chat_info:
+                    continue
+                known = self.registry.chats.get(chat_info["id"])
+                if known and known.get("top_message") == chat_info["top_message"]:
+                    if dialog.pinned:
+                        continue
+                    break
+                changed.append(chat_info)
+            return changed
+        
+        try:
+            changed = await self._with_flood_wait(read_changed, "синхронизация диалогов")
+            self.registry.merge_recent(changed)
+            self.store.set_meta("dialogs_synced", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            logger.info(f"Синхронизация чатов: обновлено {len(changed)}")
+            return changed
+            
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации чатов: {e}")
+            return []
+
+    async def resolve_peer(self, target):
+        """InputPeer для ID/username/ссылки: реестр, затем LRU кэш, затем сервер"""
+        chat_id = normalize_chat_id(target)
+        if chat_id is not None:
+            peer = self.registry.input_peer(chat_id)
+            if peer is not None:
+                return peer
+        key = peer_cache_key(target)
+        peer = self.peer_cache.get(key)
+        if peer is None:
+            start = time.perf_counter()
+            try:
+                peer = await self.client.get_input_entity(chat_id if chat_id is not None else target)
+            except ValueError as e:
+                # Только здесь ValueError значит "адресата нет" - это ошибка чата
+                raise PeerNotFoundError(str(e)) from e
+            finally:
+                self.metrics.observe("resolve", time.perf_counter() - start)
+            self.peer_cache.put(key, peer)
+        return peer
+
+    def lookup_target(self, target):
+        """ID чата адресата из реестра или кэша без запросов к серверу (None - если нужен сервер)"""
+        if isinstance(target, int):
+            if target in self.registry.chats or self.peer_cache.get(peer_cache_key(target)) is not None:
+                return target
+            return None
+        chat_id = self.registry.find_username(target)
+        if chat_id is None:
+            peer = self.peer_cache.get(target)
+            if peer is not None:
+                chat_id = utils.get_peer_id(peer)
+        return chat_id
+
+    async def resolve_targets(self, targets, invalid=None, concurrency=RESOLVE_CONCURRENCY):
+        """Найти всех адресатов до рассылки. Возвращает ResolveReport.
+
+        Сначала реестр и кэш, остальные - с сервера: не больше concurrency
+        запросов сразу и не чаще RESOLVE_RATE в секунду. FloodWait ставит на
+        паузу все запросы и повторяет адресата; слишком долгий - оставшиеся
+        адресаты попадают в ненайденные. Найденные с сервера кладутся в кэш:
+        пока они там (последние PEER_CACHE_SIZE), warm_up их уже не ищет,
+        вытесненных он снова запросит через get_input_entity.
+        """
+        targets = list(dict.fromkeys(targets))
+        report = ResolveReport(targets, invalid)
+        pending = deque()
+        for target in targets:
+            chat_id = self.lookup_target(target)
+            if chat_id is None:
+                pending.append(target)
+            else:
+                report.resolved[target] = chat_id
+                report.cached += 1
+        if not pending:
+            return report
         
-        for attempt in range(retries):
+        limiter = RateLimiter(RESOLVE_RATE, clock=self.limiter.clock)
+        
+        async def worker():
+            while pending:
+                target = pending.popleft()
+                await limiter.acquire()
+                start = time.perf_counter()
+                try:
+                    entity = await self.client.get_entity(target)
+                except FloodWaitError as e:
+                    if e.seconds > RESOLVE_MAX_FLOOD:
+                        reason = f"FloodWait {e.seconds} с, поиск прерван"
+                        report.failed[ResolveReport.label(target)] = reason
+                        report.failed.update((ResolveReport.label(t), reason) for t in pending)
+                        pending.clear()
+                    else:
+                        logger.warning(f"FloodWait при поиске адресатов: пауза {e.seconds} с")
+                        limiter.on_flood_wait(e.seconds)
+                        pending.append(target)
+                    continue
+                except Exception as e:
+                    report.failed[ResolveReport.label(target)] = str(e) or type(e).__name__
+                    continue
+                finally:
+                    self.metrics.observe("resolve", time.perf_counter() - start)
+                if not can_write(entity):
+                    report.failed[ResolveReport.label(target)] = "нет права писать в чат"
+                    continue
+                chat_id = utils.get_peer_id(entity)
+                peer = utils.get_input_peer(entity, allow_self=True, check_hash=False)
+                self.peer_cache.put(peer_cache_key(chat_id), peer)
+                if isinstance(target, str):
+                    self.peer_cache.put(target, peer)
+                report.resolved[target] = chat_id
+        
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(pending)))))
+        logger.info(f"Поиск адресатов: {report.summary()}")
+        return report
+
+    async def warm_up(self, targets):
+        """Разрешить всех адресатов до начала рассылки. Возвращает {цель: InputPeer}"""
+        peers = {}
+        for target in targets:
             try:
-                await self.client.send_message(chat_id, text)
-                sent_count += 1
-                self.stats["total_sent"] += 1
-                save_json(STATS_FILE, self.stats)
+                peers[target] = await self._with_flood_wait(lambda: self.resolve_peer(target),
+                                                            f"поиск чата {target}")
+            except Exception as e:
+                if classify_error(e) == ERROR_ACCOUNT:
+                    raise AccountError(f"{type(e).__name__}: {e}") from e
+                logger.warning(f"Не удалось найти чат {target}: {e}")
+                if is_chat_error(e) and isinstance(target, int):
+                    self.registry.quarantine.record_failure(target, type(e).__name__, permanent=True)
+        return peers
+
+    async def send_message(self, chat_id, text, retries=3, peer=None, campaign=None, media=None):
+        """Отправка сообщения с повтором по классу ошибки.
+
+        transient - повтор с экспоненциальной паузой, rate_limit - FloodWait
+        ставит на паузу лимитер и не тратит попытку, permanent - без повтора.
+        Неудачи учитываются в карантине чата, каждая попытка - в журнале доставки.
+        text - строка или CompiledTemplate, подстановки заполняются для
+        chat_id (длинный текст уходит несколькими сообщениями); media -
+        MediaAttachment, первая часть тогда уходит подписью к файлу.
+        """
+        campaign_id = campaign.id if campaign else None
+        try:
+            if not isinstance(text, CompiledTemplate):
+                text = self.template_cache.get(text, media is not None)
+            if text.fields:
+                text = text.render(template_context(self.registry.get(chat_id), campaign))
+            else:
+                text = text.parts
+        except ValueError as e:
+            logger.error(f"Сообщение в {chat_id} не отправлено: {e}")
+            return False
+        attempt = 0
+        part = 0
+        flood_waits = 0
+        failure = None
+        # Пока в чат не ушло ни одной части, остановка рассылки обрывает ожидания
+        interruptible = campaign.interruptible if campaign is not None else nullcontext()
+        while attempt < retries:
+            start = time.perf_counter()
+            with interruptible if part == 0 else nullcontext():
+                await self.limiter.acquire(campaign)
+            self.metrics.observe("pacing", time.perf_counter() - start)
+            attempt_start = time.perf_counter()
+            try:
+                if peer is None:
+                    peer = await self.resolve_peer(chat_id)
+                body, entities = text[part]
+                start = time.perf_counter()
+                try:
+                    if media is not None and part == 0:
+                        message = await self.client.send_message(peer, body, formatting_entities=entities,
+                                                                 file=media.ref())
+                        media.remember(message)
+                    else:
+                        message = await self.client.send_message(peer, body, formatting_entities=entities)
+                finally:
+                    self.metrics.observe("network", time.perf_counter() - start)
+                self._record_delivery(campaign_id, chat_id, attempt_start, "ok",
+                                      message_id=getattr(message, 'id', None))
+                self.limiter.on_success()
+                part += 1
+                if part < len(text):
+                    continue
+                self.registry.quarantine.record_success(chat_id)
+                self.metrics.outcome("ok")
+                self.stats_writer.incr("total_sent")
                 logger.info(f"Сообщение отправлено в {chat_id}")
                 return True
                 
+            except FloodWaitError as e:
+                # FloodWait не тратит попытку: ждем ровно столько, сколько сказал сервер
+                flood_waits += 1
+                self._record_delivery(campaign_id, chat_id, attempt_start, ERROR_RATE_LIMIT, "FloodWaitError")
+                self.limiter.on_flood_wait(e.seconds, chat_id)
+                self.metrics.flood_wait(e.seconds)
+                self.stats_writer.incr("flood_waits")
+                self.stats_writer.incr("flood_wait_seconds", e.seconds)
+                logger.warning(f"FloodWait {e.seconds} сек при отправке в {chat_id}")
+                if flood_waits >= MAX_FLOOD_WAITS:
+                    break
+                
             except Exception as e:
-                logger.warning(f"Попытка {attempt + 1}/{retries} не удалась: {e}")
-                if attempt < retries - 1:
-                    await asyncio.sleep(2)
+                if media is not None and media.expired(e):
+                    continue
+                kind = classify_error(e)
+                self.metrics.outcome(kind, type(e).__name__)
+                self._record_delivery(campaign_id, chat_id, attempt_start, kind, type(e).__name__)
+                if kind == ERROR_ACCOUNT:
+                    raise AccountError(f"{type(e).__name__}: {e}") from e
+                if kind == ERROR_PERMANENT:
+                    logger.warning(f"Постоянная ошибка при отправке в {chat_id}: {e}")
+                    if is_chat_error(e):
+                        failure = (type(e).__name__, True)
+                    break
+                if kind == ERROR_RATE_LIMIT:
+                    # Медленный режим или спам-ограничение: повтор сейчас не пройдет
+                    logger.warning(f"Ограничение скорости при отправке в {chat_id}: {e}")
+                    break
+                attempt += 1
+                failure = (type(e).__name__, False)
+                logger.warning(f"Попытка {attempt}/{retries} не удалась: {e}")
+                if attempt < retries:
+                    with interruptible if part == 0 else nullcontext():
+                        await asyncio.sleep(backoff_delay(attempt))
         
-        error_count += 1
-        self.stats["total_errors"] += 1
-        save_json(STATS_FILE, self.stats)
+        self.stats_writer.incr("total_errors")
+        if failure:
+            self.registry.quarantine.record_failure(chat_id, *failure)
         logger.error(f"Не удалось отправить в {chat_id}")
         return False
 
-    async def mass_send(self, chat_ids, text, delay=2, infinite=False, cycles=1, cycle_delay=5):
-        """Массовая рассылка"""
-        global sending_active, start_time
-        
-        sending_active = True
-        start_time = time.time()
-        
-        cycle_count = 0
-        total_cycles = 0 if infinite else cycles
+    def _record_delivery(self, campaign_id, chat_id, started, outcome, error="", message_id=None):
+        start = time.perf_counter()
+        self.delivery.record(campaign_id, chat_id, outcome, error, message_id, start - started)
+        self.metrics.observe("persist", time.perf_counter() - start)
+
+    async def mass_send(self, campaign):
+        """Массовая рассылка с сохранением курсора для продолжения"""
+        campaign.bind(asyncio.get_running_loop())
+        rate = 1 / campaign.delay if campaign.delay > 0 else self.limiter.max_rate
+        # Первая рассылка задает темп заново, следующие только поднимают его:
+        # расписание и FloodWait общие для всего аккаунта
+        if any(other is not campaign for other in self.campaigns.active()):
+            self.limiter.allow(rate, self.config.get("max_send_rate"))
+        else:
+            self.limiter.configure(rate, self.config.get("max_send_rate"))
+        campaign.pacer = RateLimiter(rate, clock=self.limiter.clock)
+        self.store.save_campaign(campaign.id, campaign.to_spec(), "running")
+        journal = CampaignJournal(campaign.id)
+        journal_append = self.metrics.timed("persist", journal.append)
+        status = "stopped"
         
         try:
-            while sending_active and (infinite or cycle_count < cycles):
-                cycle_count += 1
+            # Разметка разбирается и проверяется по длине до первой отправки
+            messages = campaign.prepare(self.template_cache)
+            self._refresh_targets(campaign)
+            
+            # Все адресаты разрешаются заранее, в цикле отправки запросов нет
+            with campaign.interruptible:
+                peers = await self.warm_up(self.registry.filter_targets(campaign.chat_ids))
+            
+            # Файл загружается один раз на всю рассылку
+            media = None
+            if campaign.media:
+                media = MediaAttachment(campaign.media)
+                with campaign.interruptible:
+                    await self._with_flood_wait(lambda: media.upload(self.client), "загрузка файла")
+            
+            while campaign.active and (campaign.infinite or campaign.cycle <= campaign.cycles):
+                if not campaign.infinite:
+                    logger.info(f"Цикл {campaign.cycle}/{campaign.cycles}")
                 
-                if not infinite:
-                    print(f"\n📦 Цикл {cycle_count}/{cycles}")
+                # Пропускаем черный список
+                allowed = peers.keys() & set(self.registry.filter_targets(campaign.chat_ids))
                 
-                for i, chat_id in enumerate(chat_ids):
-                    if not sending_active:
+                for index in range(campaign.index, len(campaign.chat_ids)):
+                    if not await campaign.checkpoint():
                         break
                     
-                    # Пропускаем черный список
-                    if str(chat_id) in self.blacklist:
-                        continue
-                    
-                    print(f"[{i+1}/{len(chat_ids)}] Отправка в {chat_id}...")
-                    
-                    # Рандомизация текста
-                    if isinstance(text, list):
-                        message_text = random.choice(text)
-                    else:
-                        message_text = text
+                    chat_id = campaign.chat_ids[index]
+                    if chat_id in allowed:
+                        # Рандомизация текста (варианты уже разобраны)
+                        message_text = random.choice(messages) if len(messages) > 1 else messages[0]
+                        
+                        # Свой темп рассылки, затем слот общего лимитера (внутри send_message);
+                        # оба ожидания идут в метрику pacing
+                        start = time.perf_counter()
+                        with campaign.interruptible:
+                            await campaign.pacer.acquire()
+                        self.metrics.observe("pacing", time.perf_counter() - start)
+                        campaign.record(await self.send_message(chat_id, message_text, peer=peers[chat_id],
+                                                                campaign=campaign, media=media))
                     
-                    await self.send_message(chat_id, message_text)
-                    
-                    if i < len(chat_ids) - 1 and sending_active:
-                        await asyncio.sleep(delay)
+                    campaign.index = index + 1
+                    if chat_id in allowed:
+                        journal_append(campaign.cycle, campaign.index)
+                
+                if not campaign.active:
+                    break
+                
+                logger.info(f"Скорость: {self.limiter.achieved_rate():.2f} из "
+                            f"{self.limiter.rate:.2f} сообщ/сек")
+                
+                campaign.cycle += 1
+                campaign.index = 0
+                journal.append(campaign.cycle, campaign.index)
+                if self._refresh_targets(campaign):
+                    with campaign.interruptible:
+                        peers.update(await self.warm_up(
+                            [cid for cid in self.registry.filter_targets(campaign.chat_ids) if cid not in peers]))
                 
                 # Пауза между циклами
-                if sending_active and (infinite or cycle_count < cycles):
-                    print(f"\n⏸️ Пауза между циклами: {cycle_delay} сек...")
-                    for sec in range(cycle_delay, 0, -1):
-                        if not sending_active:
-                            break
-                        print(f"⏳ {sec}...", end='\r')
-                        await asyncio.sleep(1)
-                    print()
+                if campaign.active and (campaign.infinite or campaign.cycle <= campaign.cycles):
+                    logger.info(f"Пауза между циклами: {campaign.cycle_delay} сек")
+                    await campaign.wait(campaign.cycle_delay)
             
-            print("\n✅ Рассылка завершена!")
+            if not campaign.infinite and campaign.cycle > campaign.cycles:
+                status = "done"
+                logger.info("Рассылка завершена")
             
+        except asyncio.CancelledError:
+            # Остановка оборвала ожидание; отмена задачи извне - дальше
+            if campaign.active:
+                raise
+            logger.info("Рассылка остановлена во время ожидания")
+        
+        except AccountError as e:
+            # Курсор стоит на чате, где случилась ошибка: после входа рассылку можно продолжить
+            logger.error(f"Рассылка {campaign.id} остановлена, аккаунт недоступен: {e}")
+        
         except Exception as e:
             logger.error(f"Ошибка в массовой рассылке: {e}")
-            print(f"\n❌ Ошибка: {e}")
         
         finally:
-            sending_active = False
-            self.stats["last_active"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            save_json(STATS_FILE, self.stats)
+            campaign.stop()
+            if campaign.cancelled:
+                status = "cancelled"
+            if status == "done":
+                journal.remove()
+            else:
+                journal.close()
+            self.store.set_campaign_status(campaign.id, status)
+            self.delivery.flush()
+            self.stats_writer.set("last_active", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            self.stats_writer.flush()
+
+    def _refresh_targets(self, campaign):
+        """Рассылка по правилу: пересчитать цели в начале цикла. True - если пересчитаны"""
+        if not campaign.query or campaign.index:
+            return False
+        try:
+            campaign.chat_ids = TargetQuery(campaign.query).ids(self.registry)
+        except ValueError as e:
+            logger.error(f"Правило выборки {campaign.query!r}: {e}, цели не изменены")
+            return False
+        self.store.save_campaign(campaign.id, campaign.to_spec(), "running")
+        logger.info(f"Цели по правилу {campaign.query!r}: {len(campaign.chat_ids)}")
+        return True
+
+    def load_campaign(self, campaign_id):
+        """Восстановить рассылку из базы с курсором из журнала"""
+        spec = self.store.load_campaign(campaign_id)
+        if spec is None:
+            return None
+        return Campaign.from_spec(campaign_id, spec, CampaignJournal(campaign_id).load())
+
+    def start_campaign(self, campaign):
+        """Запустить рассылку в фоновом цикле рядом с уже идущими"""
+        return self.campaigns.start(campaign)
+
+    def launch_scheduled(self, schedule):
+        """Запустить рассылку по расписанию (False - прошлый запуск еще идет)"""
+        if any(campaign.schedule_id == schedule.id for campaign in self.campaigns.active()):
+            return False
+        campaign = Campaign.from_spec(None, schedule.spec)
+        campaign.schedule_id = schedule.id
+        self.start_campaign(campaign)
+        return True
+
+    def start_scheduler(self):
+        """Запустить планировщик в фоновом цикле, когда будет подключение.
+
+        Если фоновое подключение еще идет или не удалось, планировщик
+        запустит connect_in_background после удачного подключения.
+        """
+        async def run():
+            self._scheduler_wanted = True
+            connecting = self.connecting
+            if connecting is not None and not (connecting.done() and connecting.result()):
+                return
+            if not self.scheduler.running:
+                await self.scheduler.run()
+        
+        return self.runner.submit(run())
+
+    async def _disconnect(self):
+        # disconnect() нужно вызывать в потоке цикла: вне его Telethon
+        # пытается отключиться на чужом, не запущенном цикле
+        await self.client.disconnect()
+
+    def shutdown(self, timeout=10):
+        """Остановить рассылку, сохранить данные и закрыть фоновый цикл"""
+        self.campaigns.stop_all()
+        if not self.campaigns.wait(timeout):
+            logger.error("Рассылки не завершились за отведенное время")
+        self.scheduler.stop()
+        self.stats_writer.flush()
+        self.delivery.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.runner:
+            if self.client:
+                try:
+                    self.runner.run(self._disconnect(), timeout)
+                except Exception as e:
+                    logger.error(f"Ошибка отключения: {e}")
+            self.runner.stop()
 
 # ========== ФУНКЦИИ ИНТЕРФЕЙСА ==========
+def ensure_connected(bot):
+    """Перед действием с сетью дождаться фонового подключения.
+
+    Неудавшееся подключение повторяется, а отозванная сессия ведет
+    к входу с запросом номера и кода.
+    """
+    if bot.connecting is not None and not bot.connecting.done():
+        print("📡 Подключение к Telegram...")
+    if bot.wait_connected():
+        return True
+    if bot.connecting is not None:
+        if bot.needs_login:
+            print("\n🔑 Сессия больше не действует, нужно войти заново")
+        else:
+            print("📡 Повторное подключение к Telegram...")
+        if bot.connect_in_background(interactive=bot.needs_login).result():
+            return True
+    print("\n❌ Нет подключения к Telegram! Подробности в логе")
+    time.sleep(2)
+    return False
+
 def show_main_menu(bot):
     """Главное меню"""
     while True:
-        print_header()
+        print_header(bot=bot)
         
         menu_options = [
             "[1] 📋 Мои чаты",
             "[2] 📤 Отправить одно сообщение",
             "[3] 🚀 Обычная рассылка", 
             "[4] ♾️ БЕСКОНЕЧНАЯ рассылка",
-            "[5] 🛑 Остановить рассылку",
+            "[5] 🎛️ Рассылки: пауза/стоп",
             "[6] 📁 Папки с чатами",
             "[7] 💾 Избранные чаты",
             "[8] 📝 Шаблоны текстов",
             "[9] 📊 Статистика",
             "[0] ⚙️ Настройки",
+            "[r] ⏯️ Продолжить рассылку",
+            "[s] ⏰ Расписание",
             "[x] 🚪 Выход"
         ]
         
@@ -316,7 +3680,7 @@ def show_main_menu(bot):
         elif choice == '4':
             start_mass_send(bot, infinite=True)
         elif choice == '5':
-            stop_sending()
+            manage_campaigns(bot)
         elif choice == '6':
             manage_folders(bot)
         elif choice == '7':
@@ -327,9 +3691,13 @@ def show_main_menu(bot):
             show_statistics(bot)
         elif choice == '0':
             show_settings(bot)
+        elif choice == 'r':
+            resume_campaign(bot)
+        elif choice == 's':
+            manage_schedules(bot)
         elif choice == 'x':
             print("\n👋 Выход...")
-            stop_sending()
+            stop_sending(bot)
             time.sleep(2)
             sys.exit(0)
         else:
@@ -338,26 +3706,32 @@ def show_main_menu(bot):
 
 def show_my_chats(bot):
     """Показать мои чаты"""
-    print_header("📋 МОИ ЧАТЫ")
+    print_header("📋 МОИ ЧАТЫ", bot)
     
-    if not bot.chats:
+    if not bot.registry:
         print("\n📭 Чатов нет. Загружаю...")
-        asyncio.run(bot.get_chats())
+        if not ensure_connected(bot):
+            return
+        bot.runner.run(bot.get_chats())
     
-    for i, chat in enumerate(bot.chats[:50], 1):  # Показываем первые 50
-        fav_icon = "⭐" if str(chat["id"]) in bot.favorites else "  "
-        print(f"{i:3}. {fav_icon} {chat['title'][:30]:30} ({chat['type']}) ID: {chat['id']}")
+    for i, chat in enumerate(bot.registry.head(50), 1):  # Показываем первые 50
+        fav_icon = "⭐" if bot.registry.is_favorite(chat["id"]) else "  "
+        lock_icon = "" if chat.get("writable", True) else " 🔒"
+        print(f"{i:3}. {fav_icon} {chat['title'][:30]:30} ({chat['type']}) ID: {chat['id']}{lock_icon}")
     
-    if len(bot.chats) > 50:
-        print(f"\n... и еще {len(bot.chats) - 50} чатов")
+    if len(bot.registry) > 50:
+        print(f"\n... и еще {len(bot.registry) - 50} чатов")
     
-    print(f"\n📊 Всего чатов: {len(bot.chats)}")
+    print(f"\n📊 Всего чатов: {len(bot.registry)}")
     
-    input("\n↵ Нажмите Enter для возврата...")
+    choice = input("\n↵ Enter - назад, r - полностью обновить список: ").strip().lower()
+    if choice == 'r' and ensure_connected(bot):
+        print("⏳ Обновляю...")
+        bot.runner.run(bot.get_chats())
 
 def send_single_message(bot):
     """Отправить одно сообщение"""
-    print_header("📤 ОТПРАВКА СООБЩЕНИЯ")
+    print_header("📤 ОТПРАВКА СООБЩЕНИЯ", bot)
     
     print("🎯 Куда отправить?")
     print("1. По ID чата")
@@ -365,7 +3739,31 @@ def send_single_message(bot):
     print("3. По ссылке (t.me/channel)")
     choice = input("\nВыберите: ").strip()
     
-    chat_input = input("Введите ID/username/ссылку: ").strip()
+    prompts = {
+        '1': "Введите ID чата (у групп и каналов - с минусом): ",
+        '2': "Введите username: ",
+        '3': "Введите ссылку: "
+    }
+    if choice not in prompts:
+        print("\n❌ Неверный выбор!")
+        time.sleep(2)
+        return
+    
+    try:
+        target = parse_target(input(prompts[choice]))
+    except ValueError as e:
+        print(f"\n❌ {e}")
+        time.sleep(2)
+        return
+    if choice == '1' and not isinstance(target, int):
+        print("\n❌ Это не ID чата")
+        time.sleep(2)
+        return
+    if choice == '2' and not isinstance(target, str):
+        print("\n❌ Это не username")
+        time.sleep(2)
+        return
+    
     text = input("Введите текст сообщения: ").strip()
     
     if not text:
@@ -373,33 +3771,59 @@ def send_single_message(bot):
         time.sleep(2)
         return
     
+    if not ensure_connected(bot):
+        return
+    
+    report = bot.runner.run(bot.resolve_targets([target]))
+    if not report.resolved:
+        print(f"\n❌ Адресат не найден: {next(iter(report.failed.values()))}")
+        time.sleep(2)
+        return
     print("\n⏳ Отправляю...")
     
     try:
-        asyncio.run(bot.send_message(chat_input, text))
-        print("✅ Сообщение отправлено!")
+        if bot.runner.run(bot.send_message(report.resolved[target], text)):
+            print("✅ Сообщение отправлено!")
+        else:
+            print("❌ Не удалось отправить сообщение")
     except Exception as e:
         print(f"❌ Ошибка: {e}")
     
     time.sleep(2)
 
-def start_mass_send(bot, infinite=False):
-    """Запуск массовой рассылки"""
-    global sending_active
+def resolve_input_targets(bot, values):
+    """Найти адресатов из ввода и показать, что не нашлось. None - если нет подключения"""
+    targets, invalid = parse_targets(values)
     
-    if sending_active:
-        print("\n⚠️ Рассылка уже активна!")
-        time.sleep(2)
-        return
+    # Реестр и кэш адресатов меняет фоновый цикл - проверяем в нем же
+    async def unresolved():
+        return [target for target in targets if bot.lookup_target(target) is None]
     
-    print_header("♾️ БЕСКОНЕЧНАЯ РАССЫЛКА" if infinite else "🚀 МАССОВАЯ РАССЫЛКА")
+    if bot.runner.run(unresolved()):
+        if not ensure_connected(bot):
+            return None
+        print("⏳ Ищу адресатов...")
+    report = bot.runner.run(bot.resolve_targets(targets, invalid))
+    print(f"\n🔎 Адресаты: {report.summary()}")
+    for i, (target, reason) in enumerate(report.failed.items()):
+        if i == 20:
+            print(f"   ... и еще {len(report.failed) - i}")
+            break
+        print(f"   ❌ {target}: {reason}")
+    return report.chat_ids()
+
+def start_mass_send(bot, infinite=False):
+    """Запуск массовой рассылки (сейчас или по расписанию)"""
+    print_header("♾️ БЕСКОНЕЧНАЯ РАССЫЛКА" if infinite else "🚀 МАССОВАЯ РАССЫЛКА", bot)
     
     # Выбор источника чатов
+    query = None
     print("📁 Выберите источник чатов:")
     print("1. Из папки")
     print("2. Из избранного")
     print("3. Все мои чаты")
     print("4. Ввести вручную (через запятую)")
+    print("5. По правилу (папки, избранное, типы с | & -)")
     
     source_choice = input("\nВыберите: ").strip()
     
@@ -407,18 +3831,18 @@ def start_mass_send(bot, infinite=False):
     
     if source_choice == '1':
         # Из папки
-        if not bot.folders:
+        if not bot.registry.folders:
             print("\n❌ Папки не созданы!")
             time.sleep(2)
             return
         
         print("\n📂 Доступные папки:")
-        for folder_name in bot.folders.keys():
-            print(f"- {folder_name} ({len(bot.folders[folder_name])} чатов)")
+        for folder_name, members in bot.registry.folders.items():
+            print(f"- {folder_name} ({len(members)} чатов)")
         
         folder_name = input("Введите имя папки: ").strip()
-        if folder_name in bot.folders:
-            chat_ids = bot.folders[folder_name]
+        if folder_name in bot.registry.folders:
+            chat_ids = list(bot.registry.folders[folder_name])
         else:
             print("❌ Папка не найдена!")
             time.sleep(2)
@@ -426,16 +3850,33 @@ def start_mass_send(bot, infinite=False):
             
     elif source_choice == '2':
         # Из избранного
-        chat_ids = [int(cid) for cid in bot.favorites]
+        chat_ids = list(bot.registry.favorites)
         
     elif source_choice == '3':
         # Все чаты
-        chat_ids = [chat["id"] for chat in bot.chats]
+        chat_ids = bot.registry.ids()
         
     elif source_choice == '4':
-        # Вручную
-        manual_input = input("Введите ID чатов через запятую: ").strip()
-        chat_ids = [int(cid.strip()) for cid in manual_input.split(',') if cid.strip().isdigit()]
+        # Вручную: ID (у групп и каналов - с минусом), @username и ссылки t.me
+        manual_input = input("Введите ID, @username или ссылки через запятую: ").strip()
+        chat_ids = resolve_input_targets(bot, manual_input)
+        if chat_ids is None:
+            return
+    
+    elif source_choice == '5':
+        print("\nТермы: all, favorites, folder:ИМЯ (с пробелами - folder:\"Имя папки\"),")
+        print("       type:user|group|channel, id:ЧИСЛО")
+        print("Операции: | объединение, & пересечение, - разность, скобки")
+        print("Пример: folder:Клиенты | favorites - type:user")
+        print("ℹ️ Черный список, закрытые чаты и карантин исключаются сами;")
+        print("   цели пересчитываются в начале каждого цикла")
+        try:
+            query = TargetQuery(input("\nПравило: "))
+            chat_ids = query.ids(bot.registry)
+        except ValueError as e:
+            print(f"❌ {e}")
+            time.sleep(2)
+            return
     
     if not chat_ids:
         print("\n❌ Нет чатов для рассылки!")
@@ -491,6 +3932,22 @@ def start_mass_send(bot, infinite=False):
         time.sleep(2)
         return
     
+    # Файл загружается один раз, текст становится подписью
+    media = input("📎 Путь к файлу (фото/документ, Enter - без файла): ").strip() or None
+    if media and not os.path.isfile(media):
+        print("❌ Файл не найден!")
+        time.sleep(2)
+        return
+    
+    # Разметка и длина проверяются сразу, а не на первой отправке
+    try:
+        prepared = [bot.template_cache.get(variant, bool(media)).render(template_context())
+                    for variant in (text if isinstance(text, list) else [text])]
+    except ValueError as e:
+        print(f"❌ {e}")
+        time.sleep(2)
+        return
+    
     # Настройки задержки
     try:
         delay = float(input("Задержка между сообщениями (сек, по умолчанию 2): ") or "2")
@@ -501,50 +3958,239 @@ def start_mass_send(bot, infinite=False):
         else:
             cycles = 0
         
+        # Очередность среди одновременных рассылок
+        priority = int(input("Приоритет (Enter - 0, срочная - например 10): ") or "0")
+        weight = float(input("Вес среди рассылок с тем же приоритетом (Enter - 1): ") or "1")
+        # nan и inf сломали бы порядок в очереди лимитера
+        if not (math.isfinite(weight) and weight > 0):
+            raise ValueError
+        
     except ValueError:
         print("❌ Неверное число!")
         time.sleep(2)
         return
     
+    # Время запуска
+    print("\n⏰ Когда начать? Enter - сейчас, ЧЧ:ММ или ГГГГ-ММ-ДД ЧЧ:ММ - один раз,")
+    print("   'каждые 30м' / 'каждые 2ч' - повторять, 5 полей cron ('0 9 * * 1-5') - по cron")
+    when = input("Время запуска: ").strip()
+    rule = None
+    if when:
+        try:
+            rule = parse_schedule(when)
+        except ValueError as e:
+            print(f"❌ {e}")
+            time.sleep(2)
+            return
+        if rule[0] == SCHEDULE_AT and rule[1] <= time.time():
+            print("❌ Это время уже прошло!")
+            time.sleep(2)
+            return
+    
     # Подтверждение
-    print_header("ПОДТВЕРЖДЕНИЕ")
+    print_header("ПОДТВЕРЖДЕНИЕ", bot)
     print(f"📊 Чатов для рассылки: {len(chat_ids)}")
+    if query:
+        print(f"🧮 Правило: {query.text}")
     print(f"📝 Текст: {text[:50]}{'...' if len(str(text)) > 50 else ''}")
+    if media:
+        print(f"📎 Файл: {media} ({os.path.getsize(media) / 1024 / 1024:.1f} МБ, загружается один раз)")
+    longest = max(len(parts) for parts in prepared)
+    if longest > 1:
+        print(f"✂️ Длинный текст уйдет частями: до {longest} сообщений в каждый чат")
     print(f"⏱️ Задержка: {delay} сек")
     print(f"⏸️ Пауза между циклами: {cycle_delay} сек")
     print(f"♾️ Циклов: {'Бесконечно' if cycles == 0 or infinite else cycles}")
+    if priority or weight != 1:
+        print(f"🏁 Приоритет: {priority}, вес: {weight:g}")
+    active = bot.campaigns.active()
+    if active and not rule:
+        print(f"🔀 Уже идет рассылок: {len(active)} - слоты отправки делятся по приоритету и весу")
+    
+    campaign = Campaign(chat_ids, text, delay, infinite or cycles == 0,
+                        cycles if cycles > 0 else 1, cycle_delay, media=media and os.path.abspath(media),
+                        priority=priority, weight=weight, query=query and query.text)
+    if rule:
+        schedule = Schedule(campaign.to_spec(), *rule)
+        print(f"⏰ Запуск: {schedule.describe()}, первый - "
+              f"{datetime.fromtimestamp(schedule.next_run):%Y-%m-%d %H:%M}")
+        if input("\n⏰ Запланировать рассылку? (y/n): ").strip().lower() != 'y':
+            print("❌ Отменено!")
+            time.sleep(1)
+            return
+        bot.scheduler.add(schedule)
+        print("\n✅ Рассылка запланирована! Список: [s] в главном меню")
+        time.sleep(2)
+        return
     
     confirm = input("\n🚀 Начать рассылку? (y/n): ").strip().lower()
     
-    if confirm == 'y':
-        print("\n✅ Запускаю рассылку...")
-        print("ℹ️ Чтобы остановить: выберите [5] в главном меню")
+    if confirm != 'y':
+        print("❌ Отменено!")
+        time.sleep(1)
+        return
+    if not ensure_connected(bot):
+        return
+    
+    print("\n✅ Запускаю рассылку...")
+    print("ℹ️ Пауза и остановка: [5] в главном меню")
+    
+    # Запуск в фоне
+    bot.start_campaign(campaign)
+    time.sleep(2)
+
+def manage_schedules(bot):
+    """Запланированные рассылки"""
+    while True:
+        print_header("⏰ РАСПИСАНИЕ", bot)
         
-        # Запуск в фоне
-        async def run_send():
-            await bot.mass_send(chat_ids, text, delay, infinite or cycles == 0, 
-                               cycles if cycles > 0 else 1, cycle_delay)
+        schedules = bot.scheduler.upcoming()
+        if not schedules:
+            print("📭 Запланированных рассылок нет")
+            print("ℹ️ Запланировать: [3] или [4] в главном меню, поле 'Время запуска'")
+        for i, schedule in enumerate(schedules, 1):
+            next_run = (f"{datetime.fromtimestamp(schedule.next_run):%Y-%m-%d %H:%M}"
+                        if schedule.next_run else "-")
+            last_run = (f", прошлый {datetime.fromtimestamp(schedule.last_run):%Y-%m-%d %H:%M}"
+                        if schedule.last_run else "")
+            print(f"{i}. {schedule.describe()}: {len(schedule.spec['chat_ids'])} чатов, "
+                  f"следующий {next_run}{last_run}")
         
-        asyncio.create_task(run_send())
+        choice = input("\nНомер - удалить, Enter - назад: ").strip()
+        if not choice:
+            break
+        if not choice.isdigit() or not 1 <= int(choice) <= len(schedules):
+            print("❌ Неверный номер!")
+            time.sleep(1)
+            continue
+        schedule = schedules[int(choice) - 1]
+        if input(f"Удалить расписание ({schedule.describe()})? (y/n): ").strip().lower() == 'y':
+            bot.scheduler.remove(schedule.id)
+            print("✅ Удалено!")
+            time.sleep(1)
+
+def resume_campaign(bot):
+    """Продолжить прерванную рассылку с места остановки"""
+    print_header("⏯️ ПРОДОЛЖИТЬ РАССЫЛКУ", bot)
+    
+    running = {campaign.id for campaign in bot.campaigns.active()}
+    unfinished = [row for row in bot.store.unfinished_campaigns() if row[0] not in running]
+    if not unfinished:
+        print("\n📭 Незавершенных рассылок нет")
+        time.sleep(2)
+        return
+    
+    for i, (campaign_id, spec, status, updated) in enumerate(unfinished[:20], 1):
+        cursor = CampaignJournal(campaign_id).load() or (1, 0)
+        cycles = "∞" if spec["infinite"] else spec["cycles"]
+        print(f"{i}. {updated} - {len(spec['chat_ids'])} чатов, цикл {cursor[0]}/{cycles}, "
+              f"позиция {cursor[1]} ({status})")
+    
+    try:
+        index = int(input("\nНомер рассылки: ").strip()) - 1
+    except ValueError:
+        print("❌ Введите число!")
         time.sleep(2)
+        return
+    
+    if not 0 <= index < min(len(unfinished), 20):
+        print("❌ Неверный номер!")
+        time.sleep(2)
+        return
+    
+    if not ensure_connected(bot):
+        return
+    campaign = bot.load_campaign(unfinished[index][0])
+    bot.start_campaign(campaign)
+    print(f"\n✅ Продолжаю с цикла {campaign.cycle}, позиция {campaign.index}")
+    time.sleep(2)
+
+def wait_stopped(futures, timeout=10):
+    """Дождаться, пока остановленные рассылки сохранят курсор и статистику"""
+    futures = [future for future in futures if future is not None]
+    _, pending = concurrent.futures.wait(futures, timeout)
+    if pending:
+        print("⚠️ Отправка еще завершается, рассылка остановится сразу после нее")
     else:
-        print("❌ Отменено!")
-        time.sleep(1)
+        print("✅ Остановлено, прогресс сохранен")
 
-def stop_sending():
-    """Остановить рассылку"""
-    global sending_active
-    if sending_active:
-        sending_active = False
-        print("\n🛑 Останавливаю рассылку...")
-        time.sleep(2)
+def stop_sending(bot):
+    """Остановить все рассылки"""
+    stopped = bot.campaigns.stop_all()
+    if stopped:
+        print("\n🛑 Останавливаю рассылки...")
+        wait_stopped(campaign.future for campaign in stopped)
+        time.sleep(1)
     else:
+        bot.stats_writer.flush()
         print("\n⚠️ Рассылка не активна!")
         time.sleep(1)
 
+CAMPAIGN_STATES = {
+    "running": "▶️ идет",
+    "paused": "⏸️ пауза",
+    "stopped": "⏹️ остановлена",
+    "cancelled": "✖️ отменена",
+}
+
+def manage_campaigns(bot):
+    """Рассылки: прогресс каждой, пауза, продолжение, остановка, отмена"""
+    while True:
+        print_header("🎛️ РАССЫЛКИ", bot)
+        
+        campaigns = list(bot.campaigns)
+        if not campaigns:
+            print("📭 Рассылок нет")
+            time.sleep(2)
+            return
+        
+        for i, campaign in enumerate(campaigns, 1):
+            sent, errors, elapsed = campaign.progress()
+            cycles = "∞" if campaign.infinite else campaign.cycles
+            state = CAMPAIGN_STATES[campaign.state]
+            if campaign.future is not None and campaign.future.done() and campaign.state == "stopped":
+                state = "✅ завершена" if bot.store.campaign_status(campaign.id) == "done" else state
+            print(f"{i}. {state} | {campaign.id} | приоритет {campaign.priority}, вес {campaign.weight:g}")
+            print(f"   цикл {campaign.cycle}/{cycles}, позиция {campaign.index}/{len(campaign.chat_ids)}, "
+                  f"отправлено {sent}, ошибок {errors}, {int(elapsed)} сек")
+        
+        print("\nКоманды: p N - пауза, r N - продолжить, s N - остановить (можно продолжить позже),")
+        print("         c N - отменить, sa - остановить все, cl - убрать завершенные, Enter - назад")
+        command = input("\n🎯 Команда: ").strip().lower().split()
+        if not command:
+            return
+        if command == ["sa"]:
+            stop_sending(bot)
+            continue
+        if command == ["cl"]:
+            bot.campaigns.clear_finished()
+            continue
+        if len(command) != 2 or command[0] not in ("p", "r", "s", "c") or not command[1].isdigit() \
+                or not 1 <= int(command[1]) <= len(campaigns):
+            print("❌ Неверная команда!")
+            time.sleep(1)
+            continue
+        
+        campaign = campaigns[int(command[1]) - 1]
+        if not campaign.active:
+            print("⚠️ Рассылка уже не идет")
+        elif command[0] == "p":
+            campaign.pause()
+            print("⏸️ Пауза после текущей отправки")
+        elif command[0] == "r":
+            campaign.resume()
+            print("▶️ Продолжаю")
+        elif command[0] == "s":
+            print("🛑 Останавливаю (продолжить: [r] в главном меню)")
+            wait_stopped([campaign.stop()])
+        elif input("Отменить рассылку без возможности продолжить? (y/n): ").strip().lower() == 'y':
+            wait_stopped([campaign.cancel()])
+            print("✖️ Отменено")
+        time.sleep(1)
+
 def manage_folders(bot):
     """Управление папками с чатами"""
-    print_header("📁 ПАПКИ С ЧАТАМИ")
+    print_header("📁 ПАПКИ С ЧАТАМИ", bot)
     
     while True:
         print("\n1. 📂 Создать папку")
@@ -557,40 +4203,36 @@ def manage_folders(bot):
         
         if choice == '1':
             folder_name = input("Введите имя папки: ").strip()
-            if folder_name and folder_name not in bot.folders:
-                bot.folders[folder_name] = []
-                save_json(FOLDERS_FILE, bot.folders)
+            if folder_name and bot.registry.create_folder(folder_name):
                 print(f"✅ Папка '{folder_name}' создана!")
             else:
                 print("❌ Папка уже существует или имя пустое!")
         
         elif choice == '2':
-            if not bot.folders:
+            if not bot.registry.folders:
                 print("\n📭 Папок нет")
             else:
                 print("\n📂 Ваши папки:")
-                for folder_name, chats in bot.folders.items():
+                for folder_name, chats in bot.registry.folders.items():
                     print(f"- {folder_name}: {len(chats)} чатов")
         
         elif choice == '3':
-            if not bot.folders:
+            if not bot.registry.folders:
                 print("❌ Сначала создайте папку!")
                 continue
             
             print("\n📂 Выберите папку:")
-            for folder_name in bot.folders.keys():
+            for folder_name in bot.registry.folders.keys():
                 print(f"- {folder_name}")
             
             folder_name = input("Имя папки: ").strip()
-            if folder_name not in bot.folders:
+            if folder_name not in bot.registry.folders:
                 print("❌ Папка не найдена!")
                 continue
             
-            chat_id = input("Введите ID чата: ").strip()
-            if chat_id.isdigit():
-                if int(chat_id) not in bot.folders[folder_name]:
-                    bot.folders[folder_name].append(int(chat_id))
-                    save_json(FOLDERS_FILE, bot.folders)
+            chat_id = normalize_chat_id(input("Введите ID чата: "))
+            if chat_id is not None:
+                if bot.registry.add_to_folder(folder_name, chat_id):
                     print("✅ Чат добавлен!")
                 else:
                     print("⚠️ Чат уже в папке")
@@ -598,20 +4240,19 @@ def manage_folders(bot):
                 print("❌ Неверный ID!")
         
         elif choice == '4':
-            if not bot.folders:
+            if not bot.registry.folders:
                 print("❌ Папок нет!")
                 continue
             
             print("\n📂 Выберите папку для удаления:")
-            for folder_name in bot.folders.keys():
+            for folder_name in bot.registry.folders.keys():
                 print(f"- {folder_name}")
             
             folder_name = input("Имя папки: ").strip()
-            if folder_name in bot.folders:
+            if folder_name in bot.registry.folders:
                 confirm = input(f"Удалить папку '{folder_name}'? (y/n): ").strip().lower()
                 if confirm == 'y':
-                    del bot.folders[folder_name]
-                    save_json(FOLDERS_FILE, bot.folders)
+                    bot.registry.delete_folder(folder_name)
                     print("✅ Папка удалена!")
             else:
                 print("❌ Папка не найдена!")
@@ -623,10 +4264,10 @@ def manage_folders(bot):
 
 def manage_favorites(bot):
     """Управление избранными чатами"""
-    print_header("💾 ИЗБРАННЫЕ ЧАТЫ")
+    print_header("💾 ИЗБРАННЫЕ ЧАТЫ", bot)
     
     while True:
-        print(f"\n⭐ Избранных: {len(bot.favorites)}")
+        print(f"\n⭐ Избранных: {len(bot.registry.favorites)}")
         print("\n1. 📋 Показать избранное")
         print("2. ➕ Добавить в избранное")
         print("3. 🗑️ Удалить из избранного")
@@ -635,41 +4276,40 @@ def manage_favorites(bot):
         choice = input("\nВыберите: ").strip()
         
         if choice == '1':
-            if not bot.favorites:
+            if not bot.registry.favorites:
                 print("\n📭 Избранных чатов нет")
             else:
                 print("\n⭐ Избранные чаты:")
-                for i, chat_id in enumerate(bot.favorites[:20], 1):
+                for i, chat_id in enumerate(islice(bot.registry.favorites, 20), 1):
                     # Найдем информацию о чате
-                    chat_info = next((c for c in bot.chats if str(c["id"]) == chat_id), None)
+                    chat_info = bot.registry.get(chat_id)
                     if chat_info:
                         print(f"{i}. {chat_info['title'][:30]} (ID: {chat_id})")
                     else:
                         print(f"{i}. ID: {chat_id}")
         
         elif choice == '2':
-            chat_id = input("Введите ID чата: ").strip()
-            if chat_id and chat_id not in bot.favorites:
-                bot.favorites.append(chat_id)
-                save_json(FAVORITES_FILE, bot.favorites)
+            chat_id = normalize_chat_id(input("Введите ID чата: "))
+            if chat_id is not None and bot.registry.add_favorite(chat_id):
                 print("✅ Добавлено в избранное!")
             else:
                 print("⚠️ Уже в избранном или пустой ID")
         
         elif choice == '3':
-            if not bot.favorites:
+            if not bot.registry.favorites:
                 print("❌ Избранных нет!")
                 continue
             
+            favorites = list(bot.registry.favorites)
             print("\nВыберите чат для удаления:")
-            for i, chat_id in enumerate(bot.favorites, 1):
+            for i, chat_id in enumerate(favorites, 1):
                 print(f"{i}. ID: {chat_id}")
             
             try:
                 index = int(input("Номер: ").strip()) - 1
-                if 0 <= index < len(bot.favorites):
-                    removed = bot.favorites.pop(index)
-                    save_json(FAVORITES_FILE, bot.favorites)
+                if 0 <= index < len(favorites):
+                    removed = favorites[index]
+                    bot.registry.remove_favorite(removed)
                     print(f"✅ Чат {removed} удален!")
                 else:
                     print("❌ Неверный номер!")
@@ -683,7 +4323,7 @@ def manage_favorites(bot):
 
 def manage_templates(bot):
     """Управление шаблонами текстов"""
-    print_header("📝 ШАБЛОНЫ ТЕКСТОВ")
+    print_header("📝 ШАБЛОНЫ ТЕКСТОВ", bot)
     
     while True:
         print(f"\n📋 Шаблонов: {len(bot.templates)}")
@@ -709,6 +4349,7 @@ def manage_templates(bot):
                 print("❌ Имя не может быть пустым!")
                 continue
             
+            print("Подстановки: {title} {username} {name} {id} {date} {time} {n} {cycle} {total}")
             print("Введите текст шаблона (Ctrl+D для завершения):")
             lines = []
             try:
@@ -720,8 +4361,7 @@ def manage_templates(bot):
             
             text = "\n".join(lines)
             if text:
-                bot.templates[name] = text
-                save_json(TEMPLATES_FILE, bot.templates)
+                bot.save_template(name, text)
                 print(f"✅ Шаблон '{name}' сохранен!")
             else:
                 print("❌ Текст не может быть пустым!")
@@ -742,8 +4382,7 @@ def manage_templates(bot):
                     removed = names[index]
                     confirm = input(f"Удалить '{removed}'? (y/n): ").strip().lower()
                     if confirm == 'y':
-                        del bot.templates[removed]
-                        save_json(TEMPLATES_FILE, bot.templates)
+                        bot.delete_template(removed)
                         print(f"✅ Шаблон '{removed}' удален!")
                 else:
                     print("❌ Неверный номер!")
@@ -757,31 +4396,44 @@ def manage_templates(bot):
 
 def show_statistics(bot):
     """Показать статистику"""
-    print_header("📊 СТАТИСТИКА")
+    print_header("📊 СТАТИСТИКА", bot)
     
     print(f"\n📨 Всего отправлено: {bot.stats.get('total_sent', 0)}")
     print(f"❌ Ошибок отправки: {bot.stats.get('total_errors', 0)}")
     print(f"📅 Последняя активность: {bot.stats.get('last_active', 'никогда')}")
+    print(f"⏳ FloodWait: {bot.stats.get('flood_waits', 0)} раз, "
+          f"{bot.stats.get('flood_wait_seconds', 0)} сек ожидания")
+    print(f"🚦 Текущая скорость: {bot.limiter.rate:.2f} сообщ/сек")
+    
+    latency = bot.metrics.snapshot()["latency"]
+    if latency["network"]["count"]:
+        print("⏱️ Задержки (p50 / p95, сек): " + ", ".join(
+            f"{stage} {latency[stage]['p50']} / {latency[stage]['p95']}"
+            for stage in SendMetrics.STAGES if latency[stage]["count"]))
+    if bot.metrics_server:
+        print(f"📈 Метрики: {bot.metrics_server.address}")
     
     if bot.me:
         print(f"\n👤 Аккаунт: {bot.me.first_name} (@{bot.me.username})")
         print(f"🆔 User ID: {bot.me.id}")
     
-    print(f"\n📁 Папок: {len(bot.folders)}")
-    print(f"⭐ Избранных: {len(bot.favorites)}")
+    print(f"\n📁 Папок: {len(bot.registry.folders)}")
+    print(f"⭐ Избранных: {len(bot.registry.favorites)}")
     print(f"📝 Шаблонов: {len(bot.templates)}")
-    print(f"🚫 Черный список: {len(bot.blacklist)} чатов")
+    print(f"🚫 Черный список: {len(bot.registry.blacklist)} чатов")
+    print(f"🧯 В карантине: {len(bot.registry.quarantine)} чатов")
     
     print("\n💾 Экспорт данных:")
     print("1. 📤 Экспортировать все чаты")
     print("2. 📤 Экспортировать шаблоны")
     print("3. 📥 Импортировать данные")
+    print("4. 📜 Журнал доставки")
     
     choice = input("\nВыберите действие (или Enter для выхода): ").strip()
     
     if choice == '1':
         export_file = f"chats_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        save_json(export_file, bot.chats)
+        save_json(export_file, list(bot.registry.chats.values()))
         print(f"✅ Чаты экспортированы в {export_file}")
         time.sleep(2)
     
@@ -799,12 +4451,11 @@ def show_statistics(bot):
                     data = json.load(f)
                 
                 if isinstance(data, list):
-                    bot.chats.extend(data)
-                    save_json(CHATS_FILE, bot.chats)
-                    print(f"✅ Импортировано {len(data)} чатов")
+                    imported = bot.registry.upsert(data)
+                    print(f"✅ Импортировано {len(imported)} чатов")
                 elif isinstance(data, dict):
-                    bot.templates.update(data)
-                    save_json(TEMPLATES_FILE, bot.templates)
+                    for name, text in data.items():
+                        bot.save_template(name, text)
                     print(f"✅ Импортировано {len(data)} шаблонов")
                 
             except Exception as e:
@@ -812,10 +4463,53 @@ def show_statistics(bot):
         else:
             print("❌ Файл не найден!")
         time.sleep(2)
+    
+    elif choice == '4':
+        show_delivery_log(bot)
+
+def show_delivery_log(bot):
+    """Недоставленные чаты рассылки и последняя успешная отправка в чат"""
+    print_header("📜 ЖУРНАЛ ДОСТАВКИ", bot)
+    
+    print("\n1. ❌ Чаты, куда рассылка не дошла")
+    print("2. ✅ Последняя успешная отправка в чат")
+    choice = input("\nВыберите: ").strip()
+    
+    if choice == '1':
+        campaigns = bot.store.recent_campaigns()
+        if not campaigns:
+            print("📭 Рассылок еще не было")
+        else:
+            for i, (campaign_id, status, updated) in enumerate(campaigns, 1):
+                print(f"{i}. {campaign_id} - {status}, {updated}")
+            try:
+                index = int(input("\nНомер рассылки: ").strip()) - 1
+                if 0 <= index < len(campaigns):
+                    failed = bot.delivery.failed_chats(campaigns[index][0])
+                    print(f"\n❌ Не доставлено: {len(failed)}")
+                    for chat_id, outcome, error, ts in failed[:30]:
+                        chat = bot.registry.get(chat_id) or {}
+                        print(f"  {chat.get('title') or chat_id} - {outcome} {error}")
+                else:
+                    print("❌ Неверный номер!")
+            except ValueError:
+                print("❌ Введите число!")
+    
+    elif choice == '2':
+        chat_id = normalize_chat_id(input("ID чата: "))
+        last = bot.delivery.last_success([chat_id]).get(chat_id) if chat_id is not None else None
+        if last:
+            campaign_id, message_id, ts = last
+            print(f"✅ {datetime.fromtimestamp(ts):%Y-%m-%d %H:%M:%S}, сообщение {message_id}, "
+                  f"рассылка {campaign_id or '-'}")
+        else:
+            print("📭 Успешных отправок в этот чат нет")
+    
+    input("\n↵ Нажмите Enter для продолжения...")
 
 def show_settings(bot):
     """Настройки"""
-    print_header("⚙️ НАСТРОЙКИ")
+    print_header("⚙️ НАСТРОЙКИ", bot)
     
     while True:
         print(f"\n📱 API ID: {bot.config.get('api_id', 'не установлен')}")
@@ -825,8 +4519,9 @@ def show_settings(bot):
         print("2. 🚫 Управление черным списком")
         print("3. ⏱️ Настройка задержек")
         print("4. 🧹 Очистить данные")
-        print("5. ℹ️ Информация о боте")
-        print("6. ↩️ Назад")
+        print("5. 🧯 Карантин чатов")
+        print("6. ℹ️ Информация о боте")
+        print("7. ↩️ Назад")
         
         choice = input("\nВыберите: ").strip()
         
@@ -864,15 +4559,27 @@ def show_settings(bot):
                 bot.config["default_delay"] = float(new_delay)
                 save_json(CONFIG_FILE, bot.config)
                 print("✅ Задержка сохранена!")
+            
+            max_rate = bot.config.get("max_send_rate")
+            print(f"\nМаксимальная скорость: {max_rate or 'по задержке'} сообщ/сек")
+            print("Бот сам снижает скорость при FloodWait и поднимает ее до этого предела")
+            new_rate = input("Новая максимальная скорость (Enter - не менять): ").strip()
+            if new_rate.replace('.', '').isdigit() and float(new_rate) > 0:
+                bot.config["max_send_rate"] = float(new_rate)
+                save_json(CONFIG_FILE, bot.config)
+                print("✅ Скорость сохранена!")
             time.sleep(1)
         
         elif choice == '4':
             confirm = input("\n⚠️ Очистить ВСЕ данные? (y/n): ").strip().lower()
             if confirm == 'y':
+                bot.scheduler.stop()
+                bot.stats_writer.flush()
+                bot.delivery.close()
+                bot.store.close()
                 files_to_remove = [
-                    CHATS_FILE, FAVORITES_FILE, FOLDERS_FILE,
-                    TEMPLATES_FILE, STATS_FILE, BLACKLIST_FILE,
-                    "telegram_sender.session"
+                    DB_FILE, f"{DB_FILE}-wal", f"{DB_FILE}-shm",
+                    f"{SESSION_NAME}.session"
                 ]
                 
                 for file in files_to_remove:
@@ -880,12 +4587,20 @@ def show_settings(bot):
                         os.remove(file)
                         print(f"🗑️ Удалено: {file}")
                 
+                for directory in (CAMPAIGNS_DIR, DELIVERY_DIR):
+                    if os.path.isdir(directory):
+                        shutil.rmtree(directory)
+                        print(f"🗑️ Удалено: {directory}")
+                
                 print("\n✅ Все данные очищены!")
                 print("⚠️ Бот будет перезапущен")
                 time.sleep(3)
                 sys.exit(0)
         
         elif choice == '5':
+            manage_quarantine(bot)
+        
+        elif choice == '6':
             print("\n🤖 ИНФОРМАЦИЯ О БОТЕ")
             print("=" * 40)
             print(f"Версия: {VERSION}")
@@ -896,17 +4611,17 @@ def show_settings(bot):
             print("\n⚠️ Используйте ответственно!")
             input("\n↵ Нажмите Enter для продолжения...")
         
-        elif choice == '6':
+        elif choice == '7':
             break
         
         time.sleep(1)
 
 def manage_blacklist(bot):
     """Управление черным списком"""
-    print_header("🚫 ЧЕРНЫЙ СПИСОК")
+    print_header("🚫 ЧЕРНЫЙ СПИСОК", bot)
     
     while True:
-        print(f"\n🚫 Чатов в черном списке: {len(bot.blacklist)}")
+        print(f"\n🚫 Чатов в черном списке: {len(bot.registry.blacklist)}")
         print("\n1. 📋 Показать черный список")
         print("2. ➕ Добавить в черный список")
         print("3. 🗑️ Удалить из черного списка")
@@ -915,36 +4630,35 @@ def manage_blacklist(bot):
         choice = input("\nВыберите: ").strip()
         
         if choice == '1':
-            if not bot.blacklist:
+            if not bot.registry.blacklist:
                 print("\n📭 Черный список пуст")
             else:
                 print("\n🚫 Черный список:")
-                for i, chat_id in enumerate(bot.blacklist[:20], 1):
+                for i, chat_id in enumerate(islice(bot.registry.blacklist, 20), 1):
                     print(f"{i}. ID: {chat_id}")
         
         elif choice == '2':
-            chat_id = input("Введите ID чата: ").strip()
-            if chat_id and chat_id not in bot.blacklist:
-                bot.blacklist.append(chat_id)
-                save_json(BLACKLIST_FILE, bot.blacklist)
+            chat_id = normalize_chat_id(input("Введите ID чата: "))
+            if chat_id is not None and bot.registry.add_to_blacklist(chat_id):
                 print("✅ Добавлено в черный список!")
             else:
                 print("⚠️ Уже в списке или пустой ID")
         
         elif choice == '3':
-            if not bot.blacklist:
+            if not bot.registry.blacklist:
                 print("❌ Список пуст!")
                 continue
             
+            blacklist = list(bot.registry.blacklist)
             print("\nВыберите для удаления:")
-            for i, chat_id in enumerate(bot.blacklist, 1):
+            for i, chat_id in enumerate(blacklist, 1):
                 print(f"{i}. ID: {chat_id}")
             
             try:
                 index = int(input("Номер: ").strip()) - 1
-                if 0 <= index < len(bot.blacklist):
-                    removed = bot.blacklist.pop(index)
-                    save_json(BLACKLIST_FILE, bot.blacklist)
+                if 0 <= index < len(blacklist):
+                    removed = blacklist[index]
+                    bot.registry.remove_from_blacklist(removed)
                     print(f"✅ Чат {removed} удален из списка!")
                 else:
                     print("❌ Неверный номер!")
@@ -956,8 +4670,50 @@ def manage_blacklist(bot):
         
         time.sleep(1)
 
+def manage_quarantine(bot):
+    """Чаты, исключенные из рассылок после ошибок отправки"""
+    print_header("🧯 КАРАНТИН ЧАТОВ", bot)
+    quarantine = bot.registry.quarantine
+    
+    while True:
+        blocked = sorted(quarantine.blocked())
+        print(f"\n🧯 Чатов в карантине: {len(blocked)}")
+        for i, chat_id in enumerate(blocked[:20], 1):
+            entry = quarantine.entries[chat_id]
+            chat = bot.registry.get(chat_id) or {}
+            until = ("навсегда" if entry["until"] is None
+                     else datetime.fromtimestamp(entry["until"]).strftime("до %d.%m %H:%M"))
+            print(f"{i}. {chat.get('title') or chat_id} - {entry['reason']} ({until})")
+        
+        print("\n1. 🔓 Снять карантин с чата")
+        print("2. 🔓 Снять карантин со всех")
+        print("3. ↩️ Назад")
+        
+        choice = input("\nВыберите: ").strip()
+        
+        if choice == '1':
+            try:
+                index = int(input("Номер: ").strip()) - 1
+                if 0 <= index < len(blocked):
+                    quarantine.release(blocked[index])
+                    print(f"✅ Чат {blocked[index]} снова участвует в рассылках")
+                else:
+                    print("❌ Неверный номер!")
+            except ValueError:
+                print("❌ Введите число!")
+        
+        elif choice == '2':
+            for chat_id in list(quarantine.entries):
+                quarantine.release(chat_id)
+            print("✅ Карантин снят со всех чатов")
+        
+        elif choice == '3':
+            break
+        
+        time.sleep(1)
+
 # ========== УСТАНОВОЧНЫЙ СКРИПТ ==========
-async def setup_wizard():
+def setup_wizard():
     """Мастер настройки"""
     print_header("⚡ ТЕЛЕГРАМ РАССЫЛКА v4.0")
     
@@ -1000,9 +4756,260 @@ async def setup_wizard():
     
     return config
 
+# ========== ПРОФИЛЬ ЗАПУСКА ==========
+class StartupProfile:
+    """Замер фаз запуска (`main.py --profile-startup`).
+
+    mark() закрывает последовательную фазу от предыдущей отметки,
+    span() замеряет фазу, идущую в фоне. Отсчет - от начала импорта main.py.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []  # (название, начало от старта, длительность)
+        self._last = IMPORT_STARTED
+        self._lock = threading.Lock()
+
+    def _add(self, name, start, end):
+        with self._lock:
+            self.phases.append((name, start - IMPORT_STARTED, end - start))
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self._add(name, self._last, now)
+        self._last = now
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(name, start, time.perf_counter())
+
+    def report(self, title="ПРОФИЛЬ ЗАПУСКА"):
+        if not self.enabled:
+            return
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        print(f"\n⏱️ {title}")
+        for name, start, duration in phases:
+            print(f"  {name:24} {duration * 1000:8.1f} мс   (начало: {start * 1000:.1f} мс)")
+
+# ========== ПАКЕТНЫЙ РЕЖИМ ==========
+# Коды выхода `main.py run`
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_BAD_SPEC = 2
+EXIT_PARTIAL = 3
+EXIT_NO_CONNECTION = 4
+EXIT_BUSY = 5
+EXIT_STOPPED = 130
+
+PID_FILE = "bot.pid"
+
+def emit(event, **fields):
+    """Строка прогресса для скриптов: один JSON объект на строку в stdout"""
+    fields = {"event": event, "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), **fields}
+    print(json.dumps(fields, ensure_ascii=False), flush=True)
+
+def select_targets(registry, targets):
+    """ID чатов по описанию целей из файла рассылки.
+
+    rule - правило TargetQuery; иначе folder/folders, favorites, all, ids
+    объединяются (порядок сохраняется), затем types оставляет только
+    нужные типы. exclude убирает лишнее в обоих случаях.
+    """
+    if targets.get("rule"):
+        excluded = {normalize_chat_id(value) for value in targets.get("exclude", [])}
+        return [chat_id for chat_id in TargetQuery(targets["rule"]).iter_ids(registry)
+                if chat_id not in excluded]
+    
+    selected = {}
+    folders = targets.get("folders", [])
+    if targets.get("folder"):
+        folders = [targets["folder"], *folders]
+    for name in folders:
+        if name not in registry.folders:
+            raise ValueError(f"Папка не найдена: {name}")
+        selected.update(registry.folders[name])
+    if targets.get("favorites"):
+        selected.update(registry.favorites)
+    if targets.get("all"):
+        selected.update(dict.fromkeys(registry.chats))
+    for value in targets.get("ids", []):
+        chat_id = normalize_chat_id(value)
+        if chat_id is None:
+            raise ValueError(f"Неверный ID чата: {value}")
+        selected[chat_id] = None
+    
+    types_filter = set(targets.get("types", []))
+    excluded = {normalize_chat_id(value) for value in targets.get("exclude", [])}
+    return [chat_id for chat_id in selected
+            if chat_id not in excluded
+            and (not types_filter or (registry.get(chat_id) or {}).get("type") in types_filter)]
+
+def build_campaign(bot, spec):
+    """Campaign из файла рассылки (ValueError - если файл описан неверно).
+
+    {"id": "...", "resume": true, "sync": false,
+     "targets": {"folder": "...", "favorites": true, "all": true,
+                 "ids": [-100123, "@name", "t.me/name", ...],
+                 "types": ["group", "channel", "user"], "exclude": [...]}
+                или {"rule": "folder:A | favorites - type:user"},
+     "text": "..." или ["вариант 1", "вариант 2"], "template": "имя шаблона",
+     "media": "путь к файлу", "delay": 2, "cycles": 1, "infinite": false, "cycle_delay": 5,
+     "priority": 0, "weight": 1}
+    """
+    campaign_id = spec.get("id")
+    if campaign_id and spec.get("resume"):
+        unfinished = {row[0] for row in bot.store.unfinished_campaigns()}
+        if campaign_id in unfinished:
+            return bot.load_campaign(campaign_id)
+    
+    if spec.get("template"):
+        if spec["template"] not in bot.templates:
+            raise ValueError(f"Шаблон не найден: {spec['template']}")
+        text = bot.templates[spec["template"]]
+    else:
+        text = spec.get("text")
+    if not text and not spec.get("media"):
+        raise ValueError("Не задан text, template или media")
+    if spec.get("media") and not os.path.isfile(spec["media"]):
+        raise ValueError(f"Файл не найден: {spec['media']}")
+    
+    # Адресаты из ids ищутся заранее: ненайденные попадают в отчет, а не в рассылку
+    targets = dict(spec.get("targets", {}))
+    if targets.get("ids") and not targets.get("rule"):
+        report = bot.runner.run(bot.resolve_targets(*parse_targets(targets["ids"])))
+        emit("resolve", resolved=len(report.chat_ids()), cached=report.cached, failed=report.failed)
+        targets["ids"] = report.chat_ids()
+    
+    chat_ids = select_targets(bot.registry, targets)
+    if not chat_ids:
+        raise ValueError("Нет чатов для рассылки")
+    
+    weight = float(spec.get("weight", 1))
+    if not (math.isfinite(weight) and weight > 0):
+        raise ValueError("weight должен быть конечным числом больше нуля")
+    
+    if campaign_id:
+        # Новый запуск с id прошлой рассылки: ее курсор не должен попасть в продолжение этой
+        CampaignJournal(campaign_id).remove()
+    
+    campaign = Campaign(chat_ids, text, float(spec.get("delay", bot.config.get("default_delay", 2))),
+                        bool(spec.get("infinite", False)), int(spec.get("cycles", 1)),
+                        float(spec.get("cycle_delay", 5)), campaign_id, media=spec.get("media"),
+                        priority=int(spec.get("priority", 0)), weight=weight)
+    # Цели по правилу пересчитываются в начале каждого цикла (если нет exclude)
+    if targets.get("rule") and not targets.get("exclude"):
+        campaign.query = targets["rule"]
+    # Ошибки разметки и длины - до подключения к рассылке
+    campaign.prepare(bot.template_cache)
+    return campaign
+
+def run_headless(spec_path, progress_interval=1.0):
+    """`main.py run campaign.json`: рассылка без меню и вопросов. Возвращает код выхода"""
+    config = load_json(CONFIG_FILE, {})
+    setup_logging(config)
+    
+    try:
+        with open(spec_path, 'r', encoding='utf-8') as f:
+            spec = json.load(f)
+    except (OSError, ValueError) as e:
+        emit("error", error=f"Не удалось прочитать {spec_path}: {e}")
+        return EXIT_BAD_SPEC
+    
+    if os.path.exists(PID_FILE):
+        with open(PID_FILE, 'r') as f:
+            old_pid = f.read().strip()
+        if old_pid and os.path.exists(f"/proc/{old_pid}"):
+            emit("error", error=f"Бот уже запущен (PID {old_pid})")
+            return EXIT_BUSY
+    
+    bot = None
+    try:
+        with open(PID_FILE, 'w') as f:
+            f.write(str(os.getpid()))
+        
+        # Ошибка запуска (занятая база, неверный config) - событие и код выхода, а не traceback
+        runner = AsyncRunner()
+        try:
+            bot = TelegramSender(runner)
+        except Exception as e:
+            logger.error(f"Не удалось запустить бот: {e}", exc_info=True)
+            emit("error", error=f"Не удалось запустить бот: {e}")
+            runner.stop()
+            return EXIT_FAILED
+        
+        if not bot.runner.run(bot.connect(interactive=False)):
+            emit("error", error="Нет подключения к Telegram")
+            return EXIT_NO_CONNECTION
+        if spec.get("sync") or not bot.registry:
+            bot.runner.run(bot.sync_chats())
+        
+        try:
+            campaign = build_campaign(bot, spec)
+        except (ValueError, TypeError, KeyError) as e:
+            emit("error", error=str(e))
+            return EXIT_BAD_SPEC
+        
+        # SIGTERM (например, от планировщика) и Ctrl+C - штатная остановка с сохранением курсора
+        stop_requested = []
+        
+        def request_stop(*args):
+            stop_requested.append(True)
+            campaign.stop()
+        
+        signal.signal(signal.SIGTERM, request_stop)
+        
+        emit("start", campaign=campaign.id, targets=len(campaign.chat_ids),
+             cycle=campaign.cycle, index=campaign.index)
+        bot.start_campaign(campaign)
+        while True:
+            try:
+                campaign.future.result(progress_interval)
+                break
+            except concurrent.futures.TimeoutError:
+                sent, errors_count, elapsed = campaign.progress()
+                emit("progress", campaign=campaign.id, sent=sent, errors=errors_count,
+                     cycle=campaign.cycle, index=campaign.index,
+                     rate=round(bot.limiter.achieved_rate(), 3), elapsed=round(elapsed, 1))
+            except KeyboardInterrupt:
+                request_stop()
+        
+        status = bot.store.campaign_status(campaign.id)
+        sent, errors_count, elapsed = campaign.progress()
+        emit("done", campaign=campaign.id, status=status, sent=sent, errors=errors_count,
+             elapsed=round(elapsed, 1))
+        if status == "done":
+            return EXIT_PARTIAL if errors_count else EXIT_OK
+        return EXIT_STOPPED if stop_requested else EXIT_FAILED
+    
+    finally:
+        if bot is not None:
+            bot.shutdown()
+        if os.path.exists(PID_FILE):
+            os.remove(PID_FILE)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Telegram массовый отправитель")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="напечатать время каждой фазы запуска")
+    commands = parser.add_subparsers(dest="command")
+    run = commands.add_parser("run", help="запустить рассылку из JSON файла без меню")
+    run.add_argument("spec", help="файл рассылки (JSON)")
+    run.add_argument("--progress-interval", type=float, default=1.0,
+                     help="как часто печатать прогресс, сек")
+    return parser.parse_args(argv)
+
 # ========== ГЛАВНАЯ ФУНКЦИЯ ==========
-async def main():
+def main(profile=None):
     """Основная функция"""
+    profile = profile or StartupProfile()
+    profile.mark("импорт модулей")
+    setup_logging(load_json(CONFIG_FILE, {}))
+    profile.mark("логирование")
     print_header("⚡ ЗАГРУЗКА...")
     
     print("🔍 Проверяю настройки...")
@@ -1011,50 +5018,71 @@ async def main():
     if not os.path.exists(CONFIG_FILE):
         print("❌ Конфигурация не найдена!")
         print("🔄 Запускаю мастер настройки...")
-        config = await setup_wizard()
+        config = setup_wizard()
     else:
         config = load_json(CONFIG_FILE)
     
     if not config.get("api_id") or not config.get("api_hash"):
         print("❌ API данные не настроены!")
         print("🔄 Запускаю мастер настройки...")
-        config = await setup_wizard()
+        config = setup_wizard()
     
     # Инициализация бота
     print("\n🤖 Инициализация бота...")
-    bot = TelegramSender()
-    
-    # Подключение к Telegram
-    print("📡 Подключение к Telegram...")
-    connected = await bot.connect()
-    
-    if not connected:
-        print("\n❌ Ошибка подключения!")
-        print("Возможные причины:")
-        print("1. Неверный API ID/Hash")
-        print("2. Проблемы с интернетом")
-        print("3. Аккаунт заблокирован")
-        input("\n↵ Нажмите Enter для выхода...")
-        return
+    bot = TelegramSender(AsyncRunner())
+    profile.mark("база и реестр чатов")
     
-    # Загрузка чатов
-    print("📋 Загрузка чатов...")
-    await bot.get_chats()
+    if bot.me and os.path.exists(f"{SESSION_NAME}.session"):
+        # Вход уже был: меню сразу работает с базой, подключение и
+        # обновление чатов идут в фоне
+        bot.connect_in_background(profile)
+    else:
+        # Первый вход требует ввода номера и кода - только на переднем плане
+        print("📡 Подключение к Telegram...")
+        connected = bot.runner.run(bot.connect())
+        
+        if not connected:
+            print("\n❌ Ошибка подключения!")
+            print("Возможные причины:")
+            print("1. Неверный API ID/Hash")
+            print("2. Проблемы с интернетом")
+            print("3. Аккаунт заблокирован")
+            input("\n↵ Нажмите Enter для выхода...")
+            bot.shutdown()
+            return
+        
+        bot.runner.submit(bot.sync_chats())
+        profile.mark("подключение")
+    bot.start_scheduler()
+    bot.start_metrics_server()
     
     print(f"\n✅ Бот готов!")
     print(f"👤 Аккаунт: {bot.me.first_name if bot.me else 'Неизвестно'}")
-    print(f"📊 Загружено чатов: {len(bot.chats)}")
+    print(f"📊 Загружено чатов: {len(bot.registry)} (обновление в фоне)")
+    if len(bot.scheduler):
+        print(f"⏰ Запланировано рассылок: {len(bot.scheduler)}")
+    profile.mark("меню готово")
     
-    time.sleep(2)
+    if profile.enabled:
+        profile.report()
+        input("\n↵ Enter - в меню...")
     
     # Показываем главное меню
-    show_main_menu(bot)
+    try:
+        show_main_menu(bot)
+    finally:
+        bot.shutdown()
+        profile.report("ПРОФИЛЬ ЗАПУСКА (с фоновыми фазами)")
 
 # ========== ТОЧКА ВХОДА ==========
 if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "run":
+        sys.exit(run_headless(args.spec, args.progress_interval))
+    
     try:
         # Проверка на уже запущенный процесс
-        pid_file = "bot.pid"
+        pid_file = PID_FILE
         if os.path.exists(pid_file):
             with open(pid_file, 'r') as f:
                 old_pid = f.read().strip()
@@ -1069,21 +5097,20 @@ if __name__ == "__main__":
             f.write(str(os.getpid()))
         
         # Запуск бота
-        asyncio.run(main())
+        main(StartupProfile(args.profile_startup))
         
     except KeyboardInterrupt:
         print("\n\n⚠️ Получен сигнал прерывания...")
-        stop_sending()
         print("👋 Завершение работы...")
         time.sleep(1)
         
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}", exc_info=True)
         print(f"\n❌ Критическая ошибка: {e}")
-        print("Проверьте файл logs/bot.log для деталей")
+        print(f"Проверьте файл {LOG_FILE} для деталей")
         input("\n↵ Нажмите Enter для выхода...")
         
     finally:
         # Удаляем PID файл
-        if os.path.exists("bot.pid"):
-            os.remove("bot.pid")
+        if os.path.exists(PID_FILE):
+            os.remove(PID_FILE)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Общие фикстуры: рабочий каталог, цикл с виртуальным временем и бот на FakeTelegramClient"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from fake_telegram import FakeTelegramClient, VirtualTimeLoop  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """main.py пишет в data/ и logs/ относительно текущего каталога"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("logs", exist_ok=True)
+    main.load_telethon()
+    return tmp_path
+
+
+@pytest.fixture
+def loop():
+    loop = VirtualTimeLoop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def make_bot(loop):
+    """Бот с подмененным клиентом и синхронизированными диалогами"""
+    bots = []
+
+    def make(chats=20, **client_options):
+        bot = main.TelegramSender()
+        bot.limiter.clock = loop.time
+        bot.client = FakeTelegramClient(chats, **client_options)
+        bot.me = loop.run_until_complete(bot.client.get_me())
+        loop.run_until_complete(bot.get_chats())
+        bots.append(bot)
+        return bot
+
+    yield make
+    for bot in bots:
+        bot.stats_writer.flush()
+        bot.delivery.close()
+        bot.store.close()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import os
+
+import main
+
+
+def open_log(store, **options):
+    options.setdefault("directory", os.path.join("data", "delivery"))
+    return main.DeliveryLog(store, **options)
+
+
+def test_segments_rotate_and_old_ones_are_pruned():
+    store = main.DataStore()
+    log = open_log(store, segment_bytes=400, keep_segments=2, index_every=1)
+    for chat_id in range(1, 21):
+        log.record("c1", chat_id, "ok", message_id=chat_id)
+    assert log.segment > 2
+    assert log._segments() == [log.segment - 1, log.segment]
+    # Индекс не указывает на удаленные сегменты
+    kept = log.last_success()
+    assert kept and max(kept) == 20
+    for chat_id, (campaign, message_id, _) in kept.items():
+        assert (campaign, message_id) == ("c1", chat_id)
+    assert len(kept) < 20
+    log.close()
+    store.close()
+
+
+def test_unindexed_tail_is_recovered_and_torn_line_truncated():
+    store = main.DataStore()
+    log = open_log(store, index_every=1000)
+    log.record("c1", 1, "ok", message_id=11)
+    log.record("c1", 2, "ChatWriteForbiddenError", error="ChatWriteForbiddenError")
+    # Сбой: индекс не записан, последняя строка оборвана
+    log._file.write(b'{"ts":1,"campaign":"c1","chat":3')
+    log._file.flush()
+    log._file.close()
+    log._file = None
+    path = log._segment_path(log.segment)
+    torn_size = os.path.getsize(path)
+
+    recovered = open_log(store)
+    assert os.path.getsize(path) < torn_size
+    success = recovered.last_success()
+    assert list(success) == [1] and success[1][:2] == ("c1", 11)
+    assert [row[:2] for row in recovered.failed_chats("c1")] == [(2, "ChatWriteForbiddenError")]
+    # Новая запись после восстановления ложится сразу за целыми строками
+    recovered.record("c1", 3, "ok", message_id=13)
+    with open(path, 'rb') as f:
+        assert all(line.endswith(b"\n") for line in f)
+    assert set(recovered.last_success()) == {1, 3}
+    recovered.close()
+    store.close()
+
+
+def test_sends_are_logged_per_attempt(make_bot, loop):
+    bot = make_bot(5)
+    target = bot.registry.ids()[0]
+    bot.client.chat_errors[target] = main.errors.UserIsBlockedError(request=None)
+    campaign = main.Campaign(bot.registry.ids(), "привет", delay=0)
+    loop.run_until_complete(bot.mass_send(campaign))
+    assert set(bot.delivery.last_success()) == set(bot.registry.ids()[1:])
+    assert [row[:2] for row in bot.delivery.failed_chats(campaign.id)] == [(target, "permanent")]
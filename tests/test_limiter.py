@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import main
+
+
+def grant_times(loop, limiter, count, work=0.0):
+    """Моменты выдачи слотов; work - время «отправки» после каждого слота"""
+    times = []
+
+    async def run():
+        for _ in range(count):
+            await limiter.acquire()
+            times.append(round(loop.time(), 6))
+            if work:
+                await asyncio.sleep(work)
+
+    loop.run_until_complete(run())
+    return times
+
+
+def test_slots_follow_absolute_deadlines(loop):
+    limiter = main.RateLimiter(2, clock=loop.time)
+    assert grant_times(loop, limiter, 5) == [0.0, 0.5, 1.0, 1.5, 2.0]
+
+
+def test_send_latency_is_absorbed_by_the_next_wait(loop):
+    limiter = main.RateLimiter(2, clock=loop.time)
+    # 0.3 с на отправку не добавляются к интервалу 0.5 с
+    assert grant_times(loop, limiter, 4, work=0.3) == [0.0, 0.5, 1.0, 1.5]
+
+
+def test_late_send_restarts_schedule_without_burst(loop):
+    limiter = main.RateLimiter(2, clock=loop.time)
+    times = grant_times(loop, limiter, 1)
+    loop.run_until_complete(asyncio.sleep(3))
+    times += grant_times(loop, limiter, 3)
+    assert times == [0.0, 3.0, 3.5, 4.0]
+
+
+def test_flood_wait_pauses_then_repeated_flood_slows_down(loop):
+    limiter = main.RateLimiter(2, max_rate=2, clock=loop.time)
+    grant_times(loop, limiter, 1)
+    limiter.on_flood_wait(7)
+    assert grant_times(loop, limiter, 2) == [7.0, 7.5]
+    limiter.on_flood_wait(3)
+    assert limiter.rate == 2 * main.FLOOD_BACKOFF
+    assert grant_times(loop, limiter, 2) == [10.5, 11.5]
+
+
+def test_higher_priority_lane_gets_the_slot_first(loop):
+    limiter = main.RateLimiter(1, clock=loop.time)
+    order = []
+    low, high = main.Campaign([], "low"), main.Campaign([], "high", priority=1)
+
+    async def send(lane):
+        await limiter.acquire(lane)
+        order.append(lane.text)
+
+    async def run():
+        await limiter.acquire()
+        await asyncio.gather(send(low), send(high))
+
+    loop.run_until_complete(run())
+    assert order == ["high", "low"]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import main
+
+
+def send(bot, loop, chat_id):
+    return loop.run_until_complete(bot.send_message(chat_id, "привет", retries=1))
+
+
+def test_permanent_failure_survives_dialog_updates_and_restart(make_bot, loop):
+    bot = make_bot(10)
+    target = bot.registry.ids()[0]
+    bot.client.chat_errors[target] = main.errors.UserIsBlockedError(request=None)
+    assert not send(bot, loop, target)
+    assert target in bot.registry.quarantine
+
+    # Обычное обновление диалога (новое сообщение) не снимает карантин
+    chat = dict(bot.registry.get(target), top_message=10 ** 6)
+    bot.registry.merge_recent([chat])
+    bot.registry.upsert([dict(chat)])
+    assert target in bot.registry.quarantine
+    assert target not in bot.registry.filter_targets(bot.registry.ids())
+
+    # Карантин хранится в базе и переживает перезапуск
+    assert target in main.ChatRegistry(bot.store).quarantine
+
+
+def test_write_ban_is_released_when_writing_is_allowed_again(make_bot, loop):
+    bot = make_bot(10)
+    target = bot.registry.ids()[0]
+    bot.client.chat_errors[target] = main.errors.ChatWriteForbiddenError(request=None)
+    assert not send(bot, loop, target)
+    assert target in bot.registry.quarantine
+
+    # Пока право писать не пропадало, writable=True ничего не снимает
+    bot.registry.update_chat(target, writable=True)
+    assert target in bot.registry.quarantine
+
+    bot.registry.update_chat(target, writable=False)
+    bot.registry.update_chat(target, writable=True)
+    assert target not in bot.registry.quarantine
+    assert target not in main.ChatRegistry(bot.store).quarantine
+
+
+def test_transient_failures_open_after_threshold_and_probe_after_cooldown(make_bot, loop):
+    bot = make_bot(5)
+    now = [1000.0]
+    quarantine = main.ChatQuarantine(bot.store, threshold=3, cooldown=60, clock=lambda: now[0])
+    for _ in range(2):
+        assert not quarantine.record_failure(7, "RPCError")
+    assert quarantine.record_failure(7, "RPCError")
+    assert 7 in quarantine
+    now[0] += 61
+    # Срок вышел - пробная отправка разрешена, запись остается до успеха
+    assert 7 not in quarantine
+    assert 7 in main.ChatQuarantine(bot.store).entries
+    quarantine.record_success(7)
+    assert 7 not in main.ChatQuarantine(bot.store).entries
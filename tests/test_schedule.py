@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytest
+
+import main
+
+
+def next_run(expression, moment):
+    return datetime.fromtimestamp(main.CronExpression(expression).next_after(moment.timestamp()))
+
+
+def test_cron_next_after_steps_and_ranges():
+    # Пятница 16:50 -> следующий запуск в 17:00, после 17:45 - понедельник 9:00
+    friday = datetime(2026, 10, 16, 16, 50)
+    assert next_run("*/15 9-17 * * 1-5", friday) == datetime(2026, 10, 16, 17, 0)
+    assert next_run("*/15 9-17 * * 1-5", datetime(2026, 10, 16, 17, 45)) == datetime(2026, 10, 19, 9, 0)
+
+
+def test_cron_next_after_is_strictly_later():
+    moment = datetime(2026, 10, 16, 9, 0)
+    assert next_run("0 9 * * *", moment) == datetime(2026, 10, 17, 9, 0)
+
+
+def test_cron_sunday_is_zero_or_seven():
+    saturday = datetime(2026, 10, 17, 12, 0)
+    assert next_run("0 10 * * 7", saturday) == next_run("0 10 * * 0", saturday) == datetime(2026, 10, 18, 10, 0)
+
+
+def test_cron_day_of_month_or_weekday():
+    # Заданы оба поля - подходит любое из них, как в cron
+    assert next_run("0 0 13 * 5", datetime(2026, 10, 10)) == datetime(2026, 10, 13)
+
+
+def test_cron_rejects_rules_that_never_fire():
+    with pytest.raises(ValueError):
+        main.parse_schedule("0 0 30 2 *")
+
+
+@pytest.mark.parametrize("text, seconds", [
+    ("каждые 30м", 1800),
+    ("каждые 5 минут", 300),
+    ("every 2h", 7200),
+    ("every 10 mins", 600),
+    ("каждые 3 дня", 3 * 86400),
+])
+def test_interval_units(text, seconds):
+    assert main.parse_schedule(text) == (main.SCHEDULE_EVERY, seconds)
+
+
+@pytest.mark.parametrize("text", ["every 5 months", "каждые 5 мес", "каждые 0м"])
+def test_interval_rejects_unknown_units_and_zero(text):
+    with pytest.raises(ValueError):
+        main.parse_schedule(text)
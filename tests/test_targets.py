@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import main
+
+
+@pytest.fixture
+def registry(make_bot):
+    registry = make_bot(30).registry
+    ids = registry.ids()
+    registry.create_folder("Клиенты")
+    registry.create_folder("B")
+    for chat_id in ids[:10]:
+        registry.add_to_folder("Клиенты", chat_id)
+    for chat_id in ids[5:15]:
+        registry.add_to_folder("B", chat_id)
+    for chat_id in ids[::4]:
+        registry.add_favorite(chat_id)
+    return registry
+
+
+def select(registry, rule):
+    return main.TargetQuery(rule).evaluate(registry)
+
+
+def test_set_algebra_and_precedence(registry):
+    folder = set(registry.folders["Клиенты"])
+    other = set(registry.folders["B"])
+    favorites = set(registry.favorites)
+    users = set(registry.ids_of_type("user"))
+    assert select(registry, "folder:Клиенты | favorites") == folder | favorites
+    assert select(registry, "folder:Клиенты + folder:B - type:user") == (folder | other) - users
+    # & связывает сильнее | и -
+    assert select(registry, "favorites | folder:Клиенты & folder:B") == favorites | (folder & other)
+    assert select(registry, "(favorites | folder:Клиенты) & folder:B") == (favorites | folder) & other
+
+
+def test_excluded_chats_are_always_removed(registry):
+    blocked, closed, quarantined = registry.ids()[:3]
+    registry.add_to_blacklist(blocked)
+    registry.update_chat(closed, writable=False)
+    registry.quarantine.record_failure(quarantined, "UserIsBlockedError", permanent=True)
+    selected = select(registry, "all")
+    assert not {blocked, closed, quarantined} & selected
+    assert len(selected) == len(registry) - 3
+
+
+def test_ids_keep_dialog_order(registry):
+    query = main.TargetQuery("folder:B | folder:Клиенты")
+    assert query.ids(registry) == registry.ids()[:15]
+
+
+def test_id_term_and_quoted_folder(registry):
+    registry.create_folder("Мои клиенты")
+    chat_id = registry.ids()[-1]
+    registry.add_to_folder("Мои клиенты", chat_id)
+    assert select(registry, f'folder:"Мои клиенты" | id:{registry.ids()[0]}') == {chat_id, registry.ids()[0]}
+
+
+@pytest.mark.parametrize("rule", ["", "folder:Клиенты |", "(favorites", "type:robot", "folder:Нет", "all favorites"])
+def test_malformed_rules(registry, rule):
+    with pytest.raises(ValueError):
+        select(registry, rule)
+
+
+@pytest.mark.parametrize("text", ["0", "-0", "-abc", "t.me/c/0/5"])
+def test_parse_target_rejects_bad_ids(text):
+    with pytest.raises(ValueError, match="неверный ID чата"):
+        main.parse_target(text)
+
+
+def test_parse_target_forms():
+    assert main.parse_target("-1001234") == -1001234
+    assert main.parse_target("t.me/c/1234/5") == -1001234
+    assert main.parse_target("@Name") == "name"
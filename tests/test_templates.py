@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import main
+
+
+def utf16(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def spans(text, entities):
+    """(вид сущности, размеченный текст) по смещениям UTF-16"""
+    encoded = text.encode("utf-16-le")
+    return [(type(e).__name__, encoded[2 * e.offset:2 * (e.offset + e.length)].decode("utf-16-le"))
+            for e in entities]
+
+
+def test_entities_shift_by_utf16_length_of_values():
+    template = main.CompiledTemplate("**{name}** 👍 __{n} из {total}__")
+    (text, entities), = template.render({"name": "Чат 😀😀", "n": "3", "total": "20"})
+    assert text == "Чат 😀😀 👍 3 из 20"
+    assert spans(text, entities) == [("MessageEntityBold", "Чат 😀😀"), ("MessageEntityItalic", "3 из 20")]
+    assert entities[0].length == utf16("Чат 😀😀") == 8
+
+
+def test_same_template_renders_each_recipient_independently():
+    template = main.CompiledTemplate("Привет, **{name}**!")
+    first, = template.render({"name": "😀"})
+    second, = template.render({"name": "Анна"})
+    assert spans(*first) == [("MessageEntityBold", "😀")]
+    assert spans(*second) == [("MessageEntityBold", "Анна")]
+
+
+def test_empty_value_drops_zero_length_entity():
+    (text, entities), = main.CompiledTemplate("**{username}**привет").render({"username": ""})
+    assert text == "привет"
+    assert entities == []
+
+
+def test_escaped_braces_and_unknown_fields_stay_text():
+    (text, _), = main.CompiledTemplate("{{id}} {unknown} {id}").render({"id": "42"})
+    assert text == "{id} {unknown} 42"
+
+
+def test_n_counts_within_cycle(make_bot, loop):
+    bot = make_bot(4)
+    campaign = main.Campaign(bot.registry.ids(), "{n}/{total} ц{cycle}", delay=0, cycles=2, cycle_delay=0)
+    loop.run_until_complete(bot.mass_send(campaign))
+    assert [text for _, text in bot.client.sent] == [
+        "1/4 ц1", "2/4 ц1", "3/4 ц1", "4/4 ц1", "1/4 ц2", "2/4 ц2", "3/4 ц2", "4/4 ц2"]